@@ -9,73 +9,114 @@
     Last Edited: Oct 10, 2022
 """
 
+# Start the startup timer before anything else is imported
+from time import perf_counter
+STARTED = perf_counter()
+
 # Import GUI packages
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
 
-# Import data science packages
-import numpy as np
-import pandas as pd
-import random
-
-# Import audio packages
-import sounddevice as sd
-
 # Import system packages
-import sys
 import os
+import queue
 
 # Import custom modules
+import tracing
 import views as v
 import models as m
+from booth import Booth
+from devices import DeviceInventory
+from watcher import DirectoryWatcher
 from mainmenu import MainMenu
+from profiling import Profiler
+
+
+trace = tracing.get_tracer('app')
 
 
 class Application(tk.Tk):
     """ Application root window """
+    # Limits for Raw Level changes while the calibration stimulus
+    # plays (dB FS, and dB per change)
+    CAL_MAX_LEVEL = 0
+    CAL_MAX_STEP = 10
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.withdraw()
         self.title("Adaptive Rating Tool")
 
+        # Optional profiling of handlers and model calls
+        self.profiler = Profiler()
+        for name in ('_get_audio', '_repeat_audio', 'present_audio', 
+            '_on_submit'):
+            setattr(self, name, self.profiler.wrap(name, getattr(self, name)))
+
         # Load current session parameters (or defaults)
         self.sessionpars_model = m.SessionParsModel()
         self._load_sessionpars()
 
-        # Set up file tracker counter
-        # Set this here before loading the model
-        # or counter is overriden to 0!
-        self.counter = 0
+        # Audio device list, scanned in the background so the
+        # Audio Settings dialog opens right away (and the device
+        # sample rate is known without querying PortAudio here)
+        self.devices = DeviceInventory()
+        self._devices_poll_id = None
+
+        # The session itself: stimulus list, adaptive track, 
+        # prefetching, output stream and data model (one booth
+        # using the global stimulus cache)
+        self.booth = Booth('Main', self.sessionpars, cache=m.stimulus_cache,
+            devices=self.devices)
+        self.booth.load_audio = self.profiler.wrap('Audio', 
+            self.booth.load_audio)
+        self._wrap_data_model()
+        self._refresh_devices()
+
+        # Looping calibration stimulus: (signal, fs) by file and
+        # rate, the playing Voice and its level (dB FS)
+        self._cal_buffers = dict()
+        self._cal_voice = None
+        self._cal_level = None
+
+        # Optional watcher for the audio files directory
+        self.watcher = None
+        self._audio_changes = queue.Queue()
+        self._poll_id = None
 
         # Make audio files list model
-        self._audio_list = pd.DataFrame()
-        self.audio_data = pd.DataFrame()
         self._load_audiolist_model()
 
         # Initialize objects
-        self.model = m.CSVModel(self.sessionpars)
-        self.main_frame = v.MainFrame(self, self.model, self.sessionpars)
+        self.main_frame = v.MainFrame(self, self.booth.model, self.sessionpars)
         self.main_frame.grid(row=1, column=0)
         self.main_frame.bind('<<SaveRecord>>', self._on_submit)
-        self.main_frame.bind('<<RepeatAudio>>', self.present_audio)
+        self.main_frame.bind('<<RepeatAudio>>', self._repeat_audio)
         self.main_frame.bind('<<PlayAudio>>', self._get_audio)
 
         # Menu
-        menu = MainMenu(self, self.sessionpars)
-        self.config(menu=menu)
+        self.menu = MainMenu(self, self.sessionpars)
+        self.menu.profiling.set(self.profiler.enabled)
+        self.menu.set_profiles(self.sessionpars_model.profiles(),
+            self.sessionpars_model.profile)
+        self.config(menu=self.menu)
         # Create callback dictionary
         event_callbacks = {
             '<<FileSession>>': lambda _: self._show_sessionpars(),
-            '<<FileQuit>>': lambda _: self.quit(),
-            '<<ParsDialogOk>>': lambda _: self._save_sessionpars(),
+            '<<FileProfile>>': lambda _: self._use_profile(),
+            '<<FileQuit>>': lambda _: self._quit(),
+            '<<ParsDialogOk>>': lambda _: self._on_sessionpars_ok(),
             '<<ParsDialogCancel>>': lambda _: self._load_sessionpars(),
             '<<ToolsSpeaker>>': lambda _: self._show_audioconfig(),
-            '<<AudioParsSubmit>>': lambda _: self._save_sessionpars(),
+            '<<AudioParsSubmit>>': lambda _: self._on_audiopars_submit(),
             '<<ToolsCalibrate>>': lambda _: self._show_calibration(),
-            '<<CalibrationSubmit>>': lambda _: self._calc_level(),
-            '<<PlayCalStim>>': lambda _: self._play_cal()
+            '<<ToolsProfiling>>': lambda _: self._toggle_profiling(),
+            '<<CalibrationSubmit>>': lambda _: self._on_calibration_submit(),
+            '<<PlayCalStim>>': lambda _: self._play_cal(),
+            '<<CalRawLevel>>': lambda _: self._on_raw_level(),
+            '<<StopCalStim>>': lambda _: self._stop_cal()
         }
         # Bind callbacks to sequences
         for sequence, callback in event_callbacks.items():
@@ -88,12 +129,26 @@ class Application(tk.Tk):
         # Track trial number
         self._records_saved = 0
 
+        # Flush saved records when the window is closed
+        self.protocol("WM_DELETE_WINDOW", self._quit)
+
         # Set up root window
         #self.deiconify()
 
         self.center_window()
 
 
+    @property
+    def counter(self):
+        """ Index of the current file in the stimulus list """
+        return self.booth.track.index
+
+
+    @counter.setter
+    def counter(self, value):
+        self.booth.track.index = value
+
+
     def center_window(toplevel):
         """ Center the root window """
         toplevel.update_idletasks()
@@ -107,67 +162,183 @@ class Application(tk.Tk):
 
 
     def _show_audioconfig(self):
-        print("App_110: Calling audio config dialog...")
-        v.AudioParams(self, self.sessionpars)
+        trace.info("App_110: Calling audio config dialog...")
+        # Show the cached list now; it updates when the scan ends
+        self._refresh_devices()
+        v.AudioParams(self, self.sessionpars, self.devices)
+
+
+    def _refresh_devices(self):
+        """ Rescan audio devices in the background and apply the
+            device sample rate when the scan ends
+        """
+        self.devices.refresh()
+        if self._devices_poll_id is None:
+            self._devices_poll_id = self.after(250, self._poll_devices)
+
+
+    def _poll_devices(self):
+        if self.devices.scanning:
+            self._devices_poll_id = self.after(250, self._poll_devices)
+            return
+        self._devices_poll_id = None
+        self.booth.load_rendered()
+
+    
+    def _on_audiopars_submit(self):
+        """ Save audio settings and apply them to the stream """
+        self._save_sessionpars()
+        self.booth.engine.configure(
+            blocksize=self.sessionpars['Block Size'].get(),
+            latency=self.sessionpars['Output Latency'].get())
+        # The device (and its sample rate) may have changed
+        self.booth.load_rendered()
 
     
     def _show_calibration(self):
-        print("App_115: Calling calibration dialog...")
+        trace.info("App_115: Calling calibration dialog...")
         v.Calibration(self, self.sessionpars)
 
 
     def _show_sessionpars(self):
         """ Show the session parameters dialog """
-        print("App_121: Calling sessionpars dialog...")
+        trace.info("App_121: Calling sessionpars dialog...")
         v.SessionParams(self, sessionpars=self.sessionpars, 
             title="Session", error='')
 
 
+    def _on_sessionpars_ok(self):
+        """ Save session parameters and switch track mode, 
+            storage backend and directory watching if they 
+            changed
+        """
+        self._save_sessionpars()
+        self.booth.set_track_mode()
+        if self.booth.set_data_format():
+            self._wrap_data_model()
+            self.main_frame.model = self.booth.model
+        # 'Watch Audio Files' may have been switched
+        if (self.watcher is not None) != \
+            self.sessionpars['Watch Audio Files'].get():
+            self._start_watcher()
+
+
+    def _wrap_data_model(self):
+        """ Profile the data model's save_record """
+        model = self.booth.model
+        model.save_record = self.profiler.wrap(
+            f"{type(model).__name__}.save_record", model.save_record)
+
+
     def _calc_level(self):
-        slm_offset = self.sessionpars['SLM Reading'].get() - self.sessionpars['Raw Level'].get()
-        print(f"SLM offset: {slm_offset}")
-        self.sessionpars['Adjusted Presentation Level'].set(
-            self.sessionpars['Presentation Level'].get() - slm_offset)
-        print(f"Calculated level from _calc_level: " +
-            f"{self.sessionpars['Adjusted Presentation Level'].get()}")
+        """ Update the Adjusted Presentation Level from the 
+            calibration values. Called on every presentation, so
+            settings are only saved when the level changed.
+        """
+        level = self.booth.level
+        if self.booth.calc_level() != level:
+            self._save_sessionpars()
+        self.booth.load_rendered()
+
+
+    def _on_calibration_submit(self):
+        """ Save the calibration and apply it """
         self._save_sessionpars()
+        self._calc_level()
 
 
-    def resource_path(self, relative_path):
-        """ Get the absolute path to the resource 
-            Works for dev and for PyInstaller
+    def _play_cal(self):
+        """ Loop the calibration stimulus on the output stream 
+            until _stop_cal. Raw Level changes are applied when
+            they are entered (see _on_raw_level).
         """
+        self._stop_cal()
         try:
-            # PyInstaller creates a temp folder and stores path in _MEIPASS
-            base_path = sys._MEIPASS
-        except Exception:
-            base_path = os.path.abspath(".")
+            sig, fs = self._cal_stimulus()
+            level = self.sessionpars['Raw Level'].get()
+        except (OSError, ValueError, tk.TclError) as e:
+            messagebox.showerror(title="Calibration stimulus", 
+                message=f"Could not load calibration stimulus: {e}")
+            return
 
-        return os.path.join(base_path, relative_path)
+        level = self._limit_cal_level(level)
+        self._cal_voice = self.booth.engine.play(sig, fs,
+            device_id=self.sessionpars['Audio Device ID'].get(),
+            mapping=self.sessionpars['Speaker Number'].get(),
+            loop=True, gain=m.Audio.db2mag(level))
+        self._cal_level = level
 
 
-    def _play_cal(self):
-        """ Load calibration file and present
+    def _cal_stimulus(self):
+        """ Calibration signal with an RMS of 0 dB FS, and its 
+            sample rate. White noise is generated in memory and
+            a custom file is read once.
         """
-         # Check for default calibration stimulus request
-        if self.sessionpars['Calibration File'].get() == 'cal_stim.wav':
-            # Create calibration audio object
-            try:
-                # If running from compiled, look in compiled temporary location
-                cal_file = self.resource_path('cal_stim.wav')
-                cal_stim = m.Audio(cal_file, self.sessionpars['Raw Level'].get())
-            except FileNotFoundError:
-                # If running from command line, look in assets folder
-                cal_file = '.\\assets\\cal_stim.wav'
-                cal_stim = m.Audio(cal_file, self.sessionpars['Raw Level'].get())
-        else: # Custom calibration file was provided
-            print("Reading provided calibration file...")
-            cal_stim = m.Audio(self.sessionpars['Calibration File'].get(), 
-                self.sessionpars['Raw Level'].get())
-
-        # Present calibration stimulus
-        cal_stim.play(device_id=self.sessionpars['Audio Device ID'].get(), 
-            channels=self.sessionpars['Speaker Number'].get())
+        cal_file = self.sessionpars['Calibration File'].get()
+        samplerate = self.booth.cache.samplerate
+        key = (cal_file, samplerate)
+        if key not in self._cal_buffers:
+            # Check for default calibration stimulus request
+            if cal_file == 'cal_stim.wav':
+                fs = samplerate or 48000
+                sig = m.calibration_noise(fs)
+            else: # Custom calibration file was provided
+                trace.info("Reading provided calibration file...")
+                fs, _, sig = m.read_wav(cal_file)
+                if len(sig) == 0:
+                    raise ValueError(f"{cal_file} has no samples")
+                if samplerate:
+                    sig = m.resample(sig, fs, samplerate)
+                    fs = samplerate
+                sig = m.apply_level(sig, 0)
+            # Only keep the current stimulus
+            self._cal_buffers = {key: (sig, fs)}
+        return self._cal_buffers[key]
+
+
+    def _on_raw_level(self):
+        """ Apply an entered Raw Level (<Return> or leaving the
+            entry) to the looping calibration stimulus
+        """
+        if self._cal_voice is None:
+            return
+        try:
+            level = self.sessionpars['Raw Level'].get()
+        except tk.TclError:
+            # Not a number: show the level that is playing
+            self.sessionpars['Raw Level'].set(self._cal_level)
+            return
+        level = self._limit_cal_level(level)
+        self._cal_voice.set_gain(m.Audio.db2mag(level))
+        self._cal_level = level
+
+
+    def _limit_cal_level(self, level):
+        """ LEVEL clamped to CAL_MAX_LEVEL and to within 
+            CAL_MAX_STEP of the playing level. Raw Level is set to
+            the result, so the calibration uses the level that
+            was actually played.
+        """
+        limited = min(level, self.CAL_MAX_LEVEL)
+        if self._cal_level is not None:
+            limited = min(max(limited, self._cal_level - self.CAL_MAX_STEP),
+                self._cal_level + self.CAL_MAX_STEP)
+        if limited != level:
+            trace.warning("App: Raw Level limited to %s dB FS", limited)
+            self.sessionpars['Raw Level'].set(limited)
+        return limited
+
+
+    def _stop_cal(self):
+        """ Fade out the calibration stimulus. Raw Level is reset
+            to the level that was playing, so an edit that was
+            never entered is not saved with the calibration.
+        """
+        if self._cal_voice is not None:
+            self.booth.engine.stop(fade=True)
+            self._cal_voice = None
+            self.sessionpars['Raw Level'].set(self._cal_level)
+        self._cal_level = None
     
 
     def _load_sessionpars(self):
@@ -185,34 +356,45 @@ class Application(tk.Tk):
         for key, data in self.sessionpars_model.fields.items():
             vartype = vartypes.get(data['type'], tk.StringVar)
             self.sessionpars[key] = vartype(value=data['value'])
-        print("App_180: Loaded sessionpars model fields into " +
+        trace.debug("App_180: Loaded sessionpars model fields into " +
             "running sessionpars dict")
 
 
     def _save_sessionpars(self, *_):
-        """ Save the current settings to a preferences file """
-        print("App_185: Calling sessionpar model set vars and save functions")
+        """ Save the current settings to a preferences file 
+            (changed fields only, written after a short delay)
+        """
+        trace.debug("App_185: Calling sessionpar model set vars and save functions")
 
         for key, variable in self.sessionpars.items():
             self.sessionpars_model.set(key, variable.get())
-            self.sessionpars_model.save()
+        self.sessionpars_model.save()
+
+
+    def _use_profile(self):
+        """ Switch to the settings profile chosen in the menu """
+        self._save_sessionpars()
+        self.sessionpars_model.use_profile(self.menu.profile.get())
+        # Update the running variables in place (views hold them)
+        for key, data in self.sessionpars_model.fields.items():
+            self.sessionpars[key].set(data['value'])
+        self.menu.set_profiles(self.sessionpars_model.profiles(),
+            self.sessionpars_model.profile)
+        trace.info("App: Using settings profile %s", 
+            self.sessionpars_model.profile)
+        self.booth.engine.configure(
+            blocksize=self.sessionpars['Block Size'].get(),
+            latency=self.sessionpars['Output Latency'].get())
+        self._on_sessionpars_ok()
+        self.booth.load_rendered()
+        self._load_audiolist_model()
+        self._calc_level()
 
 
     def _load_audiolist_model(self):
-        self.audiolist_model = m.AudioList(self.sessionpars)
-        try:
-            self.df_audio_data = self.audiolist_model.audio_data
-        except:
-            print("App_197: Problem creating list of audio files...")
-            return
-        if len(self.df_audio_data.index) > 0:
-            print("App_200: Loaded audio files from AudioList model into " + 
-                "runtime environment")
-            self.counter = random.choice(
-                np.arange(0,len(self.df_audio_data.index)-1))
-            print(f"App_145: Starting record number: {self.counter}")
-        else:
-            print("App_204: No audio files in list!")
+        if self.booth.load_stimuli():
+            self._start_watcher()
+        elif hasattr(self.booth.audiolist_model, 'index'):
             messagebox.showwarning(
                 title="No path selected",
                 message="Please use File>Session to select a valid " +
@@ -220,33 +402,56 @@ class Application(tk.Tk):
             )
 
 
+    def _start_watcher(self):
+        """ Start (or stop) watching the audio files directory
+            according to the 'Watch Audio Files' setting
+        """
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        if not self.sessionpars['Watch Audio Files'].get():
+            return
+        if not hasattr(self.booth.audiolist_model, 'index'):
+            return
+        self.watcher = DirectoryWatcher(
+            self.booth.audiolist_model.index.directory,
+            self._on_audio_dir_change)
+        self.watcher.start()
+        trace.info("App_230: Watching audio files directory (%s)", 
+            self.watcher.mode)
+        if self._poll_id is None:
+            self._poll_id = self.after(250, self._poll_audio_changes)
+
+
+    def _on_audio_dir_change(self):
+        """ Rescan the audio directory (runs on the watcher thread) """
+        changes = self.booth.rescan()
+        if any(changes[:3]):
+            self._audio_changes.put(changes)
+
+
+    def _poll_audio_changes(self):
+        """ Apply directory changes on the GUI thread """
+        while True:
+            try:
+                changes = self._audio_changes.get_nowait()
+            except queue.Empty:
+                break
+            self.booth.apply_changes(changes)
+        if self.watcher is not None:
+            self._poll_id = self.after(250, self._poll_audio_changes)
+        else:
+            self._poll_id = None
+
+
     def _get_audio(self, *_):
-        """ Increment counter, pull audio file, present audio """
-        # Get what button was pressed
+        """ Move the track with the pressed button and present
+            the new file
+        """
+        # The track keeps the counter within bounds
         data = self.main_frame.get()
-        if data['Button ID'] == "bigup":
-            self.counter -= 4
-        elif data['Button ID'] == "smallup":
-            self.counter -= 1
-        elif data['Button ID'] == "bigdown":
-            self.counter += 4
-        elif data['Button ID'] == "smalldown":
-            self.counter += 1
-
-        # Make sure counter stays within bounds
-        df_len = int(len(self.df_audio_data.index)-1)
-        if self.counter >= df_len:
-            self.counter = df_len
-            #self.main_frame.event_generate('<<LowerLimit>>')
-            print("App_241: Limit reached!")
-            messagebox.showwarning(
-                title='Limit Reached!',
-                message="You are at the limit"
-            )
-        elif self.counter <= 0:
-            self.counter = 0
-            #self.main_frame.event_generate('<<UpperLimit>>')
-            print("App_250: Limit reached!")
+        self.booth.move(data['Button ID'], self.main_frame.press_ns)
+        if self.booth.track.limit:
             messagebox.showwarning(
                 title='Limit Reached!',
                 message="You are at the limit"
@@ -256,51 +461,105 @@ class Application(tk.Tk):
         self.present_audio()
 
 
-    def present_audio(self, *_):
-        # Present audio
-        print(f"App_237: Playing record #: {self.counter}")
-        self.filename = self.df_audio_data["Audio List"].iloc[self.counter]
-        print(f"App_239: Record name: {self.filename}")
+    def _repeat_audio(self, *_):
+        """ Present the current file again """
+        self.booth.latency.begin(self.main_frame.press_ns)
+        self.present_audio()
 
+
+    def present_audio(self, *_):
         # Calculate adjusted presentation level in case of change
         self._calc_level()
-
-        # Create audio object from stimulus list
-        # Audio object expects a full file path and a presentation level
-        print(f"Adjusted presentation level: " + 
-            f"{self.sessionpars['Adjusted Presentation Level'].get()}")
-        print(type(self.sessionpars['Adjusted Presentation Level'].get()))
-        audio_obj = m.Audio(self.filename, 
-            self.sessionpars['Adjusted Presentation Level'].get())
-
-        # Present wav file stimulus
-        audio_obj.play(device_id=self.sessionpars['Audio Device ID'].get(),
-            channels=self.sessionpars['Speaker Number'].get())
+        self.booth.present()
 
 
     def _on_submit(self, *_):
         """ Save trial ratings, update trial counter,
             and reset sliders.
          """
-        # Get _vars from main_frame view
-        data = self.main_frame.get()
-        # Update _vars with current audio file name
-        data["Audio Filename"] = self.filename
-        # Pass data dict to CSVModel for saving
-        self.model.save_record(data)
+        # Get _vars from main_frame view; the booth adds the
+        # file name, latency and Bayes estimate
+        self.booth.submit(self.main_frame.get())
         self._records_saved += 1
         self.status.set(f"Trials Completed: {self._records_saved}")
         self.main_frame.reset()
-        # Choose a new random starting index
-        self.counter = random.choice(
-            np.arange(0,len(self.df_audio_data.index)-1))
 
 
     def _quit(self):
         """ Exit the program """
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self._devices_poll_id is not None:
+            self.after_cancel(self._devices_poll_id)
+        try:
+            self.booth.close()
+        except OSError as e:
+            messagebox.showerror(title="Could not save data", message=str(e))
+        try:
+            self.sessionpars_model.flush()
+        except OSError as e:
+            trace.warning("App: Could not save settings: %s", e)
+        self.booth.latency.finish()
+        for stage, stats in self.booth.latency.summary().items():
+            trace.info("Latency %s: %s", stage, stats)
+        self._export_trace()
+        self._export_profile()
         self.destroy()
 
 
+    def _session_file(self, suffix=''):
+        """ Path next to the data file, named after the session """
+        model = self.booth.model
+        directory = getattr(model, 'directory', self.booth.data_dir)
+        return os.path.join(directory, 
+            f"{model.datestamp}_" +
+            f"{self.sessionpars['Condition'].get()}_" +
+            f"{self.sessionpars['Subject'].get()}{suffix}")
+
+
+    def _toggle_profiling(self):
+        """ Start or stop profiling (Tools > Profiling) """
+        self.profiler.enabled = self.menu.profiling.get()
+        trace.info("App: Profiling %s", 
+            'on' if self.profiler.enabled else 'off')
+
+
+    def _export_profile(self):
+        """ Write the profile and summary (if profiling was used)
+            next to the data file
+        """
+        try:
+            summary = self.profiler.write(*os.path.split(
+                self._session_file()))
+        except OSError as e:
+            trace.warning("App: Could not write profile: %s", e)
+            return
+        if summary is not None:
+            trace.info("App: Wrote profile summary to %s", summary)
+
+
+    def _export_trace(self):
+        """ Write the session trace (if anything was traced) next
+            to the data file
+        """
+        if not tracing.events:
+            return
+        filename = self._session_file('_trace.json')
+        try:
+            count = tracing.export_chrome(filename)
+        except OSError as e:
+            trace.warning("App: Could not write trace file: %s", e)
+            return
+        trace.info("App: Wrote %d trace events to %s", count, filename)
+
+
 if __name__ == "__main__":
     app = Application()
-    app.mainloop()
+    # Report time to first window
+    app.update()
+    print(f"App: Time to first window: {perf_counter() - STARTED:.3f} s")
+    if os.environ.get('ADAPTIVE_RATING_STARTUP_CHECK'):
+        # Only measuring startup (see benchmarks.py startup)
+        app._quit()
+    else:
+        app.mainloop()
@@ -0,0 +1,204 @@
+""" Aggregate session CSV files into a columnar dataset
+
+    Merges every {datestamp}_{condition}_{subject}.csv file
+    written by CSVModel into a Parquet or Feather dataset.
+    Files written by NormalizedCSVModel (_trials.csv with a
+    _session.json sidecar) are re-joined into the same form.
+    Files are parsed in a process pool. A manifest of ingested
+    files (path, size, mtime) is kept with the dataset, so a
+    repeated run only reads new or changed sessions and writes
+    them as a new part file.
+
+    Usage:
+        python aggregate.py DATA_DIR DATASET_DIR [--format feather]
+        python aggregate.py DATA_DIR DATASET_DIR --compact
+
+    Use load_dataset(DATASET_DIR) to read the merged data.
+    Columns that only exist in some sessions (e.g., added
+    session parameters) are filled with missing values.
+
+    Parquet and Feather output require pyarrow.
+"""
+
+# Import system packages
+import argparse
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# Import data science packages
+import pandas as pd
+
+# Import custom modules
+import models as m
+
+
+# Session files written by CSVModel: 2022_Oct_10_1405_Quiet_999.csv
+SESSION_PATTERN = re.compile(r'^\d{4}_[A-Za-z]{3}_\d{2}_\d{4}_.+\.csv$')
+
+MANIFEST = 'manifest.json'
+
+
+def find_sessions(data_dir):
+    """ Return {path: (size, mtime_ns)} for every session CSV
+        below DATA_DIR
+    """
+    sessions = dict()
+    stack = [data_dir]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif SESSION_PATTERN.match(entry.name):
+                    st = entry.stat()
+                    path = os.path.abspath(entry.path)
+                    sessions[path] = (st.st_size, st.st_mtime_ns)
+    return sessions
+
+
+def load_manifest(dataset_dir):
+    """ Read the manifest of ingested files (or an empty one) """
+    file = Path(dataset_dir) / MANIFEST
+    if not file.exists():
+        return {'parts': 0, 'files': {}}
+    with open(file, 'r') as fh:
+        return json.load(fh)
+
+
+def save_manifest(dataset_dir, manifest):
+    """ Write the manifest atomically """
+    file = Path(dataset_dir) / MANIFEST
+    tmp = file.with_suffix('.tmp')
+    with open(tmp, 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    os.replace(tmp, file)
+
+
+def read_session(path):
+    """ Parse one session file (runs in a worker process) """
+    if path.endswith(m.NormalizedCSVModel.file_suffix + '.csv') and \
+        m.sidecar_path(path).exists():
+        df = m.load_normalized(path)
+    else:
+        df = pd.read_csv(path)
+    df.insert(0, 'source_file', path)
+    df.insert(1, 'trial', range(1, len(df) + 1))
+    return df
+
+
+def _write_part(df, file, fmt):
+    """ Write one part of the dataset """
+    # Mixed-type columns (e.g., subject IDs) are stored as text
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].astype('string')
+    df = df.reset_index(drop=True)
+    if fmt == 'feather':
+        df.to_feather(file)
+    else:
+        df.to_parquet(file, index=False)
+
+
+def _part_files(dataset_dir):
+    """ Map part number -> file for every part in the dataset """
+    parts = dict()
+    for file in Path(dataset_dir).glob('part-*'):
+        if file.suffix in ('.parquet', '.feather'):
+            parts[int(file.stem.split('-')[1])] = file
+    return parts
+
+
+def _read_part(file):
+    if file.suffix == '.feather':
+        return pd.read_feather(file)
+    return pd.read_parquet(file)
+
+
+def load_dataset(dataset_dir):
+    """ Load the merged dataset as one DataFrame. Rows of a
+        session that was ingested more than once are taken
+        from its most recent part only.
+    """
+    manifest = load_manifest(dataset_dir)
+    latest = {path: info['part'] for path, info in manifest['files'].items()}
+    frames = []
+    for part, file in sorted(_part_files(dataset_dir).items()):
+        df = _read_part(file)
+        keep = df['source_file'].map(latest) == part
+        frames.append(df[keep.to_numpy()])
+    if not frames:
+        return pd.DataFrame()
+    # Union of all columns, in order of first appearance
+    return pd.concat(frames, ignore_index=True, sort=False)
+
+
+def ingest(data_dir, dataset_dir, fmt='parquet', workers=None):
+    """ Add new or changed sessions from DATA_DIR to the dataset.
+        Returns the number of files read.
+    """
+    os.makedirs(dataset_dir, exist_ok=True)
+    manifest = load_manifest(dataset_dir)
+    known = manifest['files']
+
+    found = find_sessions(data_dir)
+    todo = sorted(path for path, sig in found.items()
+        if path not in known or
+        (known[path]['size'], known[path]['mtime_ns']) != sig)
+    if not todo:
+        return 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(read_session, todo, chunksize=16))
+
+    part = manifest['parts'] + 1
+    file = Path(dataset_dir) / f"part-{part:05d}.{fmt}"
+    _write_part(pd.concat(frames, ignore_index=True, sort=False), file, fmt)
+
+    for path in todo:
+        size, mtime_ns = found[path]
+        known[path] = {'size': size, 'mtime_ns': mtime_ns, 'part': part}
+    manifest['parts'] = part
+    save_manifest(dataset_dir, manifest)
+    return len(todo)
+
+
+def compact(dataset_dir, fmt='parquet'):
+    """ Rewrite the dataset as a single part """
+    df = load_dataset(dataset_dir)
+    old_parts = _part_files(dataset_dir)
+    manifest = load_manifest(dataset_dir)
+    part = manifest['parts'] + 1
+    _write_part(df, Path(dataset_dir) / f"part-{part:05d}.{fmt}", fmt)
+    for info in manifest['files'].values():
+        info['part'] = part
+    manifest['parts'] = part
+    save_manifest(dataset_dir, manifest)
+    for file in old_parts.values():
+        file.unlink()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Merge Adaptive Rating session CSV files")
+    parser.add_argument('data_dir', help="folder containing session CSVs")
+    parser.add_argument('dataset_dir', help="output dataset folder")
+    parser.add_argument('--format', choices=('parquet', 'feather'),
+        default='parquet')
+    parser.add_argument('--workers', type=int, default=None,
+        help="number of worker processes (default: all cores)")
+    parser.add_argument('--compact', action='store_true',
+        help="merge all parts into one file after ingesting")
+    args = parser.parse_args(argv)
+
+    count = ingest(args.data_dir, args.dataset_dir, args.format, args.workers)
+    print(f"Ingested {count} new or changed session file(s)")
+    if args.compact:
+        compact(args.dataset_dir, args.format)
+        print("Compacted dataset into a single part")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,368 @@
+""" Persistent audio output engine for Adaptive Rating
+
+    A single long-lived sounddevice.OutputStream is kept
+    open and fed by a callback mixer. Presenting a stimulus
+    only places a command in a lock-free ring buffer, so no
+    PortAudio stream is opened or closed per trial.
+"""
+
+# Import system packages
+import threading
+from time import perf_counter, perf_counter_ns, sleep
+
+# Import data science packages
+import numpy as np
+
+
+class RingBuffer:
+    """ Fixed-size single-producer/single-consumer queue.
+
+        The producer (GUI thread) only writes the tail index
+        and the consumer (audio callback) only writes the head
+        index, so no lock is needed.
+    """
+    def __init__(self, size=64):
+        self._slots = [None] * size
+        self._size = size
+        self._head = 0
+        self._tail = 0
+
+
+    def push(self, item):
+        """ Add an item. Returns False if the buffer is full. """
+        tail = self._tail
+        nxt = (tail + 1) % self._size
+        if nxt == self._head:
+            return False
+        self._slots[tail] = item
+        self._tail = nxt
+        return True
+
+
+    def pop(self):
+        """ Remove and return the oldest item, or None """
+        head = self._head
+        if head == self._tail:
+            return None
+        item = self._slots[head]
+        self._slots[head] = None
+        self._head = (head + 1) % self._size
+        return item
+
+
+class Voice:
+    """ A buffer being mixed into the output stream. With LOOP
+        the buffer repeats until the voice is released.
+    """
+    def __init__(self, data, columns, fade_frames, loop=False, gain=1.0):
+        self.data = data
+        self.columns = columns
+        self.loop = loop
+        self.pos = 0
+        self.gain = gain
+        # Gain requested by set_gain(), reached within one block
+        self.target_gain = gain
+        self.fade_frames = fade_frames
+        # Frames left in the fade-in and fade-out ramps
+        self.fade_in = 0
+        self.fade_out = None
+        self.done = False
+        # perf_counter_ns() of the callback that first mixed this
+        # voice, and the estimated time it reaches the DAC
+        self.start_ns = None
+        self.dac_ns = None
+
+
+    def release(self, fade_frames):
+        """ Start fading out over FADE_FRAMES (0 stops at once) """
+        if fade_frames <= 0:
+            self.done = True
+        elif self.fade_out is None:
+            self.fade_frames = fade_frames
+            self.fade_out = fade_frames
+
+
+    def set_gain(self, gain):
+        """ Change the gain while playing. The callback ramps to
+            the new value over its next block (no clicks). Safe
+            to call from another thread.
+        """
+        self.target_gain = gain
+
+
+    def mix(self, outdata, frames):
+        """ Add the next block of this voice to OUTDATA """
+        if self.loop:
+            n = frames
+            idx = (self.pos + np.arange(n)) % len(self.data)
+            chunk = self.data[idx]
+        else:
+            n = min(frames, len(self.data) - self.pos)
+            if n <= 0 or self.done:
+                self.done = True
+                return
+            chunk = self.data[self.pos:self.pos + n]
+
+        # Apply the gain, ramping to a newly requested value
+        target = self.target_gain
+        if target != self.gain:
+            ramp = np.linspace(self.gain, target, n, dtype=np.float32)
+            chunk = chunk * ramp[:, np.newaxis]
+            self.gain = target
+        else:
+            chunk = chunk * np.float32(self.gain)
+
+        # Apply fade ramps
+        if self.fade_in > 0 or self.fade_out is not None:
+            idx = np.arange(n)
+            env = np.ones(n, dtype=np.float32)
+            if self.fade_in > 0:
+                done = self.fade_frames - self.fade_in
+                env *= np.minimum((done + idx) / self.fade_frames, 1.0)
+                self.fade_in = max(self.fade_in - n, 0)
+            if self.fade_out is not None:
+                env *= np.maximum((self.fade_out - idx) / self.fade_frames, 0.0)
+                self.fade_out -= n
+                if self.fade_out <= 0:
+                    self.done = True
+            chunk *= env[:, np.newaxis]
+
+        outdata[:n, self.columns] += chunk
+        if self.loop:
+            self.pos = (self.pos + n) % len(self.data)
+            return
+        self.pos += n
+        if self.pos >= len(self.data):
+            self.done = True
+
+
+class NullOutputStream:
+    """ Stand-in for sounddevice.OutputStream without audio
+        hardware. A thread calls the callback at the pace of a
+        real device, and the mixed output is discarded. Used to
+        check engine timing (see benchmarks.py booths).
+    """
+    def __init__(self, device=None, samplerate=48000, channels=2,
+        dtype='float32', blocksize=0, latency=None, callback=None):
+        self.device = device
+        self.samplerate = samplerate
+        self.channels = channels
+        self.dtype = dtype
+        # PortAudio would choose a size; use a typical one
+        self.blocksize = blocksize or 256
+        self.callback = callback
+        # Number of callbacks so far
+        self.blocks = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def _run(self):
+        outdata = np.zeros((self.blocksize, self.channels), dtype=self.dtype)
+        period = self.blocksize / self.samplerate
+        deadline = perf_counter()
+        while not self._stop.is_set():
+            self.callback(outdata, self.blocksize, None, None)
+            self.blocks += 1
+            deadline += period
+            delay = deadline - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+
+class AudioEngine:
+    """ Long-lived output stream with a callback mixer.
+
+        BLOCKSIZE: frames per callback (0 lets PortAudio choose)
+        LATENCY: 'low', 'high' or a latency in seconds
+        CROSSFADE: seconds used to fade between stimuli when a
+            new press interrupts the current one
+        STREAM_FACTORY: stream class (default: 
+            sounddevice.OutputStream)
+        CHANNELS: output channels to open (default: all of the
+            device's output channels)
+
+        Each engine only talks to its own device, so several
+        engines (e.g., one per booth) can run in one process.
+    """
+    def __init__(self, blocksize=0, latency='low', crossfade=0.01,
+        stream_factory=None, channels=None):
+        self.blocksize = blocksize
+        self.latency = latency
+        self.crossfade = crossfade
+        self.stream_factory = stream_factory
+        self.channels = channels
+
+        self.stream = None
+        self._config = None
+        self._commands = RingBuffer()
+        # Voices are only touched by the audio callback
+        self._voices = []
+
+
+    @staticmethod
+    def parse_latency(latency):
+        """ Convert a latency setting to a sounddevice argument """
+        if isinstance(latency, str) and latency.strip() in ('low', 'high'):
+            return latency.strip()
+        try:
+            return float(latency)
+        except (TypeError, ValueError):
+            return 'low'
+
+
+    def configure(self, blocksize=None, latency=None, crossfade=None):
+        """ Change stream settings. The stream is reopened on the
+            next presentation.
+        """
+        if blocksize is not None:
+            self.blocksize = blocksize
+        if latency is not None:
+            self.latency = latency
+        if crossfade is not None:
+            self.crossfade = crossfade
+        self.close()
+
+
+    def _open(self, device_id, fs):
+        """ Open (or reuse) the output stream for DEVICE_ID at FS """
+        config = (device_id, fs, self.blocksize, self.latency)
+        if self.stream is not None and self._config == config:
+            return
+        self.close()
+
+        factory, channels = self.stream_factory, self.channels
+        if factory is None or not channels:
+            # sounddevice is imported on first use (slow to load)
+            import sounddevice as sd
+            factory = factory or sd.OutputStream
+            channels = channels or \
+                sd.query_devices(device_id)['max_output_channels']
+        self.stream = factory(
+            device=device_id,
+            samplerate=fs,
+            channels=channels,
+            dtype='float32',
+            blocksize=self.blocksize,
+            latency=self.parse_latency(self.latency),
+            callback=self._callback
+        )
+        self.stream.start()
+        self._config = config
+
+
+    @staticmethod
+    def _columns(mapping, nchans):
+        """ Convert a 1-based output mapping to 0-based columns.
+            A single speaker number routes the signal channels
+            to consecutive outputs starting at that speaker.
+        """
+        if np.ndim(mapping) == 0:
+            return [int(mapping) - 1 + ii for ii in range(nchans)]
+        columns = [int(x) - 1 for x in mapping]
+        if len(columns) != nchans:
+            raise ValueError("Mapping does not match number of channels")
+        return columns
+
+
+    def play(self, sig, fs, device_id, mapping, loop=False, gain=1.0):
+        """ Queue SIG for playback. A stimulus that is already
+            playing is crossfaded out. With LOOP, SIG repeats until
+            stop() (e.g., for calibration); GAIN can then be 
+            changed live with Voice.set_gain. Returns the new 
+            Voice. Raises ValueError for an empty SIG.
+        """
+        data = np.asarray(sig, dtype=np.float32)
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        # A looping voice with no samples would fail in the callback
+        if len(data) == 0:
+            raise ValueError("Empty signal: nothing to play")
+        self._open(device_id, fs)
+        columns = self._columns(mapping, data.shape[1])
+        if max(columns) >= self.stream.channels or min(columns) < 0:
+            raise ValueError("Speaker number exceeds device output channels")
+
+        voice = Voice(data, columns, int(self.crossfade * fs), loop, gain)
+        if not self._commands.push(('play', voice)):
+            raise RuntimeError("Audio engine command buffer is full")
+        return voice
+
+
+    def stop(self, fade=False):
+        """ Stop all playback. With FADE, use a crossfade-length
+            ramp instead of stopping at once.
+        """
+        if self.stream is None:
+            return
+        self._commands.push(('stop', fade))
+
+
+    def close(self):
+        """ Stop and close the output stream """
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = None
+        self._config = None
+        self._voices = []
+        while self._commands.pop() is not None:
+            pass
+
+
+    def _callback(self, outdata, frames, time, status):
+        """ Mix all active voices into the output block """
+        outdata.fill(0)
+
+        # Apply pending commands
+        while True:
+            command = self._commands.pop()
+            if command is None:
+                break
+            action, arg = command
+            if action == 'play':
+                # Crossfade only when interrupting another stimulus
+                if self._voices:
+                    arg.fade_in = arg.fade_frames
+                for voice in self._voices:
+                    voice.release(arg.fade_frames)
+                self._voices.append(arg)
+            elif action == 'stop':
+                fade = int(self.crossfade * self.stream.samplerate) if arg else 0
+                for voice in self._voices:
+                    voice.release(fade)
+
+        # Timestamp voices starting in this block
+        for voice in self._voices:
+            if voice.start_ns is None:
+                self._stamp(voice, time)
+
+        for voice in self._voices:
+            voice.mix(outdata, frames)
+        self._voices = [x for x in self._voices if not x.done]
+
+
+    @staticmethod
+    def _stamp(voice, time):
+        """ Record when VOICE is first mixed and when its first 
+            sample is expected at the DAC, using the stream 
+            clock times passed to the callback.
+        """
+        voice.start_ns = perf_counter_ns()
+        # Some host APIs do not report stream times
+        if time is None or not time.currentTime:
+            ahead = 0
+        else:
+            ahead = time.outputBufferDacTime - time.currentTime
+        voice.dac_ns = voice.start_ns + int(max(ahead, 0) * 1e9)
@@ -0,0 +1,571 @@
+""" Benchmarks for Adaptive Rating
+
+    Usage:
+        python benchmarks.py level [--seconds 60] [--channels 8]
+        python benchmarks.py track [--trials 1000000]
+        python benchmarks.py bayes [--grid 10000]
+        python benchmarks.py stimuli [--files 100000]
+        python benchmarks.py index [--files 20000] [--budget-ms 50]
+        python benchmarks.py booths [--booths 4] [--budget-ms 20]
+        python benchmarks.py startup [--budget 2.0] [--top 15]
+        python benchmarks.py tracing [--calls 1000000]
+        python benchmarks.py settings [--presses 1000]
+        python benchmarks.py storage [--records 10000]
+"""
+
+# Import system packages
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+
+# Import data science packages
+import numpy as np
+from scipy.io import wavfile
+
+# Import custom modules
+import tracing
+import models as m
+from audioengine import NullOutputStream
+from booth import Booth, booth_sessionpars
+from track import AdaptiveTrack, BayesianTrack, STEP_SIZES
+
+
+def _best_of(func, repeats):
+    """ Fastest wall time (s) of REPEATS calls to FUNC """
+    best = np.inf
+    for _ in range(repeats):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def bench_level(seconds=60, channels=8, fs=48000, repeats=5):
+    """ Compare Audio.setRMS (one call per channel, as
+        Audio.play used it) with the vectorized apply_level on a
+        long multichannel signal
+    """
+    rng = np.random.default_rng(0)
+    sig = rng.standard_normal((int(seconds * fs), channels)) * 0.1
+    # Give each channel a different level
+    sig *= np.linspace(0.5, 2, channels)
+    audio = m.Audio.__new__(m.Audio)
+
+    def old():
+        return np.array([audio.setRMS(sig[:, ii], -30)
+            for ii in range(channels)]).T
+
+    def new():
+        return m.apply_level(sig, -30)
+
+    rms = m.channel_rms(sig)
+    def new_cached_rms():
+        return m.apply_level(sig, -30, rms=rms)
+
+    # Results must match
+    assert np.allclose(old(), new(), rtol=1e-4, atol=1e-6)
+
+    results = {
+        'setRMS per channel (float64)': _best_of(old, repeats),
+        'apply_level (float32)': _best_of(new, repeats),
+        'apply_level, precomputed RMS': _best_of(new_cached_rms, repeats)
+    }
+    print(f"Level engine: {seconds} s, {channels} channels, {fs} Hz")
+    base = results['setRMS per channel (float64)']
+    for name, secs in results.items():
+        print(f"  {name:32s} {secs*1000:8.1f} ms  ({base/secs:4.1f}x)")
+    return results
+
+
+def bench_track(trials=1000000, n_files=200, presses=8):
+    """ Simulated trials per second through AdaptiveTrack, with
+        PRESSES random button presses per trial
+    """
+    rng = random.Random(0)
+    track = AdaptiveTrack(list(range(n_files)), rng=rng)
+    buttons = [rng.choice(list(STEP_SIZES)) for _ in range(4096)]
+    press = track.press
+    submit = track.submit
+
+    start = perf_counter()
+    ii = 0
+    for _ in range(trials):
+        for _ in range(presses):
+            press(buttons[ii & 4095])
+            ii += 1
+        submit()
+    secs = perf_counter() - start
+    print(f"Adaptive track: {trials / secs:,.0f} trials/s, " +
+        f"{trials * presses / secs:,.0f} presses/s")
+    return trials / secs
+
+
+def bench_stimuli(n_files=100000, lookups=100000):
+    """ Per-press lookup time and memory of the stimulus table
+        compared with the pandas DataFrame used before
+    """
+    import pandas as pd
+    rng = np.random.default_rng(0)
+    parameters = rng.permutation(n_files)
+    paths = [f"/data/stimuli/noise_{x}.wav" for x in parameters]
+    rms = [np.full(2, 0.1) for _ in range(n_files)]
+
+    table = m.StimulusTable(paths, parameters, rms)
+    frame = pd.DataFrame({'Audio List': paths, 'Parameter': parameters,
+        'RMS': rms}).sort_values(by='Parameter').reset_index(drop=True)
+    indices = rng.integers(0, n_files, lookups).tolist()
+
+    def old():
+        for idx in indices:
+            frame["Audio List"].iloc[idx]
+
+    def new():
+        for idx in indices:
+            table.path(idx)
+
+    def search():
+        for idx in indices:
+            table.find(idx)
+
+    table_bytes = (table.parameters.nbytes + table.paths.nbytes +
+        table._rms.nbytes + table._rms_offsets.nbytes +
+        sum(sys.getsizeof(x) for x in table.paths))
+    frame_bytes = int(frame.memory_usage(deep=True).sum())
+    print(f"Stimulus list: {n_files} files")
+    print(f"  DataFrame .iloc lookup {_best_of(old, 3) / lookups * 1e9:8.0f} ns" +
+        f"   memory {frame_bytes / 1024**2:6.1f} MB")
+    print(f"  StimulusTable.path     {_best_of(new, 3) / lookups * 1e9:8.0f} ns" +
+        f"   memory {table_bytes / 1024**2:6.1f} MB")
+    print(f"  StimulusTable.find     {_best_of(search, 3) / lookups * 1e9:8.0f} ns")
+
+
+def bench_index(n_files=20000, budget_ms=50.0, repeats=5):
+    """ Opening a stimulus directory of N_FILES files (AudioList)
+        with a current index. Returns False if the fastest of
+        REPEATS warm opens exceeds BUDGET_MS.
+    """
+    sig = (np.random.default_rng(0).standard_normal((64, 2)) * 0.1
+        ).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmp:
+        for ii in range(n_files):
+            wavfile.write(os.path.join(tmp, f"noise_{ii}.wav"), 48000, sig)
+        sessionpars = booth_sessionpars(Audio_Files_Path=tmp)
+
+        start = perf_counter()
+        m.AudioList(sessionpars, cache=m.StimulusCache())
+        cold = perf_counter() - start
+        warm = _best_of(lambda: m.AudioList(sessionpars, 
+            cache=m.StimulusCache()), repeats)
+
+    ok = warm * 1000 <= budget_ms
+    print(f"Stimulus directory: {n_files} files")
+    print(f"  cold open (index built)  {cold:8.3f} s")
+    print(f"  warm open                {warm * 1000:8.1f} ms " +
+        f"({'ok' if ok else 'over'} budget of {budget_ms} ms)")
+    return ok
+
+
+def bench_bayes(grid=10000, n_files=1000, updates=2000, budget_ms=1.0,
+    candidates_ms=20.0, presses=200):
+    """ Per-press work of BayesianTrack: press() plus taking the
+        candidates snapshot on the GUI thread, and candidates() 
+        on the prefetch thread. Returns False if the GUI thread
+        part exceeds BUDGET_MS or candidates() CANDIDATES_MS
+        (mean per press).
+    """
+    rng = random.Random(0)
+    track = BayesianTrack(list(range(n_files)), grid_size=grid, rng=rng)
+    buttons = [rng.choice(track.BUTTONS) for _ in range(updates)]
+
+    def updates_only():
+        for button in buttons:
+            track.update(track.index, button)
+    update_ms = _best_of(updates_only, 3) / updates * 1000
+
+    # Restart every 10 presses, like a rating
+    gui_ms = background_ms = np.inf
+    for _ in range(3):
+        gui = background = 0
+        for ii, button in enumerate(buttons[:presses]):
+            if ii % 10 == 0:
+                track.restart()
+            start = perf_counter()
+            track.press(button)
+            candidates = track.deferred_candidates()
+            middle = perf_counter()
+            candidates()
+            gui += middle - start
+            background += perf_counter() - middle
+        gui_ms = min(gui_ms, gui / presses * 1000)
+        background_ms = min(background_ms, background / presses * 1000)
+
+    ok = gui_ms < budget_ms and background_ms < candidates_ms
+    print(f"Bayesian track: {grid} grid points, {n_files} stimuli")
+    print(f"  posterior update       {update_ms:8.3f} ms")
+    print(f"  press (GUI thread)     {gui_ms:8.3f} ms " +
+        f"(budget {budget_ms} ms)")
+    print(f"  candidates (prefetch)  {background_ms:8.3f} ms " +
+        f"(budget {candidates_ms} ms)")
+    print(f"  {'ok' if ok else 'OVER BUDGET'}")
+    return ok
+
+
+def bench_tracing(calls=1000000, budget_ns=1000):
+    """ Cost of disabled and enabled tracing calls, ring buffer
+        bound and Chrome export. Returns False if a disabled call
+        costs more than BUDGET_NS or the export is not valid.
+    """
+    trace = tracing.get_tracer('benchmark')
+    counter = 17
+    filename = '/path/to/stimulus_3.wav'
+
+    def disabled_message():
+        for _ in range(calls):
+            trace.debug("App_237: Playing record #: %s", counter)
+
+    def disabled_span():
+        for _ in range(calls):
+            with trace.span('present', record=counter):
+                pass
+
+    def printed():
+        for _ in range(calls // 100):
+            print(f"App_237: Playing record #: {counter}")
+            print(f"App_239: Record name: {filename}")
+
+    def enabled_span():
+        for _ in range(calls // 10):
+            with trace.span('present', record=counter):
+                pass
+
+    tracing.configure(benchmark='off')
+    message_ns = _best_of(disabled_message, 3) / calls * 1e9
+    span_ns = _best_of(disabled_span, 3) / calls * 1e9
+    with contextlib.redirect_stdout(io.StringIO()):
+        print_ns = _best_of(printed, 3) / (calls // 100) * 1e9
+    tracing.configure(benchmark='debug')
+    tracing.clear()
+    enabled_ns = _best_of(enabled_span, 3) / (calls // 10) * 1e9
+    bounded = len(tracing.events) <= tracing.BUFFER_SIZE
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'trace.json')
+        count = tracing.export_chrome(path, clear_events=True)
+        with open(path, 'r') as fh:
+            events = json.load(fh)['traceEvents']
+    valid = count == len(events) and all(x['ph'] == 'X' and 'dur' in x
+        for x in events)
+    tracing.configure(benchmark='warning')
+
+    ok = max(message_ns, span_ns) < budget_ns and bounded and valid
+    print(f"Tracing: {calls} calls")
+    print(f"  disabled message   {message_ns:8.1f} ns")
+    print(f"  disabled span      {span_ns:8.1f} ns " +
+        f"({'ok' if ok else 'over'} budget of {budget_ns} ns)")
+    print(f"  enabled span       {enabled_ns:8.1f} ns")
+    print(f"  two prints (old)   {print_ns:8.1f} ns (to a buffer)")
+    print(f"  ring buffer        {count} events kept " +
+        f"(max {tracing.BUFFER_SIZE}), export " +
+        f"{'valid' if valid else 'INVALID'}")
+    return ok
+
+
+def bench_settings(presses=1000):
+    """ Settings writes per arrow press: the old save (every 
+        field, one JSON rewrite per field) vs. the debounced
+        store. Returns False if the store writes more than once
+        for PRESSES presses.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        filepath = os.path.join(tmp, 'pars.json')
+        model = m.SessionParsModel(filepath=filepath, save_delay=60)
+        # Values as the tk Variables return them
+        types = {'bool': bool, 'str': str, 'int': int, 'float': float}
+        values = {key: types[field['type']](field['value']) for key, field 
+            in model.fields.items()}
+
+        def old():
+            for _ in range(presses):
+                for key in values:
+                    with open(filepath, 'w') as fh:
+                        json.dump(model.fields, fh)
+
+        def new():
+            for ii in range(presses):
+                # Level changes on the first press only
+                for key, value in values.items():
+                    model.set(key, value)
+                model.save()
+
+        old_s = _best_of(old, 1)
+        values['Adjusted Presentation Level'] = -42.0
+        new_s = _best_of(new, 1)
+        model.flush()
+        writes = model.writes
+        new_s = min(new_s, _best_of(new, 2))
+
+    ok = writes == 1
+    print(f"Settings: {presses} presses, {len(values)} fields")
+    print(f"  old  {old_s / presses * 1e6:10.1f} us/press " +
+        f"({presses * len(values)} file writes)")
+    print(f"  new  {new_s / presses * 1e6:10.1f} us/press " +
+        f"({writes} file write{'s' if writes != 1 else ''}, " +
+        f"{'ok' if ok else 'expected 1'})")
+    return ok
+
+
+def bench_storage(records=10000):
+    """ File size and save_record time of CSVModel vs. 
+        NormalizedCSVModel. Returns False if load_normalized does
+        not give back the wide form.
+    """
+    import pandas as pd
+    sessionpars = booth_sessionpars(Subject='101')
+    rows = [{'Rating': ii % 100, 'Button ID': 'smallup', 
+        'Audio Filename': f"/stimuli/noise_{ii % 200}.wav"} 
+        for ii in range(records)]
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        for model_class in (m.CSVModel, m.NormalizedCSVModel):
+            model = model_class(sessionpars, directory=tmp)
+            start = perf_counter()
+            for row in rows:
+                model.save_record(row)
+            elapsed = perf_counter() - start
+            model.close()
+            files = [x for x in os.listdir(tmp) if x.startswith(
+                model.datestamp) and (x.endswith('_trials.csv') or 
+                x.endswith('_session.json')) == 
+                (model_class is m.NormalizedCSVModel)]
+            size = sum(os.path.getsize(os.path.join(tmp, x)) for x in files)
+            results[model_class.__name__] = (elapsed, size, model.file)
+
+        wide = pd.read_csv(results['CSVModel'][2])
+        joined = m.load_normalized(results['NormalizedCSVModel'][2])
+        try:
+            pd.testing.assert_frame_equal(wide, joined)
+            ok = True
+        except AssertionError:
+            ok = False
+
+    print(f"Storage: {records} records")
+    for name, (elapsed, size, _) in results.items():
+        print(f"  {name:<20}{elapsed / records * 1e6:8.1f} us/record " +
+            f"{size / 1024:10.1f} KiB")
+    print(f"  re-joined form {'matches' if ok else 'DIFFERS FROM'} " +
+        "the wide file")
+    return ok
+
+
+def bench_booths(n_booths=4, presses=100, budget_ms=20.0, blocksize=256,
+    fs=48000, n_files=40):
+    """ Run N_BOOTHS booth sessions at once, each pressing 
+        buttons on its own thread and playing on its own 
+        (simulated) output stream. Returns False if the 95th
+        percentile press-to-callback latency of any booth 
+        exceeds BUDGET_MS.
+    """
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        stim_dir = os.path.join(tmp, 'stimuli')
+        os.mkdir(stim_dir)
+        for ii in range(n_files):
+            sig = rng.standard_normal((fs // 2, 2)) * 0.1
+            wavfile.write(os.path.join(stim_dir, f"noise_{ii}.wav"), fs,
+                sig.astype(np.float32))
+
+        booths = [Booth(f"Booth {ii + 1}", booth_sessionpars(
+                Subject=f"{ii + 1}", Audio_Files_Path=stim_dir,
+                Audio_Device_ID=ii, Block_Size=blocksize),
+            data_dir=tmp, stream_factory=NullOutputStream, channels=2)
+            for ii in range(n_booths)]
+        for booth in booths:
+            booth.load_stimuli()
+
+        def participant(booth, seed):
+            rand = random.Random(seed)
+            for ii in range(presses):
+                if ii % 8 == 7:
+                    booth.submit()
+                booth.press(rand.choice(list(STEP_SIZES)))
+                sleep(rand.uniform(0.02, 0.08))
+
+        threads = [threading.Thread(target=participant, args=(b, ii))
+            for ii, b in enumerate(booths)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sleep(0.1)
+        for booth in booths:
+            booth.close()
+
+    ok = True
+    print(f"{n_booths} booths, {presses} presses each, blocksize " +
+        f"{blocksize} ({blocksize / fs * 1000:.1f} ms)")
+    for booth in booths:
+        booth.latency.finish()
+        stats = booth.latency.summary()['callback']
+        over = stats['p95'] > budget_ms
+        ok &= not over
+        print(f"  {booth.name}: press to callback median " +
+            f"{stats['median']:.1f} ms, p95 {stats['p95']:.1f} ms, " +
+            f"max {stats['max']:.1f} ms " +
+            f"({'over' if over else 'ok'} budget of {budget_ms} ms)")
+    return ok
+
+
+def import_profile(module='adaptive_rating', top=15):
+    """ Run 'python -X importtime' on MODULE and print the 
+        packages with the longest cumulative import times
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+        f"import {module}"], cwd=here, capture_output=True, text=True)
+    # Lines read "import time: self [us] | cumulative | name"
+    packages = dict()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if '.' not in name:
+            packages[name] = max(packages.get(name, 0), int(cumulative))
+    if proc.returncode:
+        print(proc.stderr.splitlines()[-1])
+
+    print(f"Slowest imports of {module} (cumulative):")
+    for name, us in sorted(packages.items(), key=lambda x: -x[1])[:top]:
+        print(f"  {name:24s} {us / 1000:8.1f} ms")
+    return packages
+
+
+def _no_display(stderr):
+    """ True if STDERR shows that Tk could not open a display """
+    return 'TclError' in stderr and ('no display' in stderr or 
+        "couldn't connect to display" in stderr)
+
+
+def bench_startup(budget=2.0, runs=3, top=15):
+    """ Cold start time of adaptive_rating.py until its first
+        window is shown (import time only when there is no 
+        display). Returns False if the app fails to start or the
+        median exceeds BUDGET seconds.
+    """
+    import_profile(top=top)
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, ADAPTIVE_RATING_STARTUP_CHECK='1')
+
+    times = []
+    what = "first window"
+    for _ in range(runs):
+        start = perf_counter()
+        proc = subprocess.run([sys.executable, 'adaptive_rating.py'], 
+            cwd=here, env=env, capture_output=True, text=True)
+        if proc.returncode and _no_display(proc.stderr):
+            # No display: time the imports
+            what = "import (no window)"
+            start = perf_counter()
+            proc = subprocess.run([sys.executable, '-c', 
+                'import adaptive_rating'], cwd=here, capture_output=True,
+                text=True)
+        if proc.returncode:
+            print(f"Startup failed (exit code {proc.returncode}):")
+            print(proc.stderr)
+            return False
+        times.append(perf_counter() - start)
+
+    median = float(np.median(times))
+    ok = median <= budget
+    print(f"Cold start to {what}: " + 
+        ", ".join(f"{x:.2f}" for x in times) + 
+        f" s (median {median:.2f} s, {'ok' if ok else 'over'} " +
+        f"budget of {budget} s)")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    level = sub.add_parser('level', help="level engine vs. Audio.setRMS")
+    level.add_argument('--seconds', type=float, default=60)
+    level.add_argument('--channels', type=int, default=8)
+    level.add_argument('--repeats', type=int, default=5)
+
+    track = sub.add_parser('track', help="headless adaptive track")
+    track.add_argument('--trials', type=int, default=1000000)
+    track.add_argument('--presses', type=int, default=8)
+
+    stimuli = sub.add_parser('stimuli', help="stimulus table vs. DataFrame")
+    stimuli.add_argument('--files', type=int, default=100000)
+
+    index = sub.add_parser('index', help="stimulus directory open time")
+    index.add_argument('--files', type=int, default=20000)
+    index.add_argument('--budget-ms', type=float, default=50.0)
+
+    bayes = sub.add_parser('bayes', help="Bayesian track update time")
+    bayes.add_argument('--grid', type=int, default=10000)
+    bayes.add_argument('--budget-ms', type=float, default=1.0,
+        help="press() on the GUI thread")
+    bayes.add_argument('--candidates-ms', type=float, default=20.0,
+        help="candidates() on the prefetch thread")
+
+    booths = sub.add_parser('booths', 
+        help="latency of simultaneous booth sessions")
+    booths.add_argument('--booths', type=int, default=4)
+    booths.add_argument('--presses', type=int, default=100)
+    booths.add_argument('--budget-ms', type=float, default=20.0)
+
+    startup = sub.add_parser('startup', help="import profile and cold start")
+    startup.add_argument('--budget', type=float, default=2.0,
+        help="maximum median start time (s)")
+    startup.add_argument('--runs', type=int, default=3)
+    startup.add_argument('--top', type=int, default=15)
+
+    tracer = sub.add_parser('tracing', help="tracing overhead and export")
+    tracer.add_argument('--calls', type=int, default=1000000)
+
+    settings = sub.add_parser('settings', help="settings writes per press")
+    settings.add_argument('--presses', type=int, default=1000)
+
+    storage = sub.add_parser('storage', help="wide vs. normalized CSV")
+    storage.add_argument('--records', type=int, default=10000)
+
+    args = parser.parse_args(argv)
+    if args.bench == 'level':
+        bench_level(args.seconds, args.channels, repeats=args.repeats)
+    elif args.bench == 'track':
+        bench_track(args.trials, presses=args.presses)
+    elif args.bench == 'stimuli':
+        bench_stimuli(args.files)
+    elif args.bench == 'index':
+        return 0 if bench_index(args.files, args.budget_ms) else 1
+    elif args.bench == 'bayes':
+        return 0 if bench_bayes(args.grid, budget_ms=args.budget_ms,
+            candidates_ms=args.candidates_ms) else 1
+    elif args.bench == 'startup':
+        return 0 if bench_startup(args.budget, args.runs, args.top) else 1
+    elif args.bench == 'tracing':
+        return 0 if bench_tracing(args.calls) else 1
+    elif args.bench == 'settings':
+        return 0 if bench_settings(args.presses) else 1
+    elif args.bench == 'storage':
+        return 0 if bench_storage(args.records) else 1
+    elif args.bench == 'booths':
+        return 0 if bench_booths(args.booths, args.presses, 
+            args.budget_ms) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
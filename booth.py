@@ -0,0 +1,387 @@
+""" Per-booth sessions for Adaptive Rating
+
+    A Booth is one participant in one sound booth: its own
+    session parameters (subject, output device, speaker mapping,
+    calibration, stimulus directory), stimulus cache, prefetcher,
+    audio stream, adaptive track and data file. Nothing is shared
+    through module globals such as sd.default.device, so one
+    process can drive several booths at once (see multibooth.py).
+    The single-booth GUI (adaptive_rating.Application) runs one
+    Booth as well.
+
+    Booth methods are meant to be called from one thread per
+    booth (e.g., the Tk main loop); different booths do not
+    share any state.
+"""
+
+# Import system packages
+import copy
+import os
+import threading
+
+# Import custom modules
+import tracing
+import models as m
+from audioengine import AudioEngine
+from latency import LatencyTracker
+from render import RenderedSet
+from track import AdaptiveTrack, TRACKS
+
+
+trace = tracing.get_tracer('booth')
+
+
+class Var:
+    """ Plain stand-in for a tk Variable (get/set), so session
+        parameters can be used without a Tk root or from other
+        threads
+    """
+    def __init__(self, value=None):
+        self._value = value
+
+
+    def get(self):
+        return self._value
+
+
+    def set(self, value):
+        self._value = value
+
+
+def booth_sessionpars(**values):
+    """ Session parameters dictionary (as used by the models)
+        with the defaults of models.SessionParsModel and the
+        given VALUES. Keys use underscores for spaces, e.g.
+        booth_sessionpars(Audio_Device_ID=3, Subject='101').
+    """
+    fields = copy.deepcopy(m.SessionParsModel.fields)
+    sessionpars = {key: Var(field['value']) for key, field in fields.items()}
+    for key, value in values.items():
+        key = key.replace('_', ' ')
+        if key not in sessionpars:
+            raise KeyError(f"Unknown session parameter: {key}")
+        sessionpars[key].set(value)
+    return sessionpars
+
+
+def data_model_class(data_format):
+    """ Storage model class for a 'Data Format' setting """
+    if data_format == 'sqlite':
+        return m.SQLiteModel
+    if data_format == 'csv (normalized)':
+        return m.NormalizedCSVModel
+    return m.CSVModel
+
+
+class Booth:
+    """ One participant session on one output device.
+
+        NAME: label used in messages
+        SESSIONPARS: dictionary of session parameters (tk
+            Variables or booth.Var objects)
+        CACHE: stimulus cache to use (default: a new cache of
+            CACHE_BYTES)
+        DATA_DIR: folder for this booth's data files
+        DEVICES: devices.DeviceInventory giving the output
+            device's sample rate (without one, or before its
+            first scan, stimuli are played at their own rate)
+        STREAM_FACTORY, CHANNELS: passed to AudioEngine
+
+        Call load_stimuli() before the first press.
+    """
+    def __init__(self, name, sessionpars, cache=None,
+        cache_bytes=64 * 1024**2, data_dir='.', stream_factory=None,
+        channels=None, devices=None):
+        self.name = name
+        self.sessionpars = sessionpars
+        self.data_dir = data_dir
+        self.devices = devices
+
+        self.cache = cache or m.StimulusCache(cache_bytes)
+        self.prefetcher = m.Prefetcher(self.cache)
+        self.engine = AudioEngine(
+            blocksize=sessionpars['Block Size'].get(),
+            latency=sessionpars['Output Latency'].get(),
+            stream_factory=stream_factory,
+            channels=channels)
+        # Press-to-sound timing for every presentation
+        self.latency = LatencyTracker()
+        self.model = self.make_data_model()
+
+        self.filename = None
+        self.audiolist_model = None
+        self.stimuli = m.StimulusTable([], [], [])
+        self.track = self._track_class()([])
+
+        # Pre-rendered stimulus set for the current calibration
+        self._rendered_key = None
+        self.calc_level()
+        self.load_rendered()
+
+
+    @property
+    def level(self):
+        return self.sessionpars['Adjusted Presentation Level'].get()
+
+
+    def calc_level(self):
+        """ Adjusted Presentation Level from this booth's
+            calibration
+        """
+        slm_offset = (self.sessionpars['SLM Reading'].get() -
+            self.sessionpars['Raw Level'].get())
+        trace.debug("SLM offset: %s", slm_offset)
+        level = self.sessionpars['Presentation Level'].get() - slm_offset
+        trace.debug("Calculated level from calc_level: %s", level)
+        if level != self.level:
+            self.sessionpars['Adjusted Presentation Level'].set(level)
+        return level
+
+
+    def make_data_model(self):
+        """ Storage model for this booth's 'Data Format' """
+        model = data_model_class(self.sessionpars['Data Format'].get())
+        if model is m.SQLiteModel:
+            return model(self.sessionpars,
+                db_path=os.path.join(self.data_dir, 'adaptive_rating.db'))
+        return model(self.sessionpars, directory=self.data_dir)
+
+
+    def set_data_format(self):
+        """ Switch the storage model if 'Data Format' changed.
+            Returns True if it did.
+        """
+        if isinstance(self.model, data_model_class(
+            self.sessionpars['Data Format'].get())):
+            return False
+        self.model.close()
+        self.model = self.make_data_model()
+        return True
+
+
+    def _track_class(self):
+        """ Track class for the selected Track Mode """
+        return TRACKS.get(self.sessionpars['Track Mode'].get(), AdaptiveTrack)
+
+
+    def set_track_mode(self):
+        """ Switch the track if 'Track Mode' changed, keeping the
+            current stimulus
+        """
+        if isinstance(self.track, self._track_class()):
+            return
+        index = self.track.index
+        self.track = self._track_class()(self.track.parameters)
+        if index < len(self.track.parameters):
+            self.track.index = index
+        self.prefetch_neighbours()
+
+
+    def device_samplerate(self):
+        """ Default sample rate of the output device from the
+            device inventory (never queries PortAudio), or 0 if
+            it is not known
+        """
+        if self.devices is None:
+            return 0
+        device = self.devices.find(self.sessionpars['Audio Device ID'].get())
+        if device is None:
+            return 0
+        return int(device['default_samplerate'])
+
+
+    def load_rendered(self):
+        """ Use the pre-rendered stimulus set (see render.py) for
+            this booth's directory and calibration, if any. Call
+            again when the device inventory has been scanned.
+        """
+        # Stimuli are played at the device's native rate
+        key = (self.sessionpars['Audio Files Path'].get(), self.level,
+            self.device_samplerate())
+        if key == self._rendered_key:
+            return
+        self._rendered_key = key
+        self.cache.rendered = None
+        if not os.path.isdir(key[0]):
+            return
+        samplerate = key[2]
+        self.cache.samplerate = samplerate
+        self.cache.rendered = RenderedSet.find(key[0], key[1], samplerate)
+        if self.cache.rendered is not None:
+            trace.info("App_140: Using pre-rendered stimuli from %s",
+                self.cache.rendered.directory)
+        self.harmonise()
+
+
+    def harmonise(self):
+        """ Resample stimuli that are not at the device rate on
+            background threads, so presentation does not have to
+        """
+        if self.audiolist_model is None:
+            return
+        # Leave room in the cache for scaled buffers
+        paths = self.audiolist_model.off_rate(self.cache.samplerate,
+            self.cache.max_bytes // 2)
+        if not paths:
+            return
+        trace.info("App_160: Resampling %d file(s) to %s Hz",
+            len(paths), self.cache.samplerate)
+        threading.Thread(target=self.cache.harmonise, args=(paths,),
+            daemon=True).start()
+
+
+    def load_stimuli(self):
+        """ Read the stimulus list of 'Audio Files Path' and
+            restart the track. Returns False if there are no
+            audio files.
+        """
+        self.audiolist_model = m.AudioList(self.sessionpars,
+            cache=self.cache)
+        try:
+            self.stimuli = self.audiolist_model.table
+        except AttributeError:
+            trace.warning("App_197: Problem creating list of audio files...")
+            self.stimuli = m.StimulusTable([], [], [])
+            return False
+        if len(self.stimuli) == 0:
+            trace.warning("App_204: No audio files in list!")
+            return False
+        trace.info("App_200: Loaded audio files from AudioList model into " +
+            "runtime environment")
+        self.track.set_parameters(self.stimuli.parameters, 0)
+        self.track.restart()
+        trace.info("App_145: Starting record number: %s", self.track.index)
+        self.prefetch_neighbours(include_current=True)
+        self.harmonise()
+        return True
+
+
+    def rescan(self):
+        """ Rescan the stimulus directory (safe to call from a
+            watcher thread). Pass the result to apply_changes().
+        """
+        return self.audiolist_model.rescan()
+
+
+    def apply_changes(self, changes):
+        """ Update the stimulus list after a rescan, keeping the
+            track on the same parameter value
+        """
+        index = self.track.index
+        value = self.stimuli.parameters[index] if len(self.stimuli) else None
+
+        stale = self.audiolist_model.apply(changes)
+        self.prefetcher.invalidate(stale)
+        self.stimuli = self.audiolist_model.table
+        trace.info("App_262: Audio list updated: %d added, " +
+            "%d removed, %d changed", *map(len, changes[:3]))
+
+        # Same value, or the nearest remaining value if it was removed
+        found = self.stimuli.find(value) if value is not None else None
+        self.track.set_parameters(self.stimuli.parameters,
+            index if found is None else found)
+        self.prefetch_neighbours(include_current=True)
+        self.harmonise()
+
+
+    def move(self, button_id, press_ns=None):
+        """ Start timing a press and move the track with an arrow
+            button (without presenting). Returns the new index.
+        """
+        self.latency.begin(press_ns)
+        self.latency.mark('get_audio')
+        with trace.span('press', booth=self.name, button=button_id):
+            index = self.track.press(button_id)
+        if self.track.limit:
+            trace.info("App_241: Limit reached!")
+        return index
+
+
+    def press(self, button_id, press_ns=None):
+        """ Move the track with an arrow button and present the
+            new stimulus. Returns the playing Voice.
+        """
+        self.move(button_id, press_ns)
+        return self.present()
+
+
+    def repeat(self, press_ns=None):
+        """ Present the current stimulus again """
+        self.latency.begin(press_ns)
+        return self.present()
+
+
+    def present(self):
+        """ Present the current stimulus on this booth's device """
+        with trace.span('present', booth=self.name,
+            record=self.track.index) as span:
+            self.latency.mark('present')
+            trace.debug("App_237: Playing record #: %s", self.track.index)
+            self.filename = self.stimuli.path(self.track.index)
+            trace.debug("App_239: Record name: %s", self.filename)
+            trace.debug("Adjusted presentation level: %s", self.level)
+            audio_obj = self.prefetcher.take(self.filename, self.level)
+            span.set(prefetched=audio_obj is not None)
+            if audio_obj is None:
+                audio_obj = self.load_audio(self.filename, self.level)
+            self.latency.mark('decoded')
+
+            voice = audio_obj.play(
+                device_id=self.sessionpars['Audio Device ID'].get(),
+                channels=self.sessionpars['Speaker Number'].get(),
+                engine=self.engine)
+            self.latency.mark('enqueued')
+            self.latency.attach(voice)
+        # Load the files the next press can lead to
+        self.prefetch_neighbours()
+        return voice
+
+
+    def load_audio(self, file_path, level):
+        """ Audio object for a stimulus that was not prefetched """
+        return m.Audio(file_path, level, cache=self.cache)
+
+
+    def prefetch_neighbours(self, include_current=False):
+        """ Prefetch every file reachable with one button press """
+        if len(self.stimuli) == 0:
+            return
+        # Candidates are chosen on the prefetch thread
+        stimuli = self.stimuli
+        candidates = self.track.deferred_candidates()
+        current = [stimuli.path(self.track.index)] if include_current else []
+        self.prefetcher.schedule(current, self.level,
+            more=lambda: [stimuli.path(x) for x in candidates()])
+
+
+    def submit(self, data=None):
+        """ Save a rating with the current stimulus and start the
+            next one. DATA holds extra record fields. Returns the
+            track record.
+        """
+        data = dict(data or {})
+        data['Audio Filename'] = self.filename
+        # Add press-to-sound latency of the last presentation
+        if self.sessionpars['Record Latency'].get():
+            data.update(self.latency.columns())
+        # Finish the rating and choose a new starting index
+        record = self.track.submit()
+        # Add the posterior estimate in Bayesian mode
+        if 'Estimate' in record:
+            data['Bayes Estimate'] = record['Estimate']
+            data['Bayes Estimate SD'] = record['Estimate SD']
+            data['Bayes Start Index'] = record['Start Index']
+        with trace.span('submit', booth=self.name, record=record['Index']):
+            self.model.save_record(data)
+        self.prefetch_neighbours(include_current=True)
+        return record
+
+
+    def close(self):
+        """ Flush data and release the audio stream """
+        self.engine.stop()
+        try:
+            self.model.close()
+        finally:
+            self.prefetcher.close()
+            self.engine.close()
@@ -0,0 +1,168 @@
+""" Audio device inventory for Adaptive Rating
+
+    DeviceInventory keeps the list of output devices reported by
+    sounddevice (PortAudio), refreshed on a background thread so
+    dialogs can show it without waiting. Each device is probed
+    once for its supported sample rates; probe results are kept
+    in ~/.adaptive_rating/devices.json (keyed by host API, name
+    and channel count, since device IDs can change between
+    runs), so later sessions skip the probe.
+"""
+
+# Import system packages
+import json
+import os
+import threading
+from pathlib import Path
+
+# Import custom modules
+import tracing
+
+
+CACHE_FILE = Path.home() / '.adaptive_rating' / 'devices.json'
+# Sample rates checked by the probe
+PROBE_RATES = (22050, 44100, 48000, 88200, 96000, 192000)
+
+trace = tracing.get_tracer('devices')
+
+
+class DeviceInventory:
+    """ Cached audio output device list.
+
+        devices: list of dictionaries with keys id, name,
+            hostapi, chans_out, default_samplerate,
+            low_latency, high_latency (s) and samplerates
+        updated: number of completed refreshes
+        error: message of the last failed refresh, or None
+    """
+    def __init__(self, cache_file=CACHE_FILE):
+        self.cache_file = Path(cache_file)
+        self.devices = []
+        self.updated = 0
+        self.error = None
+        # Device key -> supported sample rates
+        self._probes = self._load()
+        self._lock = threading.Lock()
+        self._thread = None
+
+
+    def _load(self):
+        try:
+            with open(self.cache_file, 'r') as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return dict()
+
+
+    def _save(self):
+        """ Write the probe cache (atomically) """
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_file.with_suffix('.tmp')
+            with open(tmp, 'w') as fh:
+                json.dump(self._probes, fh)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            trace.warning("DeviceInventory: Could not save probe cache: %s", e)
+
+
+    def refresh(self):
+        """ Rescan devices on a background thread (if a scan is
+            not already running). Returns right away.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+
+    @property
+    def scanning(self):
+        return self._thread is not None and self._thread.is_alive()
+
+
+    def wait(self, timeout=None):
+        """ Wait for a running scan to finish """
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+    def _run(self):
+        try:
+            with trace.span('scan'):
+                devices = self.scan()
+        except Exception as e:
+            self.error = str(e)
+            trace.warning("DeviceInventory: Could not list audio devices: %s", e)
+            return
+        # Replace the list in one step; readers never see a
+        # partial scan
+        self.devices = devices
+        self.error = None
+        self.updated += 1
+
+
+    def scan(self):
+        """ Query and probe all output devices (blocking) """
+        import sounddevice as sd
+        hostapis = [x['name'] for x in sd.query_hostapis()]
+        devices = []
+        probed = False
+        for info in sd.query_devices():
+            if info['max_output_channels'] < 1:
+                continue
+            device = {
+                'id': info['index'],
+                'name': info['name'],
+                'hostapi': hostapis[info['hostapi']],
+                'chans_out': info['max_output_channels'],
+                'default_samplerate': info['default_samplerate'],
+                'low_latency': info['default_low_output_latency'],
+                'high_latency': info['default_high_output_latency']
+            }
+            key = f"{device['hostapi']}|{device['name']}|{device['chans_out']}"
+            if key not in self._probes:
+                self._probes[key] = self._probe(sd, device)
+                probed = True
+            device['samplerates'] = self._probes[key]
+            devices.append(device)
+        if probed:
+            self._save()
+        return devices
+
+
+    @staticmethod
+    def _probe(sd, device):
+        """ Sample rates DEVICE accepts for output """
+        rates = []
+        for rate in PROBE_RATES:
+            try:
+                sd.check_output_settings(device=device['id'],
+                    samplerate=rate, channels=1, dtype='float32')
+            except Exception:
+                continue
+            rates.append(rate)
+        return rates
+
+
+    def find(self, device_id):
+        """ Device dictionary for DEVICE_ID, or None """
+        for device in self.devices:
+            if device['id'] == device_id:
+                return device
+        return None
+
+
+    def lowest_latency(self, min_channels=1, samplerate=None):
+        """ Device with the lowest default low output latency
+            that has at least MIN_CHANNELS outputs (and supports
+            SAMPLERATE, if given), or None
+        """
+        candidates = [x for x in self.devices if
+            x['chans_out'] >= min_channels and
+            (samplerate is None or samplerate in x['samplerates'])]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda x: x['low_latency'])
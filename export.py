@@ -0,0 +1,52 @@
+""" Export an Adaptive Rating database to session CSV files
+
+    Writes one {datestamp}_{condition}_{subject}.csv file per
+    session stored by SQLiteModel (Data Format 'sqlite'), in
+    the layout CSVModel writes, so scripts that read the CSV
+    files (including aggregate.py) keep working.
+
+    Usage:
+        python export.py [DB] [--out DIR] [--subject SUBJECT]
+
+    DB defaults to adaptive_rating.db in the current folder.
+"""
+
+# Import system packages
+import argparse
+import os
+import sys
+
+# Import custom modules
+import models as m
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Write session CSV files from an Adaptive Rating "
+            "database")
+    parser.add_argument('db', nargs='?', default='adaptive_rating.db',
+        help="SQLite database (default: adaptive_rating.db)")
+    parser.add_argument('--out', default='.',
+        help="output folder (default: current folder)")
+    parser.add_argument('--subject', default=None,
+        help="only export this subject's sessions")
+    args = parser.parse_args(argv)
+
+    # Opening a missing database would create an empty one
+    if not os.path.isfile(args.db):
+        print(f"Not a database file: {args.db}")
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+    model = m.SQLiteModel(dict(), db_path=args.db)
+    try:
+        written = model.export_csv(args.out, subject=args.subject)
+    finally:
+        model.close()
+    for file in written:
+        print(file)
+    print(f"Wrote {len(written)} session file(s) to {args.out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
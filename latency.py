@@ -0,0 +1,114 @@
+""" Press-to-sound latency measurement for Adaptive Rating
+
+    Each button press is timestamped with time.perf_counter_ns
+    as it moves through the app:
+
+        press     arrow/repeat button callback (views.MainFrame)
+        get_audio Application._get_audio (arrow presses only)
+        present   Application.present_audio
+        decoded   Audio object ready (decoded or prefetched)
+        enqueued  buffer handed to the audio engine
+        callback  first stream callback that mixes the buffer
+        dac       estimated time the first sample reaches the DAC
+
+    Stage times are stored relative to the press and collected
+    in a fixed-bin histogram for the whole session.
+"""
+
+# Import system packages
+from time import perf_counter_ns
+
+# Import data science packages
+import numpy as np
+
+
+class LatencyTracker:
+    """ Per-press stage timestamps and session histograms """
+    STAGES = ('get_audio', 'present', 'decoded', 'enqueued', 'callback', 'dac')
+
+    def __init__(self, bin_ms=0.1, max_ms=1000):
+        self.bin_ms = bin_ms
+        # Last bin collects everything above max_ms
+        nbins = int(max_ms / bin_ms) + 1
+        self.histograms = {stage: np.zeros(nbins, dtype=np.int64)
+            for stage in self.STAGES}
+
+        # Timestamps of the press being measured
+        self._marks = None
+        self._voice = None
+        # Stage latencies (ms) of the last completed press
+        self.last = dict()
+
+
+    def begin(self, press_ns=None):
+        """ Start measuring a new press. PRESS_NS defaults to now. """
+        self.finish()
+        self._marks = {'press': press_ns or perf_counter_ns()}
+        self._voice = None
+
+
+    def mark(self, stage):
+        """ Timestamp STAGE of the current press """
+        if self._marks is not None:
+            self._marks[stage] = perf_counter_ns()
+
+
+    def attach(self, voice):
+        """ Use VOICE (see audioengine.Voice) for callback/DAC times """
+        self._voice = voice
+
+
+    def finish(self):
+        """ Close the current press and add it to the histograms.
+            Called automatically by begin() and columns().
+        """
+        if self._marks is None:
+            return
+        marks = self._marks
+        if self._voice is not None and self._voice.start_ns is not None:
+            marks['callback'] = self._voice.start_ns
+            marks['dac'] = self._voice.dac_ns
+
+        press = marks['press']
+        last = dict()
+        for stage in self.STAGES:
+            if stage not in marks:
+                continue
+            ms = (marks[stage] - press) / 1e6
+            last[stage] = ms
+            idx = min(int(max(ms, 0) / self.bin_ms),
+                len(self.histograms[stage]) - 1)
+            self.histograms[stage][idx] += 1
+
+        self.last = last
+        self._marks = None
+        self._voice = None
+
+
+    def columns(self):
+        """ Stage latencies of the last press as record fields """
+        self.finish()
+        return {f"Latency {stage} ms": round(self.last.get(stage, np.nan), 3)
+            for stage in self.STAGES}
+
+
+    def summary(self):
+        """ Return count, median, 95th percentile and maximum (ms)
+            for each stage, estimated from the histograms.
+        """
+        results = dict()
+        for stage, hist in self.histograms.items():
+            count = int(hist.sum())
+            if not count:
+                continue
+            cumulative = np.cumsum(hist)
+            # Report the upper edge of the bin containing the value
+            def pct(p):
+                return float(np.searchsorted(cumulative, p * count) + 1) * self.bin_ms
+            results[stage] = {
+                'count': count,
+                'median': pct(0.5),
+                'p95': pct(0.95),
+                'max': float(np.flatnonzero(hist)[-1] + 1) * self.bin_ms
+            }
+        return results
@@ -3,6 +3,7 @@
 # Import GUI packages
 import tkinter as tk
 from tkinter import messagebox
+from tkinter import simpledialog
 
 
 class MainMenu(tk.Menu):
@@ -26,6 +27,10 @@ class MainMenu(tk.Menu):
             label="Session...",
             command=self._event('<<FileSession>>')
         )
+        # Settings profiles (filled in by set_profiles)
+        self.profile = tk.StringVar()
+        self.profile_menu = tk.Menu(file_menu, tearoff=False)
+        file_menu.add_cascade(label="Profile", menu=self.profile_menu)
         file_menu.add_separator()
         file_menu.add_command(
             label="Quit",
@@ -43,6 +48,14 @@ class MainMenu(tk.Menu):
             label="Calibration...",
             command=self._event('<<ToolsCalibrate>>')
         )
+        tools_menu.add_separator()
+        # Profiling on/off (see profiling.py)
+        self.profiling = tk.BooleanVar(value=False)
+        tools_menu.add_checkbutton(
+            label="Profiling",
+            variable=self.profiling,
+            command=self._event('<<ToolsProfiling>>')
+        )
         self.add_cascade(label='Tools', menu=tools_menu)
 
 
@@ -54,6 +67,33 @@ class MainMenu(tk.Menu):
         )
         self.add_cascade(label="Help", menu=help_menu)
 
+    def set_profiles(self, names, current):
+        """ List settings profiles NAMES, with CURRENT selected """
+        self.profile_menu.delete(0, 'end')
+        for name in names:
+            self.profile_menu.add_radiobutton(
+                label=name,
+                value=name,
+                variable=self.profile,
+                command=self._event('<<FileProfile>>')
+            )
+        self.profile_menu.add_separator()
+        self.profile_menu.add_command(
+            label="New Profile...",
+            command=self._new_profile
+        )
+        self.profile.set(current)
+
+
+    def _new_profile(self):
+        """ Ask for a profile name and switch to it """
+        name = simpledialog.askstring(parent=self.master, 
+            title="New Profile", prompt="Profile name:")
+        if name and name.strip():
+            self.profile.set(name.strip())
+            self._event('<<FileProfile>>')()
+
+
     def show_about(self):
         """ Show the about dialog """
         about_message = 'Adaptive Rating Tool'
@@ -1,116 +1,1097 @@
 """ Model class for Adaptive Ratings """
 
 # Import system packages
+import sys
 import csv
+import sqlite3
 from pathlib import Path
 from datetime import datetime
 import os
+import time
+import hashlib
+import queue
+import threading
+import zipfile
+from collections import OrderedDict
 
 # Import data science packages
 import numpy as np
-import pandas as pd
 
 # Import data handling packages
 import json
-from glob import glob
 
-# Import audio packages
-from scipy.io import wavfile
-import sounddevice as sd
+# Import custom modules
+import tracing
+
+# pandas, scipy and sounddevice are imported on first use 
+# to keep startup fast
+
+trace = tracing.get_tracer('models')
+
+
+class StimulusCache:
+    """ LRU cache of decoded audio buffers. The app shares one 
+        instance (stimulus_cache); each booth.Booth owns its own.
+
+        Entries are keyed by file path, modification time 
+        and size, so a file that changes on disk is decoded 
+        again on its next request. The total size of the 
+        cached buffers is kept under MAX_BYTES by evicting 
+        the least recently used entries.
+    """
+    def __init__(self, max_bytes=256 * 1024**2):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+        # Hit/miss statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> (mtime, size, entry), where key is the file path
+        # for decoded buffers and (path, level, layout) for 
+        # level-scaled buffers
+        self._entries = OrderedDict()
+        # path -> (mtime, size, per-channel RMS)
+        self._rms = dict()
+        # Stimulus table whose stored RMS values are used before
+        # decoding a file (see AudioList)
+        self.table = None
+        # Pre-rendered stimulus set (see render.RenderedSet)
+        self.rendered = None
+        # Output (device) sample rate. Files at other rates are 
+        # resampled once and kept; 0 keeps each file's rate.
+        self.samplerate = 0
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def _signature(file_path):
+        """ Return the (mtime, size) pair used to validate entries """
+        st = os.stat(file_path)
+        return st.st_mtime_ns, st.st_size
+
+
+    @staticmethod
+    def _entry_bytes(entry):
+        """ Number of bytes held by a cache entry """
+        return entry[2].nbytes
+
+
+    def get(self, file_path):
+        """ Return (fs, data_type, float64 signal) for FILE_PATH,
+            decoding it only if it is not already cached.
+            The returned signal is read-only.
+        """
+        signature = self._signature(file_path)
+        with self._lock:
+            cached = self._entries.get(file_path)
+            if cached is not None and cached[:2] == signature:
+                self._entries.move_to_end(file_path)
+                self.hits += 1
+                return cached[2]
+            self.misses += 1
+
+        # Decode outside the lock so other readers are not blocked
+        with trace.span('decode', file=file_path):
+            entry = read_wav(file_path)
+        entry[2].setflags(write=False)
+        self._store(file_path, signature, entry)
+        return entry
+
+
+    def get_resampled(self, file_path):
+        """ Return (fs, data_type, float64 signal) for FILE_PATH at
+            the output sample rate. Files at another rate are 
+            resampled (polyphase) once per file version, and the
+            resampled buffer replaces the decoded one in the 
+            cache.
+        """
+        rate = self.samplerate
+        if not rate:
+            return self.get(file_path)
+        signature = self._signature(file_path)
+        key = (file_path, rate)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[:2] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._drop_decoded(file_path)
+                return cached[2]
+
+        fs, data_type, sig = self.get(file_path)
+        if fs == rate:
+            return fs, data_type, sig
+        entry = (rate, data_type, resample(sig, fs, rate))
+        entry[2].setflags(write=False)
+        # Level the resampled signal by its own RMS
+        values = channel_rms(entry[2])
+        with self._lock:
+            self._rms[key] = (signature[0], signature[1], values)
+        self._store(key, signature, entry)
+        with self._lock:
+            self._drop_decoded(file_path)
+        return entry
+
+
+    def _drop_decoded(self, file_path):
+        """ Evict the decoded (original rate) buffer of FILE_PATH;
+            only the resampled version is needed. Caller must 
+            hold the lock.
+        """
+        old = self._entries.pop(file_path, None)
+        if old is not None:
+            self.nbytes -= self._entry_bytes(old[2])
+
+
+    def harmonise(self, paths, workers=None):
+        """ Resample PATHS to the output sample rate ahead of 
+            time on a thread pool (the polyphase filter runs 
+            outside the GIL). Returns the number of files done.
+        """
+        if not self.samplerate:
+            return 0
+        from concurrent.futures import ThreadPoolExecutor
+
+        def convert(file_path):
+            try:
+                self.get_resampled(file_path)
+                return 1
+            except Exception as e:
+                trace.warning("StimulusCache: Could not resample %s: %s", file_path, e)
+                return 0
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return sum(pool.map(convert, paths))
+
+
+    def rms(self, file_path):
+        """ Return the per-channel RMS of FILE_PATH. Values come
+            from the stimulus table or are computed once per file
+            version, and are never evicted.
+        """
+        signature = self._signature(file_path)
+        with self._lock:
+            cached = self._rms.get(file_path)
+        table = self.table
+        if cached is None and table is not None:
+            cached = table.stored_rms(file_path)
+        if cached is not None and cached[:2] == signature:
+            return cached[2]
+        values = channel_rms(self.get(file_path)[2])
+        with self._lock:
+            self._rms[file_path] = (signature[0], signature[1], values)
+        return values
+
+
+    def get_scaled(self, file_path, level, eq='y', decode=True):
+        """ Return (fs, data_type, float32 signal) with LEVEL 
+            applied to every channel of FILE_PATH (see 
+            apply_level for EQ). The result is cached, so 
+            repeating a file at the same level costs nothing; a 
+            new level (e.g., after calibration) is computed once.
+
+            Signals are at the output sample rate (see 
+            get_resampled). Pre-rendered buffers (see render.py)
+            are used when available at that rate. Without DECODE,
+            return None instead of decoding the original file.
+        """
+        signature = self._signature(file_path)
+        # Channel layout (from the resampled RMS if there is one,
+        # which avoids decoding a harmonised file again)
+        with self._lock:
+            rms = self._rms.get((file_path, self.samplerate))
+        rms = rms[2] if rms is not None and rms[:2] == signature else \
+            self.rms(file_path)
+        layout = tuple(range(len(rms)))
+        key = (file_path, level, layout, eq, self.samplerate)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[:2] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached[2]
+
+        entry = None
+        if self.rendered is not None:
+            entry = self.rendered.load(file_path, level, eq, signature)
+            if entry is not None and self.samplerate and \
+                entry[0] != self.samplerate:
+                entry = None
+        if entry is None:
+            if not decode:
+                return None
+            fs, data_type, sig = self.get_resampled(file_path)
+            with self._lock:
+                rms = self._rms.get((file_path, fs))
+            if rms is None or rms[:2] != signature:
+                rms = self.rms(file_path)
+            else:
+                rms = rms[2]
+            with trace.span('scale', file=file_path, level=level):
+                scaled = apply_level(sig, level, eq=eq, rms=rms)
+            entry = (fs, data_type, scaled)
+        entry[2].setflags(write=False)
+        with self._lock:
+            self.misses += 1
+        self._store(key, signature, entry)
+        return entry
+
+
+    def _store(self, key, signature, entry):
+        """ Add an entry and evict old entries to respect the budget """
+        size = self._entry_bytes(entry)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= self._entry_bytes(old[2])
+            # Never cache an entry that cannot fit in the budget
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (signature[0], signature[1], entry)
+            self.nbytes += size
+            self._evict()
+
+
+    def _evict(self):
+        """ Drop least recently used entries until under budget.
+            Caller must hold the lock.
+        """
+        while self.nbytes > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self.nbytes -= self._entry_bytes(old[2])
+            self.evictions += 1
+
+
+    def resize(self, max_bytes):
+        """ Change the memory budget, evicting entries if needed """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+
+    def discard(self, file_path):
+        """ Remove every buffer of FILE_PATH from the cache """
+        with self._lock:
+            for key in list(self._rms):
+                if key == file_path or (
+                    isinstance(key, tuple) and key[0] == file_path):
+                    del self._rms[key]
+            for key in list(self._entries):
+                if key == file_path or (
+                    isinstance(key, tuple) and key[0] == file_path):
+                    old = self._entries.pop(key)
+                    self.nbytes -= self._entry_bytes(old[2])
+
+
+    def clear(self):
+        """ Remove all entries and reset statistics """
+        with self._lock:
+            self._entries.clear()
+            self._rms.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+    def stats(self):
+        """ Return a dictionary of cache statistics """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / requests if requests else 0.0
+            }
+
+
+def channel_rms(sig):
+    """ Per-channel RMS of a (frames, channels) or 1-channel 
+        signal, computed in one pass with float64 accumulation.
+        Always returns a 1-D array (one value per channel).
+    """
+    sig = np.asarray(sig)
+    if sig.ndim == 1:
+        sig = sig[:, np.newaxis]
+    if not len(sig):
+        return np.zeros(sig.shape[1])
+    power = np.einsum('ij,ij->j', sig, sig, dtype=np.float64)
+    return np.sqrt(power / len(sig))
+
+
+def level_gains(rms, amp, eq='y'):
+    """ Linear gains that set channels with RMS values RMS to 
+        AMP dB (re: 1.0).
+
+        EQ: 'y' sets every channel to AMP. 'n' applies one gain
+            to all channels so their mean level (in dB) is AMP, 
+            preserving interaural/inter-channel level 
+            differences (as Audio.setRMS does with eq='n').
+    """
+    rms = np.asarray(rms, dtype=np.float64)
+    # Silent channels cannot be scaled and are left unchanged
+    silent = ~(rms > 0)
+    rmsdb = 20 * np.log10(np.where(silent, 1.0, rms))
+    if eq == 'n' and not silent.all():
+        rmsdb = np.full_like(rmsdb, rmsdb[~silent].mean())
+    return np.where(silent, 1.0, 10**((amp - rmsdb)/20))
+
+
+def apply_level(sig, amp, eq='y', rms=None, out=None):
+    """ Set the level of an N-channel signal (frames, channels)
+        or a 1-channel signal to AMP dB (see level_gains for EQ).
+
+        The result is float32. Gains are applied in place to OUT
+        (which may be SIG itself, if it is a writable float32 
+        array); otherwise one float32 copy of SIG is made.
+        Precomputed per-channel RMS values can be passed as RMS.
+    """
+    if out is None:
+        out = np.array(sig, dtype=np.float32)
+    elif out is not sig:
+        np.copyto(out, sig, casting='same_kind')
+    if rms is None:
+        rms = channel_rms(out)
+    gains = level_gains(rms, amp, eq).astype(np.float32)
+    if out.ndim == 1:
+        out *= gains[0]
+    else:
+        out *= gains
+    return out
+
+
+def calibration_noise(fs=48000, seconds=2.0, seed=0):
+    """ Seeded Gaussian white noise with an RMS of 1 (0 dB FS
+        RMS) as a float32 column, for looping calibration
+    """
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal((int(fs * seconds), 1)).astype(np.float32)
+    noise /= np.sqrt(np.mean(noise.astype(np.float64)**2))
+    return noise
+
+
+def resample(sig, fs, target_fs):
+    """ Resample SIG (frames first) from FS to TARGET_FS with a
+        polyphase filter
+    """
+    if fs == target_fs:
+        return sig
+    from fractions import Fraction
+    from scipy.signal import resample_poly
+    ratio = Fraction(int(target_fs), int(fs)).limit_denominator(1000)
+    return resample_poly(sig, ratio.numerator, ratio.denominator, axis=0)
+
+
+def read_wav(file_path):
+    """ Read a .wav file and convert it to float64. 
+        Returns (fs, original data type, signal).
+    """
+    from scipy.io import wavfile
+    fs, audio_file = wavfile.read(file_path)
+    data_type = audio_file.dtype
+    if data_type == 'float64':
+        sig = audio_file
+    else:
+        # 1. Convert to float64
+        sig = audio_file.astype(np.float64)
+        # 2. Divide by original dtype max val
+        sig = sig / Audio.wav_dict[str(data_type)][1]
+    return fs, data_type, sig
+
+
+# Decoded buffers shared by every Audio object
+stimulus_cache = StimulusCache()
+
+
+class Prefetcher:
+    """ Decode and level-scale likely upcoming stimuli on a 
+        background thread, so the next button press can be
+        played straight from memory.
+
+        Keep track of how many prefetched stimuli were 
+        presented (used) and how many were dropped without 
+        being presented (wasted).
+
+        CACHE: StimulusCache to load from (default: the shared
+            stimulus_cache)
+    """
+    def __init__(self, cache=None):
+        self.cache = cache or stimulus_cache
+        self.used = 0
+        self.wasted = 0
+        self.missed = 0
+
+        # (path, level) -> scaled Audio object
+        self._ready = dict()
+        # Keys requested by the most recent schedule() call
+        self._wanted = list()
+        # (function, level) of the most recent schedule() call
+        # that still has to run, and a count of schedule() calls
+        self._more = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def schedule(self, paths, level, more=None):
+        """ Replace the prefetch queue with PATHS at LEVEL. 
+            Prefetched stimuli that are no longer wanted are
+            discarded and counted as wasted.
+
+            MORE is an optional function returning further paths.
+            It is called on the prefetch thread once PATHS are 
+            loaded, so slow work (e.g., choosing the stimuli the
+            next press can lead to) stays off the caller's 
+            thread. Ready stimuli are only discarded once it has
+            run.
+        """
+        wanted = [(path, level) for path in paths]
+        with self._lock:
+            self._generation += 1
+            if more is None:
+                self._discard_unwanted(wanted)
+                self._more = None
+            else:
+                self._more = (more, level, self._generation)
+            self._wanted = wanted
+        self._wake.set()
+
+
+    def _discard_unwanted(self, wanted):
+        """ Drop ready stimuli not in WANTED. Caller must hold 
+            the lock.
+        """
+        for key in list(self._ready):
+            if key not in wanted:
+                del self._ready[key]
+                self.wasted += 1
+
+
+    def _run_more(self):
+        """ Call the pending MORE function of schedule() and add
+            its paths. Returns False if there was none.
+        """
+        with self._lock:
+            if self._more is None:
+                return False
+            more, level, generation = self._more
+            self._more = None
+        try:
+            paths = more()
+        except Exception as e:
+            trace.warning("Prefetcher: Could not choose stimuli: %s", e)
+            paths = []
+        with self._lock:
+            # Skip if schedule() was called again meanwhile
+            if generation == self._generation:
+                self._wanted += [(path, level) for path in paths
+                    if (path, level) not in self._wanted]
+                self._discard_unwanted(self._wanted)
+        return True
+
+
+    def take(self, file_path, level):
+        """ Return the prefetched Audio object for FILE_PATH at 
+            LEVEL, or None if it is not ready.
+        """
+        key = (file_path, level)
+        with self._lock:
+            audio = self._ready.pop(key, None)
+            if key in self._wanted:
+                self._wanted.remove(key)
+            if audio is None:
+                self.missed += 1
+            else:
+                self.used += 1
+        return audio
+
+
+    def invalidate(self, paths):
+        """ Drop prefetched stimuli for PATHS (e.g., files that
+            changed on disk)
+        """
+        paths = set(paths)
+        with self._lock:
+            for key in list(self._ready):
+                if key[0] in paths:
+                    del self._ready[key]
+                    self.wasted += 1
+
+
+    def stats(self):
+        """ Return a dictionary of prefetch statistics """
+        with self._lock:
+            return {
+                'used': self.used,
+                'wasted': self.wasted,
+                'missed': self.missed,
+                'ready': len(self._ready)
+            }
+
+
+    def close(self):
+        """ Stop the background thread """
+        self._stopped = True
+        self._wake.set()
+
+
+    def _next_job(self):
+        """ Return the next wanted key that is not ready yet """
+        with self._lock:
+            for key in self._wanted:
+                if key not in self._ready:
+                    return key
+        return None
+
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait()
+            self._wake.clear()
+            while not self._stopped:
+                key = self._next_job()
+                if key is None:
+                    if self._run_more():
+                        continue
+                    break
+                try:
+                    audio = Audio(*key, cache=self.cache)
+                    audio.scale()
+                except Exception as e:
+                    trace.warning("Prefetcher: Could not load %s: %s", key[0], e)
+                    with self._lock:
+                        if key in self._wanted:
+                            self._wanted.remove(key)
+                    continue
+                with self._lock:
+                    # Only keep it if it is still wanted
+                    if key in self._wanted:
+                        self._ready[key] = audio
+
+
+class StimulusIndex:
+    """ On-disk index of the .wav files in a stimulus directory.
+
+        The index is kept as columns (NumPy arrays, one row per
+        file) in self.columns:
+
+            name, parameter (text), fs, channels, dtype,
+            duration, mtime_ns, size: one value per file
+            rms: per-channel RMS of all files in one flat 
+                array (CHANNELS values per file)
+
+        update() rescans the folder with os.scandir and only
+        reads files that are new or have changed since the
+        index was written. After a complete scan the index 
+        file's mtime is set to the directory's. If they still 
+        match (no file added, removed or renamed), a quick 
+        update skips the per-file stat calls; a file rewritten
+        in place is picked up by a full update (the directory
+        watcher does one), and until then the stimulus cache 
+        still checks every buffer and RMS value against the 
+        file's mtime and size.
+
+        The index is stored (.npz) in the stimulus directory 
+        or, if that is not writable, in ~/.adaptive_rating/index.
+        New files are decoded through CACHE (default: 
+        stimulus_cache).
+    """
+    filename = '.adaptive_rating_index.npz'
+    version = 2
+    # Column name -> dtype of an empty column
+    fields = {
+        'name': str,
+        'parameter': str,
+        'fs': np.int64,
+        'channels': np.int64,
+        'dtype': str,
+        'duration': np.float64,
+        'mtime_ns': np.int64,
+        'size': np.int64,
+        'rms': np.float64
+    }
+
+    def __init__(self, directory, cache=None):
+        self.directory = os.path.abspath(directory)
+        self.cache = cache or stimulus_cache
+        self.filepath = self._index_path()
+        # Column name -> array; replaced (never changed) by update()
+        self.columns = {key: np.zeros(0, dtype=dtype) 
+            for key, dtype in self.fields.items()}
+        # True once the columns were loaded or scanned
+        self._valid = False
+        self.load()
+
+
+    def __len__(self):
+        return len(self.columns['name'])
+
+
+    def _index_path(self):
+        """ Choose where to keep the index file """
+        local = Path(self.directory) / self.filename
+        if os.access(self.directory, os.W_OK) and (
+            not local.exists() or os.access(local, os.W_OK)):
+            return local
+        digest = hashlib.sha1(self.directory.encode()).hexdigest()[:16]
+        return Path.home() / '.adaptive_rating' / 'index' / f"{digest}.npz"
+
+
+    def load(self):
+        """ Load the index file (if present and compatible) """
+        try:
+            with np.load(self.filepath, allow_pickle=False) as raw:
+                if int(raw['version']) != self.version:
+                    return
+                columns = {key: raw[key] for key in self.fields}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return
+        self.columns = columns
+        self._valid = True
+
+
+    def save(self):
+        """ Write the index atomically """
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.filepath.with_suffix('.tmp')
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, version=self.version, **self.columns)
+        os.replace(tmp, self.filepath)
+
+
+    def _mark_current(self):
+        """ Set the index file's mtime to the directory's, which
+            marks the index as up to date (see update)
+        """
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        os.utime(self.filepath, ns=(mtime_ns, mtime_ns))
+
+
+    def _is_current(self, dir_mtime_ns):
+        """ True if the directory has not changed since the index
+            was marked up to date
+        """
+        try:
+            return os.stat(self.filepath).st_mtime_ns == dir_mtime_ns
+        except OSError:
+            return False
+
+
+    @staticmethod
+    def parse_parameter(name):
+        """ Trailing underscore value of a file name (as text) """
+        return name.split("_")[-1][:-4]
+
+
+    def _read_entry(self, path, mtime_ns, size):
+        """ Read header values and RMS of one file """
+        fs, data_type, sig = self.cache.get(path)
+        return {
+            'name': os.path.basename(path),
+            'parameter': self.parse_parameter(os.path.basename(path)),
+            'fs': int(fs),
+            'channels': 1 if sig.ndim == 1 else int(sig.shape[1]),
+            'dtype': str(data_type),
+            'duration': len(sig) / fs,
+            'rms': [float(x) for x in self.cache.rms(path)],
+            'mtime_ns': mtime_ns,
+            'size': size
+        }
+
+
+    def update(self, full=True):
+        """ Rescan the directory, reading only new or changed 
+            files. Without FULL, nothing is read if the directory
+            has not changed since the last complete scan. Returns
+            (added, removed, changed) file names.
+
+            The new columns are built as new arrays and swapped 
+            in at the end, so other threads reading 
+            self.columns always see a consistent index.
+        """
+        dir_mtime_ns = os.stat(self.directory).st_mtime_ns
+        if not full and self._valid and self._is_current(dir_mtime_ns):
+            return [], [], []
+
+        found = dict()
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.lower().endswith('.wav') and entry.is_file():
+                    st = entry.stat()
+                    found[entry.name] = (st.st_mtime_ns, st.st_size)
+
+        columns = self.columns
+        names = columns['name'].tolist()
+        signatures = zip(columns['mtime_ns'].tolist(), 
+            columns['size'].tolist())
+        keep = np.zeros(len(names), dtype=bool)
+        added, removed, changed, new = [], [], [], []
+        for row, (name, signature) in enumerate(zip(names, signatures)):
+            current = found.pop(name, None)
+            if current is None:
+                removed.append(name)
+            elif current == signature:
+                keep[row] = True
+            else:
+                changed.append(name)
+                found[name] = current
+        for name, (mtime_ns, size) in found.items():
+            path = os.path.join(self.directory, name)
+            try:
+                new.append(self._read_entry(path, mtime_ns, size))
+            except Exception as e:
+                trace.warning("StimulusIndex: Skipping unreadable file %s: %s", name, e)
+                if name in changed:
+                    changed.remove(name)
+                    removed.append(name)
+                continue
+            if name not in changed:
+                added.append(name)
+
+        if added or removed or changed:
+            self.columns = self._merge(columns, keep, new)
+        self._valid = True
+        if self._is_current(dir_mtime_ns) and not (added or removed or 
+            changed):
+            return added, removed, changed
+
+        # A file added during the scan leaves the index unmarked
+        complete = os.stat(self.directory).st_mtime_ns == dir_mtime_ns
+        try:
+            if added or removed or changed or not self.filepath.exists():
+                self.save()
+            if complete:
+                self._mark_current()
+        except OSError as e:
+            trace.warning("StimulusIndex: Could not save index: %s", e)
+        return added, removed, changed
+
+
+    def _merge(self, columns, keep, new):
+        """ Columns of the rows of COLUMNS selected by KEEP, 
+            followed by NEW entries (dicts from _read_entry)
+        """
+        merged = dict()
+        rms_keep = np.repeat(keep, columns['channels'])
+        for key, dtype in self.fields.items():
+            kept = columns[key][rms_keep if key == 'rms' else keep]
+            if key == 'rms':
+                values = [x for entry in new for x in entry['rms']]
+            else:
+                values = [entry[key] for entry in new]
+            merged[key] = np.concatenate([kept, 
+                np.array(values, dtype=dtype)]) if values else kept
+        return merged
+
+
+    def off_rate(self, samplerate, max_bytes=None):
+        """ Names of the files that are not at SAMPLERATE. With 
+            MAX_BYTES, only as many as fit in that many bytes 
+            once resampled (float64).
+        """
+        columns = self.columns
+        off = columns['fs'] != samplerate
+        names = columns['name'][off]
+        if max_bytes is not None:
+            need = np.cumsum(columns['duration'][off] * samplerate * 
+                columns['channels'][off] * 8)
+            names = names[:np.searchsorted(need, max_bytes, side='right')]
+        return names.tolist()
+
+
+    def path(self, name):
+        """ Full path of an indexed file """
+        return os.path.join(self.directory, name)
+
+
+class StimulusTable:
+    """ Compact stimulus list, sorted by Parameter.
+
+        parameters: NumPy array of Parameter values (integers,
+            or strings if the values are not numeric)
+        paths: object array of full file paths
+        rms(index): per-channel RMS of a file, stored in one
+            flat float array
+
+        RMS is a list of per-file arrays or, with COUNTS, one flat
+        array holding COUNTS[i] values for file i. SIGNATURES 
+        (arrays of mtime_ns and size) let stored_rms() give the
+        stimulus cache the RMS of a file version.
+
+        Rows are looked up by position in O(1) and by Parameter
+        value in O(log n) with find(). frame() gives a pandas
+        DataFrame view with the columns of earlier versions.
+    """
+    def __init__(self, paths, parameters, rms, counts=None, signatures=None):
+        parameters = np.asarray(parameters)
+        order = np.argsort(parameters, kind='stable')
+        self.parameters = parameters[order]
+        self.paths = np.empty(len(order), dtype=object)
+        self.paths[:] = paths
+        self.paths = self.paths[order]
+
+        if counts is None:
+            counts = [len(x) for x in rms]
+            rms = np.concatenate(rms) if len(rms) else np.zeros(0)
+        counts = np.asarray(counts, dtype=np.int64)
+        starts = (np.cumsum(counts) - counts)[order]
+        counts = counts[order]
+        self._rms_offsets = np.concatenate(([0], np.cumsum(counts)))
+        take = np.repeat(starts - self._rms_offsets[:-1], counts) + \
+            np.arange(self._rms_offsets[-1])
+        self._rms = np.asarray(rms, dtype=np.float64)[take]
+
+        self._signatures = None if signatures is None else \
+            tuple(np.asarray(x)[order] for x in signatures)
+        # Path -> row, built on the first stored_rms() call
+        self._rows = None
+        self._frame = None
+
+
+    def __len__(self):
+        return len(self.parameters)
+
+
+    def path(self, index):
+        """ Full path of the file at INDEX """
+        return self.paths[index]
+
+
+    def rms(self, index):
+        """ Per-channel RMS of the file at INDEX """
+        return self._rms[self._rms_offsets[index]:self._rms_offsets[index + 1]]
+
+
+    def stored_rms(self, path):
+        """ (mtime_ns, size, per-channel RMS) of PATH, or None if
+            the table has no signatures or no such file
+        """
+        if self._signatures is None:
+            return None
+        rows = self._rows
+        if rows is None:
+            rows = {x: ii for ii, x in enumerate(self.paths.tolist())}
+            self._rows = rows
+        row = rows.get(path)
+        if row is None:
+            return None
+        return (int(self._signatures[0][row]), int(self._signatures[1][row]),
+            self.rms(row))
+
+
+    def find(self, value):
+        """ Index of the first file with Parameter VALUE. If there
+            is none, the index of the nearest value (or of the
+            insertion point for string values). None if the 
+            table is empty or VALUE cannot be compared.
+        """
+        n = len(self.parameters)
+        if not n:
+            return None
+        try:
+            index = int(np.searchsorted(self.parameters, value))
+        except TypeError:
+            return None
+        if index < n and self.parameters[index] == value:
+            return index
+        if not np.issubdtype(self.parameters.dtype, np.number):
+            return min(index, n - 1)
+        # Nearest remaining value
+        lower, upper = max(index - 1, 0), min(index, n - 1)
+        try:
+            if abs(value - self.parameters[lower]) <= abs(
+                self.parameters[upper] - value):
+                return lower
+        except TypeError:
+            return None
+        return upper
+
+
+    def frame(self):
+        """ pandas DataFrame view (built on first use) """
+        if self._frame is None:
+            import pandas as pd
+            self._frame = pd.DataFrame({
+                'Audio List': self.paths,
+                'Parameter': self.parameters,
+                'RMS': [self.rms(ii) for ii in range(len(self))]
+            })
+        return self._frame
 
 
 class AudioList:
     """ Get audio files and trailing underscore values """
+    # Columns of the audio_data view
     fields = {
         'Audio List': [],
-        'Parameter': []
+        'Parameter': [],
+        'RMS': []
     }
 
-    def __init__(self, sessionpars):
+    def __init__(self, sessionpars, cache=None):
         
         self.sessionpars = sessionpars
+        # Stimulus cache that reads RMS values from the table
+        self.cache = cache or stimulus_cache
 
-        print("Models_33: Checking for audio files dir...")
+        trace.debug("Models_33: Checking for audio files dir...")
         # If the file doesn't exist, return
         if not os.path.exists(self.sessionpars['Audio Files Path'].get()):
-            print("Models_36: Not a valid audio files directory!")
+            trace.warning("Models_36: Not a valid audio files directory!")
             return
-        # If a valid path has been given, get the files
-        #self.fields['Audio List'] = os.listdir(self.sessionpars['Audio Files Path'].get())
-        glob_pattern = os.path.join(self.sessionpars['Audio Files Path'].get(), '*')
-        self.fields['Audio List'] = glob(glob_pattern)
+        # If a valid path has been given, get the .wav files
+        # from the directory index (only changed files are read)
+        self.index = StimulusIndex(self.sessionpars['Audio Files Path'].get(),
+            self.cache)
+        self.index.update(full=False)
+        self._build(self.index.columns)
+
+
+    def rescan(self):
+        """ Update the directory index. Safe to call from a watcher
+            thread; pass the result to apply() on the GUI thread.
+            Returns (added, removed, changed, columns).
+        """
+        added, removed, changed = self.index.update()
+        return added, removed, changed, self.index.columns
+
+
+    def apply(self, changes):
+        """ Rebuild the stimulus table after a rescan and drop
+            cached buffers of removed or modified files. Returns
+            the full paths of those files.
+        """
+        added, removed, changed, columns = changes
+        stale = [self.index.path(x) for x in removed + changed]
+        for path in stale:
+            self.cache.discard(path)
+        self._build(columns)
+        return stale
+
+
+    def _build(self, columns):
+        """ Create the sorted stimulus table from index columns """
+        prefix = os.path.join(self.index.directory, '')
+        paths = [prefix + x for x in columns['name'].tolist()]
         # Get trailing underscore value from file name
         try:
             # Convert 'Parameter' value to integer
-            self.fields['Parameter'] = [int(x.split("_")[-1][:-4]) for x in self.fields["Audio List"]]
-        except:
-            self.fields['Parameter'] = [x.split("_")[-1][:-4] for x in self.fields["Audio List"]]
-        # Create dataframe
-        self.audio_data = pd.DataFrame(self.fields)
-        # Sort dataframe by Parameter
-        self.audio_data = self.audio_data.sort_values(by='Parameter').reset_index(drop=True)
-        print("Models_52: Audio file data frame loaded into AudioList model")
-        print(self.audio_data)
-
-
-class CSVModel:
-    """ CSV file storage """
-    def __init__(self, sessionpars):
+            parameters = columns['parameter'].astype(np.int64)
+        except (TypeError, ValueError):
+            parameters = columns['parameter']
+        # Per-channel RMS is stored in the index, so presentation
+        # only has to apply a gain; the cache looks values up in
+        # the table when it needs them
+        self.table = StimulusTable(paths, parameters, columns['rms'],
+            counts=columns['channels'], 
+            signatures=(columns['mtime_ns'], columns['size']))
+        self.cache.table = self.table
+        trace.info("Models_52: Stimulus table loaded into AudioList model " +
+            "(%d files)", len(self.table))
+
+
+    def off_rate(self, samplerate, max_bytes=None):
+        """ Paths of the files that are not at SAMPLERATE. With 
+            MAX_BYTES, only as many as fit in that many bytes 
+            once resampled (float64).
+        """
+        if not samplerate or not hasattr(self, 'index'):
+            return []
+        return [self.index.path(x) for x in 
+            self.index.off_rate(samplerate, max_bytes)]
+
+
+    @property
+    def audio_data(self):
+        """ DataFrame view of the stimulus table """
+        return self.table.frame()
+
+
+class RecordModel:
+    """ Shared record formatting for the data storage models """
+    # Fields to remove before saving
+    exclude = (
+        'audio_files_path', # Don't care about directory
+        'button_id', # Don't care about last button pressed
+        'calibration_file', # Don't care about calibration file
+        'block_size', # Don't care about stream settings
+        'output_latency',
+        'record_latency',
+        'data_format', # Don't care about storage backend
+        'watch_audio_files'
+    )
 
+    # Data dictionary
+    fields = {
+        "Audio Filename": {'req': True}
+        }
+
+    def __init__(self, sessionpars):
         # Initialize session parameter dictionary
         self.sessionpars = sessionpars
 
         # Generate date stamp
         self.datestamp = datetime.now().strftime("%Y_%b_%d_%H%M")
 
-    # Data dictionary
-    fields = {
-        "Audio Filename": {'req': True}
-        }
+        # Formatted keys, filled in as new keys are seen
+        self._keymap = dict()
 
-    
-    def save_record(self, data):
-        """ Save a dictionary of data to .csv file 
+
+    def _format_key(self, key):
+        """ Make key lowercase and replace spaces with underscores """
+        try:
+            return self._keymap[key]
+        except KeyError:
+            formatted = key.lower().replace(' ', '_')
+            self._keymap[key] = formatted
+            return formatted
+
+
+    def format_record(self, data):
+        """ Combine DATA with the session parameters into a flat 
+            dictionary with formatted keys
         """
-        # Create file name and path
-        filename = f"{self.datestamp}_{self.sessionpars['Condition'].get()}_{self.sessionpars['Subject'].get()}.csv"
-        self.file = Path(filename)
+        all_data = self.session_record()
+        all_data.update(self.trial_record(data))
+        return all_data
 
-        # Check for write access to store csv
-        file_exists = os.access(self.file, os.F_OK)
-        parent_writable = os.access(self.file.parent, os.W_OK)
-        file_writable = os.access(self.file, os.W_OK)
-        if (
-            (not file_exists and not parent_writable) or
-            (file_exists and not file_writable)
-        ):
-            msg = f"Permission denied accessing file: {filename}"
-            raise PermissionError(msg)
 
-        # Combine rating data and session parameters
-        # 1. Create temp sessionpars dict to avoid changing runtime vals
-        # 2. Get actual sessionpars values (not tk controls)
-        temp_sessionpars = dict()
-        for key in self.sessionpars:
-            temp_sessionpars[key] = self.sessionpars[key].get()
+    def session_record(self):
+        """ Session parameters as a dictionary with formatted 
+            keys (without the excluded fields)
+        """
+        all_data = dict()
+        # Get actual sessionpars values (not tk controls)
+        for key, variable in self.sessionpars.items():
+            all_data[self._format_key(key)] = variable.get()
 
-        # Add rating data to the end of the sessionpars dict
-        temp_sessionpars.update(data)
+        # Fields to remove from dictionary before saving it
+        for key in self.exclude:
+            all_data.pop(key, None)
+        return all_data
 
-        # Reformat dict keys for easy import
-        keys = temp_sessionpars.keys()
-        # Make all lowercase and replace spaces with underscores
-        keys_formatted = [x.lower().replace(' ', '_') for x in keys]
 
-        # Make a new dictionary with the formatted keys
+    def trial_record(self, data):
+        """ Rating DATA as a dictionary with formatted keys, plus
+            the filename value
+        """
         all_data = dict()
-        for idx, key in enumerate(keys):
-            all_data[keys_formatted[idx]] = temp_sessionpars[key]
+        for key, value in data.items():
+            all_data[self._format_key(key)] = value
 
         # Fields to remove from dictionary before saving it
-        all_data.pop('audio_files_path') # Don't care about directory
-        all_data.pop('button_id') # Don't care about last button pressed
-        all_data.pop('calibration_file') # Don't care about calibration file
+        for key in self.exclude:
+            all_data.pop(key, None)
 
         # Create new field for trailing underscore naming
         # See naming convention info above
@@ -119,18 +1100,453 @@ class CSVModel:
         # Remove .wav file extension
         filename_val = filename_val[:-4]
         all_data["filename_value"] = filename_val
+        return all_data
 
-        # Save combined dict to file
-        newfile = not self.file.exists()
-        with open(self.file, 'a', newline='') as fh:
-            csvwriter = csv.DictWriter(fh, fieldnames=all_data.keys())
-            if newfile:
-                csvwriter.writeheader()
-            csvwriter.writerow(all_data)
+
+    def close(self):
+        """ Finish writing. Nothing to do by default. """
+
+
+class CSVModel(RecordModel):
+    """ CSV file storage.
+
+        The file for the current subject and condition is opened 
+        once and kept open. Records are formatted on the calling
+        thread (Tk variables are not thread-safe) and written by
+        a background thread, so save_record returns right away.
+
+        FLUSH_RECORDS: flush after this many records
+        FLUSH_MS: also flush when this many ms have passed since 
+            the last flush (None to disable)
+        FSYNC: force flushed data to disk with os.fsync
+        DIRECTORY: folder for the .csv files
+    """
+    # Added to the file name before .csv
+    file_suffix = ''
+
+    def __init__(self, sessionpars, flush_records=1, flush_ms=None, 
+        fsync=False, directory='.'):
+        super().__init__(sessionpars)
+        self.directory = Path(directory)
+
+        # Flush policy
+        self.flush_records = flush_records
+        self.flush_ms = flush_ms
+        self.fsync = fsync
+
+        # (condition, subject) of the file that was checked last
+        self._session = None
+        self.file = None
+
+        # Writer thread state
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = None
+
+
+    def _check_file(self):
+        """ Resolve the file for the current subject/condition and
+            check write access (once per file)
+        """
+        session = (self.sessionpars['Condition'].get(), 
+            self.sessionpars['Subject'].get())
+        if session == self._session:
+            return self.file
+
+        # Create file name and path
+        filename = f"{self.datestamp}_{session[0]}_{session[1]}" + \
+            f"{self.file_suffix}.csv"
+        file = self.directory / filename
+
+        # Check for write access to store csv
+        file_exists = os.access(file, os.F_OK)
+        parent_writable = os.access(file.parent, os.W_OK)
+        file_writable = os.access(file, os.W_OK)
+        if (
+            (not file_exists and not parent_writable) or
+            (file_exists and not file_writable)
+        ):
+            msg = f"Permission denied accessing file: {filename}"
+            raise PermissionError(msg)
+
+        self._session = session
+        self.file = file
+        return file
+
+
+    def save_record(self, data):
+        """ Queue a dictionary of data to be saved to .csv file 
+        """
+        if self._error is not None:
+            raise self._error
+        file = self._check_file()
+        all_data = self.format_record(data)
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put((file, all_data))
+
+
+    def close(self):
+        """ Write all queued records and close the file """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise self._error
+
+
+    def _run(self):
+        """ Writer thread: append queued records to the file """
+        fh = None
+        writer = None
+        current = None
+        columns = set()
+        pending = 0
+        last_flush = time.monotonic()
+        timeout = None if self.flush_ms is None else self.flush_ms / 1000
+
+        def flush():
+            fh.flush()
+            if self.fsync:
+                os.fsync(fh.fileno())
+
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = False
+
+                if item:
+                    file, all_data = item
+                    # Reopen for a new file or when the record
+                    # brings new columns (the header is widened)
+                    if file != current or not columns.issuperset(all_data):
+                        if fh is not None:
+                            flush()
+                            fh.close()
+                            fh = None
+                        fh, writer = self._open(file, all_data)
+                        columns = set(writer.fieldnames)
+                        current = file
+                    writer.writerow(all_data)
+                    pending += 1
+
+                if fh is not None and pending and (
+                    item is None or
+                    pending >= self.flush_records or (
+                        self.flush_ms is not None and
+                        time.monotonic() - last_flush >= self.flush_ms / 1000)
+                ):
+                    flush()
+                    pending = 0
+                    last_flush = time.monotonic()
+
+                if item is None:
+                    break
+        except Exception as e:
+            self._error = e
+        finally:
+            if fh is not None:
+                fh.close()
+
+
+    @classmethod
+    def _open(cls, file, all_data):
+        """ Open FILE for appending and resolve its header. Keys
+            of ALL_DATA that are not in the header are added to it
+            (existing rows get empty values).
+        """
+        newfile = not file.exists() or file.stat().st_size == 0
+        if newfile:
+            fieldnames = list(all_data.keys())
+        else:
+            # Keep the column order of the existing file
+            with open(file, 'r', newline='') as fh:
+                fieldnames = next(csv.reader(fh))
+            missing = [x for x in all_data if x not in fieldnames]
+            if missing:
+                fieldnames += missing
+                cls._rewrite(file, fieldnames)
+        fh = open(file, 'a', newline='')
+        writer = csv.DictWriter(fh, fieldnames=fieldnames, restval='')
+        if newfile:
+            writer.writeheader()
+        return fh, writer
+
+
+    @staticmethod
+    def _rewrite(file, fieldnames):
+        """ Rewrite FILE (atomically) with the header FIELDNAMES """
+        tmp = file.with_name(file.name + '.tmp')
+        with open(file, 'r', newline='') as src, \
+            open(tmp, 'w', newline='') as dst:
+            writer = csv.DictWriter(dst, fieldnames=fieldnames, restval='')
+            writer.writeheader()
+            writer.writerows(csv.DictReader(src))
+        os.replace(tmp, file)
+
+
+class NormalizedCSVModel(CSVModel):
+    """ CSV storage without repeated session parameters.
+
+        Session parameters are written once to a sidecar file
+        ({datestamp}_{condition}_{subject}_session.json) and each
+        trial row in {datestamp}_{condition}_{subject}_trials.csv
+        only holds the rating data and a 'session' column. If the
+        parameters change during a session (e.g., a new 
+        calibration), a new entry is added to the sidecar and 
+        later rows refer to it.
+
+        Use load_normalized() to get the wide form written by 
+        CSVModel.
+    """
+    file_suffix = '_trials'
+
+    def __init__(self, sessionpars, **kwargs):
+        super().__init__(sessionpars, **kwargs)
+        # Trials file, its sidecar and the sidecar entries
+        self._trials = None
+        self._sidecar = None
+        self._segments = []
+        # Raw session values of the last entry
+        self._raw = None
+
+
+    def save_record(self, data):
+        """ Queue a trial row, updating the sidecar first if the
+            session parameters changed
+        """
+        if self._error is not None:
+            raise self._error
+        file = self._check_file()
+        if file != self._trials:
+            self._trials = file
+            self._sidecar = sidecar_path(file)
+            self._segments = read_sidecar(self._sidecar)
+            self._raw = None
+
+        # Only format the session parameters when they changed
+        raw = tuple(variable.get() for variable in self.sessionpars.values())
+        if raw != self._raw:
+            values = self.session_record()
+            if not self._segments or self._segments[-1]['values'] != values:
+                self._segments.append({'values': values})
+                self._write_sidecar()
+            self._raw = raw
+
+        row = {'session': len(self._segments) - 1}
+        row.update(self.trial_record(data))
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put((file, row))
+
+
+    def _write_sidecar(self):
+        """ Replace the sidecar file (atomically) """
+        tmp = self._sidecar.with_name(self._sidecar.name + '.tmp')
+        with open(tmp, 'w') as fh:
+            json.dump({'segments': self._segments}, fh, indent=1)
+        os.replace(tmp, self._sidecar)
+
+
+def sidecar_path(trials_file):
+    """ Session sidecar of a NormalizedCSVModel trials file """
+    trials_file = Path(trials_file)
+    stem = trials_file.stem
+    if stem.endswith(NormalizedCSVModel.file_suffix):
+        stem = stem[:-len(NormalizedCSVModel.file_suffix)]
+    return trials_file.with_name(f"{stem}_session.json")
+
+
+def read_sidecar(path):
+    """ Session entries of a sidecar file (empty if missing) """
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh)['segments']
+    except FileNotFoundError:
+        return []
+
+
+def load_normalized(trials_file):
+    """ Re-join a NormalizedCSVModel trials file with its session
+        sidecar. Returns a DataFrame in the wide form written by
+        CSVModel (session parameters, then trial data).
+    """
+    import io
+    import pandas as pd
+    trials = pd.read_csv(trials_file)
+    segments = read_sidecar(sidecar_path(trials_file))
+    # Parse the session values as read_csv parses a wide file, 
+    # so both forms give the same column types
+    session = pd.read_csv(io.StringIO(pd.DataFrame(
+        [x['values'] for x in segments]).to_csv(index=False)))
+    session_cols = list(session.columns)
+    session['session'] = range(len(segments))
+    wide = trials.merge(session, on='session', how='left', sort=False)
+    trial_cols = [x for x in trials.columns if x != 'session' and 
+        x not in session_cols]
+    return wide[session_cols + trial_cols]
+
+
+class SQLiteModel(RecordModel):
+    """ SQLite storage for all subjects and sessions.
+
+        Trials are written to a single database through one
+        persistent connection in WAL mode. Each trial keeps the 
+        full record (as JSON, in column order), so export_csv
+        can reproduce the per-session CSV files written by 
+        CSVModel (from the command line: python export.py).
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS subjects (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            subject_id INTEGER NOT NULL REFERENCES subjects(id),
+            condition TEXT NOT NULL,
+            datestamp TEXT NOT NULL,
+            UNIQUE (subject_id, condition, datestamp)
+        );
+        CREATE TABLE IF NOT EXISTS trials (
+            id INTEGER PRIMARY KEY,
+            session_id INTEGER NOT NULL REFERENCES sessions(id),
+            trial INTEGER NOT NULL,
+            audio_filename TEXT,
+            filename_value TEXT,
+            record TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_subject 
+            ON sessions (subject_id);
+        CREATE INDEX IF NOT EXISTS trials_session 
+            ON trials (session_id, trial);
+        CREATE INDEX IF NOT EXISTS trials_filename_value
+            ON trials (filename_value);
+    """
+
+    def __init__(self, sessionpars, db_path='adaptive_rating.db'):
+        super().__init__(sessionpars)
+        self.db_path = Path(db_path)
+
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.conn.executescript(self.schema)
+
+        # (condition, subject) -> (session id, trial count)
+        self._sessions = dict()
+
+
+    def _session_id(self):
+        """ Get (or create) the row id of the current session """
+        key = (self.sessionpars['Condition'].get(), 
+            self.sessionpars['Subject'].get())
+        if key in self._sessions:
+            return key
+
+        condition, subject = key
+        cur = self.conn.cursor()
+        cur.execute('INSERT OR IGNORE INTO subjects (name) VALUES (?)', 
+            (subject,))
+        cur.execute('SELECT id FROM subjects WHERE name = ?', (subject,))
+        subject_id = cur.fetchone()[0]
+        cur.execute('INSERT OR IGNORE INTO sessions '
+            '(subject_id, condition, datestamp) VALUES (?, ?, ?)', 
+            (subject_id, condition, self.datestamp))
+        cur.execute('SELECT id FROM sessions WHERE subject_id = ? AND '
+            'condition = ? AND datestamp = ?', 
+            (subject_id, condition, self.datestamp))
+        session_id = cur.fetchone()[0]
+        cur.execute('SELECT COUNT(*) FROM trials WHERE session_id = ?', 
+            (session_id,))
+        self._sessions[key] = [session_id, cur.fetchone()[0]]
+        return key
+
+
+    def save_record(self, data):
+        """ Save a dictionary of data as a new trial """
+        all_data = self.format_record(data)
+        key = self._session_id()
+        session = self._sessions[key]
+        session[1] += 1
+        with self.conn:
+            self.conn.execute('INSERT INTO trials (session_id, trial, '
+                'audio_filename, filename_value, record) '
+                'VALUES (?, ?, ?, ?, ?)', 
+                (session[0], session[1], all_data['audio_filename'],
+                all_data['filename_value'], json.dumps(all_data)))
+
+
+    def close(self):
+        """ Close the database connection """
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+    def trials(self, subject=None):
+        """ Return a list of records (dicts), optionally only for
+            SUBJECT, in session and trial order
+        """
+        query = ('SELECT t.record FROM trials t '
+            'JOIN sessions s ON s.id = t.session_id '
+            'JOIN subjects p ON p.id = s.subject_id ')
+        args = ()
+        if subject is not None:
+            query += 'WHERE p.name = ? '
+            args = (subject,)
+        query += 'ORDER BY s.id, t.trial'
+        return [json.loads(row[0]) for row in self.conn.execute(query, args)]
+
+
+    def export_csv(self, directory='.', subject=None):
+        """ Write one CSV file per session in the layout used by 
+            CSVModel: {datestamp}_{condition}_{subject}.csv.
+            Returns the list of files written.
+        """
+        query = ('SELECT s.id, s.datestamp, s.condition, p.name '
+            'FROM sessions s JOIN subjects p ON p.id = s.subject_id ')
+        args = ()
+        if subject is not None:
+            query += 'WHERE p.name = ? '
+            args = (subject,)
+        written = []
+        for session_id, datestamp, condition, name in \
+            self.conn.execute(query, args).fetchall():
+            records = [json.loads(row[0]) for row in self.conn.execute(
+                'SELECT record FROM trials WHERE session_id = ? '
+                'ORDER BY trial', (session_id,))]
+            if not records:
+                continue
+            # Column order of the first record, plus any added later
+            fieldnames = list(records[0].keys())
+            for record in records[1:]:
+                fieldnames += [x for x in record if x not in fieldnames]
+            file = Path(directory) / f"{datestamp}_{condition}_{name}.csv"
+            with open(file, 'w', newline='') as fh:
+                writer = csv.DictWriter(fh, fieldnames=fieldnames, 
+                    restval='')
+                writer.writeheader()
+                writer.writerows(records)
+            written.append(file)
+        return written
 
 
 class SessionParsModel:
-    """ A model for saving session parameters 
+    """ A model for saving session parameters.
+
+        Changed fields are marked dirty and written together
+        SAVE_DELAY seconds after save() (flush() writes at once).
+        The settings file holds named profiles, e.g. one per lab
+        setup; use_profile() switches between them.
     """
     # Define dictionary items
     fields = {
@@ -143,56 +1559,187 @@ class SessionParsModel:
         'Raw Level': {'type': 'float', 'value': -50},
         'SLM Reading': {'type': 'float', 'value': 70},
         'Adjusted Presentation Level': {'type': 'float', 'value': -50},
-        'Calibration File': {'type': 'str', 'value': 'cal_stim.wav'}
+        'Calibration File': {'type': 'str', 'value': 'cal_stim.wav'},
+        'Block Size': {'type': 'int', 'value': 0},
+        'Output Latency': {'type': 'str', 'value': 'low'},
+        'Record Latency': {'type': 'bool', 'value': False},
+        'Data Format': {'type': 'str', 'value': 'csv'},
+        'Watch Audio Files': {'type': 'bool', 'value': False},
+        'Track Mode': {'type': 'str', 'value': 'staircase'}
     }
 
-    def __init__(self):
+    # Seconds to wait before writing changed settings
+    SAVE_DELAY = 1.0
+    DEFAULT_PROFILE = 'default'
+
+    def __init__(self, profile=None, filepath=None, save_delay=None):
         filename = 'adaptive_rating_pars.json'
         # Store settings file in user's home directory
-        self.filepath = Path.home() / filename
+        self.filepath = Path(filepath) if filepath else Path.home() / filename
+        self.save_delay = self.SAVE_DELAY if save_delay is None else save_delay
+        # Each instance gets its own copy of the defaults
+        self.fields = {key: dict(field) for key, field in 
+            SessionParsModel.fields.items()}
+        # Profile name -> {key: value}, for the inactive profiles
+        self._profiles = dict()
+        self.profile = self.DEFAULT_PROFILE
+        # Keys changed since the last write, and completed writes
+        self.dirty = set()
+        self.writes = 0
+        self._lock = threading.Lock()
+        # One writer at a time (timer thread or caller)
+        self._write_lock = threading.Lock()
+        self._timer = None
         # Load settings file
         self.load()
+        if profile is not None and profile != self.profile:
+            self.use_profile(profile)
 
 
     def load(self):
         """ Load the settings from the file """
-        print("Models_157: Checking for pars file...")
+        trace.debug("Models_157: Checking for pars file...")
         # If the file doesn't exist, abort
         if not self.filepath.exists():
             return
 
         # Open the file and read in the raw values
-        print("Models_163: File found - reading raw vals from pars file...")
+        trace.debug("Models_163: File found - reading raw vals from pars file...")
         with open(self.filepath, 'r') as fh:
             raw_values = json.load(fh)
 
+        if 'profiles' in raw_values:
+            self.profile = raw_values.get('profile', self.DEFAULT_PROFILE)
+            self._profiles = dict(raw_values['profiles'])
+            raw_values = self._profiles.pop(self.profile, {})
+        else:
+            # Settings file from an earlier version: one profile
+            # with {key: {'type':, 'value':}} entries
+            raw_values = {key: value['value'] for key, value in 
+                raw_values.items() if isinstance(value, dict) and 
+                'value' in value}
+
         # Don't implicitly trust the raw values; only get known keys
-        print("Models_168: Loading vals into sessionpars model if they match model keys")
+        trace.debug("Models_168: Loading vals into sessionpars model if they match model keys")
+        self._apply(raw_values)
+
+
+    def _apply(self, values):
+        """ Use the known keys of VALUES """
         for key in self.fields:
-            if key in raw_values and 'value' in raw_values[key]:
-                raw_value = raw_values[key]['value']
-                self.fields[key]['value'] = raw_value
+            if key in values:
+                self.fields[key]['value'] = values[key]
+
+
+    def _values(self):
+        return {key: field['value'] for key, field in self.fields.items()}
 
 
     def save(self):
-        """ Save the current settings to the file """
-        print("Models_177: Writing session pars from model to file...")
-        with open(self.filepath, 'w') as fh:
-            json.dump(self.fields, fh)
+        """ Write changed settings to the file after SAVE_DELAY
+            seconds. Calls within the delay are coalesced into
+            one write.
+        """
+        with self._lock:
+            if not self.dirty or self._timer is not None:
+                return
+            if self.save_delay <= 0:
+                self._timer = None
+            else:
+                self._timer = threading.Timer(self.save_delay, 
+                    self._flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self.flush()
+
+
+    def _flush_later(self):
+        """ Debounced write (runs on the timer thread) """
+        try:
+            self.flush()
+        except OSError as e:
+            trace.warning("SessionParsModel: Could not save settings: %s", e)
+
+
+    def flush(self):
+        """ Write the settings now if anything changed. The file 
+            is replaced atomically (temp file, then rename).
+        """
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self.dirty:
+                    return
+                dirty = set(self.dirty)
+                self.dirty.clear()
+                profiles = dict(self._profiles)
+                profiles[self.profile] = self._values()
+                data = {'profile': self.profile, 'profiles': profiles}
+
+            trace.info("Models_177: Writing session pars from model to file...")
+            tmp = self.filepath.with_name(self.filepath.name + '.tmp')
+            try:
+                with open(tmp, 'w') as fh:
+                    json.dump(data, fh, indent=1)
+                os.replace(tmp, self.filepath)
+                self.writes += 1
+            except OSError:
+                # Try again on the next save
+                with self._lock:
+                    self.dirty |= dirty
+                raise
 
 
     def set(self, key, value):
-        """ Set a variable value """
-        print("Models_184: Setting sessionpars model fields with running vals...")
+        """ Set a variable value (marks it for saving if it 
+            changed)
+        """
         if (
             key in self.fields and 
             type(value).__name__ == self.fields[key]['type']
         ):
-            self.fields[key]['value'] = value
+            if self.fields[key]['value'] != value:
+                trace.debug("Models_184: Setting sessionpars model field %s", 
+                    key)
+                self.fields[key]['value'] = value
+                self.dirty.add(key)
         else:
             raise ValueError("Bad key or wrong variable type")
 
 
+    def profiles(self):
+        """ Names of all saved profiles """
+        return sorted(set(self._profiles) | {self.profile})
+
+
+    def use_profile(self, name):
+        """ Switch to profile NAME. A new profile starts with the
+            current values.
+        """
+        if name == self.profile:
+            return
+        with self._lock:
+            self._profiles[self.profile] = self._values()
+            self._apply(self._profiles.pop(name, {}))
+            self.profile = name
+            # The active profile is stored in the file
+            self.dirty.add('profile')
+        self.save()
+
+
+    def delete_profile(self, name):
+        """ Remove an inactive profile """
+        if name == self.profile:
+            raise ValueError("Cannot delete the active profile")
+        with self._lock:
+            if self._profiles.pop(name, None) is not None:
+                self.dirty.add('profile')
+        self.save()
+
+
 class Audio:
     """ An object for use with .wav files. Audio objects 
         can read a given .wav file, handle audio data type 
@@ -207,78 +1754,96 @@ class Audio:
         'uint8': (0, 255)
     }
 
-    def __init__(self, file_path, level):
+    def __init__(self, file_path, level, cache=None):
         # Parse file path
         self.directory = file_path.split(os.sep) # path only
         self.name = str(file_path.split(os.sep)[-1]) # file name only
         self.file_path = file_path
         self.level = level
-
-        # Read audio file
-        fs, audio_file = wavfile.read(self.file_path)
+        self.scaled = False
+        # Decoded buffers (shared process-wide unless a session
+        # brings its own cache)
+        self.cache = cache or stimulus_cache
+
+        # Use an already scaled (or pre-rendered) buffer if 
+        # there is one; otherwise read the audio file (as float64)
+        # from the stimulus cache
+        scaled = self.cache.get_scaled(file_path, level, decode=False)
+        if scaled is not None:
+            self.fs, self.data_type, self.working_audio = scaled
+            self.scaled = True
+        else:
+            self.convert_to_float()
 
         # Get number of channels
         try:
-            self.channels = audio_file.shape[1]
+            self.channels = self.working_audio.shape[1]
         except IndexError:
             self.channels = 1
-        print(f"Number of channels: {self.channels}")
+        trace.debug("Number of channels: %s", self.channels)
 
         # Assign audio file attributes
-        self.fs = fs
-        self.original_audio = audio_file
-        self.dur = len(self.original_audio) / self.fs
+        self.dur = len(self.working_audio) / self.fs
         self.t = np.arange(0, self.dur, 1/self.fs)
 
-        # Get data type
-        #self.data_type = np.dtype(audio_file[0])
-        self.data_type = audio_file.dtype
-        print(f"Incoming audio data type: {self.data_type}")
-
-        # Immediately convert to float64 for processing
-        self.convert_to_float()
+        trace.debug("Incoming audio data type: %s", self.data_type)
 
 
     def convert_to_float(self):
-        """ Convert original audio data type to float64 
-            for processing
+        """ Get float64 audio for processing, at the output 
+            sample rate. Decoding, conversion and resampling are
+            cached process-wide, so repeated presentations of a 
+            file skip the disk read.
         """
-        if self.data_type == 'float64':
-            self.working_audio = self.original_audio
-        else:
-            # 1. Convert to float64
-            sig = self.original_audio.astype(np.float64)
-            # 2. Divide by original dtype max val
-            sig = sig / self.wav_dict[str(self.data_type)][1]
-            self.working_audio = sig
+        self.fs, self.data_type, self.working_audio = \
+            self.cache.get_resampled(self.file_path)
 
 
-    def play(self, device_id, channels):
-        """ Present working audio """
+    def play(self, device_id, channels, engine=None):
+        """ Present working audio. With an ENGINE (see 
+            audioengine.AudioEngine) the scaled buffer is queued
+            on its persistent stream and the Voice is returned.
+        """
         #print(f"Presenting audio data type: {np.dtype(self.working_audio[0])}")
-        print(f"Presenting audio data type: {self.working_audio.dtype}")
+        trace.debug("Presenting audio data type: %s", self.working_audio.dtype)
         # plt.subplot(1,3,1)
         # plt.plot(self.original_audio)
         # plt.subplot(1,3,2)
         # plt.plot(self.working_audio)
 
-        sd.default.device = device_id
+        self.scale()
+        if engine is not None:
+            return engine.play(self.working_audio, self.fs, device_id, 
+                channels)
 
-        if self.channels == 1:
-            sig = self.setRMS(self.working_audio, self.level)
-            self.working_audio = sig
-        elif self.channels > 1:
-            left = self.setRMS(self.working_audio[:,0], self.level)
-            right = self.setRMS(self.working_audio[:,1], self.level)
-            self.working_audio = np.array([left, right])
         # plt.subplot(1,3,3)
         # plt.plot(self.working_audio)
         # plt.show()
 
-        sd.play(self.working_audio.T, self.fs, mapping=channels)
+        # Pass the device explicitly: sd.default.device is
+        # process-wide and would be shared between sessions
+        import sounddevice as sd
+        sd.play(self.working_audio, self.fs, mapping=channels, 
+            device=device_id)
         #sd.wait(self.dur+0.5)
 
 
+    def scale(self):
+        """ Apply the presentation level to the working audio.
+            Only the first call has an effect, so an object 
+            scaled ahead of time (see Prefetcher) is played 
+            as-is.
+        """
+        if self.scaled:
+            return
+
+        # Each channel is set to the presentation level using 
+        # the RMS values precomputed by the stimulus cache
+        self.fs, _, self.working_audio = self.cache.get_scaled(
+            self.file_path, self.level)
+        self.scaled = True
+
+
     def convert_to_original(self):
         """ Convert back to original audio data type """
         # 1. Multiply float64 by original data type max
@@ -288,7 +1853,7 @@ class Audio:
             sig = np.round(sig)
         # 3. Convert back to original data type
         sig = sig.astype(self.data_type)
-        print(f"Converted data type: {str(type(sig[0]))}")
+        trace.debug("Converted data type: %s", sig.dtype)
         self.working_audio = sig
 
 
@@ -296,29 +1861,23 @@ class Audio:
     def db2mag(db):
         """ 
             Convert decibels to magnitude. Takes a single
-            value or a list of values.
+            value or a list of values (returned as an array).
         """
         # Must use this form to handle negative db values!
-        try:
-            mag = [10**(x/20) for x in db]
-            return mag
-        except:
-            mag = 10**(db/20)
-            return mag
+        if np.ndim(db):
+            return 10**(np.asarray(db, dtype=np.float64)/20)
+        mag = 10**(db/20)
+        return mag
 
 
     @staticmethod
     def mag2db(mag):
         """ 
             Convert magnitude to decibels. Takes a single
-            value or a list of values.
+            value or a list of values (returned as an array).
         """
-        try:
-            db = [20 * np.log10(x) for x in mag]
-            return db
-        except:
-            db = 20 * np.log10(mag)
-            return db
+        db = 20 * np.log10(mag)
+        return db
 
 
     def rms(self, sig):
@@ -340,6 +1899,7 @@ class Audio:
     def setRMS(self, sig, amp, eq='n'):
         """
             Set RMS level of a 1-channel or 2-channel signal.
+            See apply_level for any number of channels.
         
             SIG: a 1-channel or 2-channel signal
             AMP: the desired amplitude to be applied to 
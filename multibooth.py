@@ -0,0 +1,139 @@
+""" Multi-booth mode for Adaptive Rating
+
+    Serve several sound booths from one workstation. Each booth
+    gets its own window (to place on the booth's monitor) and a
+    booth.Booth session with its own output device, speaker
+    mapping, calibration, stimulus cache and CSV file.
+
+    Usage:
+        python multibooth.py booths.json
+
+    booths.json holds one entry per booth with the session
+    parameters that differ from the saved settings, e.g.:
+
+        [
+            {"name": "Booth A", "data_dir": "data/a",
+             "Subject": "101", "Audio Device ID": 3,
+             "Speaker Number": 1, "Raw Level": -50,
+             "SLM Reading": 72.5},
+            {"name": "Booth B", "data_dir": "data/b",
+             "Subject": "102", "Audio Device ID": 5,
+             "Speaker Number": 1, "Raw Level": -50,
+             "SLM Reading": 70.1}
+        ]
+"""
+
+# Import GUI packages
+import tkinter as tk
+from tkinter import ttk
+from tkinter import messagebox
+
+# Import system packages
+import json
+import os
+import sys
+
+# Import custom modules
+import views as v
+import models as m
+from booth import Booth, booth_sessionpars
+from devices import DeviceInventory
+
+
+class BoothWindow(tk.Toplevel):
+    """ Participant window for one Booth """
+    def __init__(self, parent, booth, *args, **kwargs):
+        super().__init__(parent, *args, **kwargs)
+        self.booth = booth
+        self.title(f"Adaptive Rating Tool - {booth.name}")
+
+        self.main_frame = v.MainFrame(self, booth.model, booth.sessionpars)
+        self.main_frame.grid(row=1, column=0)
+        self.main_frame.bind('<<SaveRecord>>', self._on_submit)
+        self.main_frame.bind('<<RepeatAudio>>', self._repeat_audio)
+        self.main_frame.bind('<<PlayAudio>>', self._get_audio)
+
+        self.status = tk.StringVar(value="Trials Completed: 0")
+        ttk.Label(self, textvariable=self.status).grid(
+            sticky='w', padx=15, pady=(0,5))
+        self._records_saved = 0
+
+
+    def _get_audio(self, *_):
+        data = self.main_frame.get()
+        self.booth.press(data['Button ID'], self.main_frame.press_ns)
+        if self.booth.track.limit:
+            messagebox.showwarning(parent=self, title='Limit Reached!',
+                message="You are at the limit")
+
+
+    def _repeat_audio(self, *_):
+        self.booth.repeat(self.main_frame.press_ns)
+
+
+    def _on_submit(self, *_):
+        self.booth.submit(self.main_frame.get())
+        self._records_saved += 1
+        self.status.set(f"Trials Completed: {self._records_saved}")
+        self.main_frame.reset()
+
+
+def load_booths(config_file):
+    """ Create a Booth for each entry in CONFIG_FILE, starting
+        from the saved session parameters
+    """
+    with open(config_file, 'r') as fh:
+        config = json.load(fh)
+
+    defaults = {key: field['value'] for key, field in
+        m.SessionParsModel().fields.items()}
+    # Device sample rates, scanned once before the windows open
+    devices = DeviceInventory()
+    devices.refresh()
+    devices.wait()
+    booths = []
+    for ii, entry in enumerate(config):
+        entry = dict(entry)
+        name = entry.pop('name', f"Booth {ii + 1}")
+        data_dir = entry.pop('data_dir', '.')
+        os.makedirs(data_dir, exist_ok=True)
+        values = dict(defaults, **entry)
+        sessionpars = booth_sessionpars(**{key.replace(' ', '_'): value
+            for key, value in values.items()})
+        booth = Booth(name, sessionpars, data_dir=data_dir,
+            devices=devices)
+        if not booth.load_stimuli():
+            raise ValueError(f"Booth {name}: no audio files in " +
+                f"{sessionpars['Audio Files Path'].get()}")
+        booths.append(booth)
+    return booths
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print(__doc__)
+        return 1
+
+    booths = load_booths(argv[0])
+    root = tk.Tk()
+    root.title("Adaptive Rating Tool - Booths")
+    for booth in booths:
+        ttk.Label(root, text=f"{booth.name}: subject " +
+            f"{booth.sessionpars['Subject'].get()}, device " +
+            f"{booth.sessionpars['Audio Device ID'].get()}"
+            ).grid(sticky='w', padx=15, pady=2)
+        BoothWindow(root, booth)
+
+    def quit():
+        for booth in booths:
+            booth.close()
+        root.destroy()
+    ttk.Button(root, text="Quit", command=quit).grid(padx=15, pady=10)
+    root.protocol("WM_DELETE_WINDOW", quit)
+    root.mainloop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
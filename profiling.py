@@ -0,0 +1,109 @@
+""" Profiling mode for Adaptive Rating
+
+    Profiler wraps event handlers and model calls. While it is
+    enabled, each call is timed and the outermost call runs under
+    cProfile; while disabled, a wrapped call costs one attribute
+    check. At the end of a session write() saves:
+
+        <stem>_profile.prof   cProfile statistics (pstats,
+                              snakeviz, ...)
+        <stem>_profile.txt    slowest handlers and the functions
+                              with the most cumulative time
+
+    Profiling is switched on with Tools > Profiling or by setting
+    the ADAPTIVE_RATING_PROFILE environment variable (e.g., =1).
+"""
+
+# Import system packages
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+from time import perf_counter
+
+
+ENV_VAR = 'ADAPTIVE_RATING_PROFILE'
+
+
+class Profiler:
+    """ Deterministic profiler for wrapped calls (GUI thread) """
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = os.environ.get(ENV_VAR, '') not in ('', '0')
+        self.enabled = enabled
+        self._profile = cProfile.Profile()
+        # Name -> [calls, total s, max s]
+        self.timings = dict()
+        self._depth = 0
+        self._thread = threading.get_ident()
+
+
+    def wrap(self, name, func):
+        """ Return FUNC, profiled and timed as NAME when enabled """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled or threading.get_ident() != self._thread:
+                return func(*args, **kwargs)
+            return self._call(name, func, args, kwargs)
+        return wrapper
+
+
+    def _call(self, name, func, args, kwargs):
+        outer = self._depth == 0
+        self._depth += 1
+        if outer:
+            self._profile.enable()
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            if outer:
+                self._profile.disable()
+            self._depth -= 1
+            stats = self.timings.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+
+    def summary(self, top=20):
+        """ Text report of handler timings and the TOP functions
+            by cumulative time
+        """
+        lines = ["Slowest handlers (by max time)",
+            f"{'handler':<28}{'calls':>8}{'mean ms':>10}{'max ms':>10}" +
+            f"{'total s':>10}"]
+        ranked = sorted(self.timings.items(), key=lambda x: x[1][2],
+            reverse=True)
+        for name, (calls, total, longest) in ranked:
+            lines.append(f"{name:<28}{calls:>8}" +
+                f"{total / calls * 1000:>10.2f}{longest * 1000:>10.2f}" +
+                f"{total:>10.3f}")
+
+        stream = io.StringIO()
+        try:
+            stats = pstats.Stats(self._profile, stream=stream)
+        except TypeError:
+            # Nothing was profiled
+            return "\n".join(lines) + "\n"
+        stats.sort_stats('cumulative').print_stats(top)
+        lines += ["", f"Top {top} functions (by cumulative time)",
+            stream.getvalue()]
+        return "\n".join(lines)
+
+
+    def write(self, directory, stem):
+        """ Save the profile and its summary as DIRECTORY/STEM_
+            profile.prof and .txt. Returns the summary path, or
+            None if nothing was recorded.
+        """
+        if not self.timings:
+            return None
+        base = os.path.join(directory, f"{stem}_profile")
+        self._profile.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w') as fh:
+            fh.write(self.summary())
+        return base + '.txt'
@@ -0,0 +1,199 @@
+""" Offline pre-render of a calibrated stimulus set
+
+    Level-normalizes every .wav file in the Audio Files Path
+    to the Adjusted Presentation Level (as calculated by
+    Application._calc_level) using a process pool, and writes
+    float32 buffers at the output sample rate to:
+
+        ~/.adaptive_rating/render/<calibration hash>/
+
+    The hash covers the stimulus directory, level, sample rate
+    and format, so recalibrating (or changing device rate)
+    selects a different render automatically. At runtime the
+    stimulus cache loads rendered buffers instead of decoding
+    and scaling the original files.
+
+    Usage:
+        python render.py [--samplerate 48000] [--workers N]
+
+    Session parameters are read from the saved settings file.
+"""
+
+# Import system packages
+import argparse
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# Import data science packages
+import numpy as np
+
+# Import custom modules
+import models as m
+
+
+RENDER_ROOT = Path.home() / '.adaptive_rating' / 'render'
+RENDER_VERSION = 1
+MANIFEST = 'manifest.json'
+
+
+def calibration_hash(directory, level, samplerate, dtype='float32', eq='y'):
+    """ Key identifying one rendered stimulus set """
+    key = json.dumps([os.path.abspath(directory), float(level),
+        int(samplerate), dtype, eq, RENDER_VERSION])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def adjusted_level(fields):
+    """ Adjusted Presentation Level from session parameter fields,
+        as calculated by Application._calc_level
+    """
+    slm_offset = fields['SLM Reading']['value'] - fields['Raw Level']['value']
+    return fields['Presentation Level']['value'] - slm_offset
+
+
+def device_samplerate(device_id):
+    """ Default sample rate of DEVICE_ID, or 0 if unavailable """
+    try:
+        import sounddevice as sd
+        return int(sd.query_devices(device_id)['default_samplerate'])
+    except Exception:
+        return 0
+
+
+def render_file(job):
+    """ Render one file (runs in a worker process) """
+    source, target, level, samplerate, eq = job
+    fs, _, sig = m.read_wav(source)
+    if samplerate:
+        sig = m.resample(sig, fs, samplerate)
+        fs = samplerate
+    out = m.apply_level(sig, level, eq=eq)
+    np.save(target, out)
+    return fs
+
+
+def render(directory, level, samplerate=0, eq='y', workers=None):
+    """ Render every .wav file in DIRECTORY. SAMPLERATE 0 keeps
+        each file's own rate. Only new or changed files are
+        rendered again. Returns the render directory.
+    """
+    digest = calibration_hash(directory, level, samplerate, eq=eq)
+    out_dir = RENDER_ROOT / digest
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    rendered = RenderedSet.open(out_dir)
+    files = rendered.files if rendered else dict()
+
+    index = m.StimulusIndex(directory)
+    index.update()
+
+    jobs, sigs = [], []
+    columns = index.columns
+    for name, signature in zip(columns['name'].tolist(), 
+        zip(columns['mtime_ns'].tolist(), columns['size'].tolist())):
+        source = index.path(name)
+        old = files.get(source)
+        if old is not None and (old['mtime_ns'], old['size']) == signature:
+            continue
+        target = str(out_dir / (Path(name).stem + '.npy'))
+        jobs.append((source, target, level, samplerate, eq))
+        sigs.append(signature)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rates = list(pool.map(render_file, jobs, chunksize=8))
+
+    for job, signature, fs in zip(jobs, sigs, rates):
+        files[job[0]] = {'mtime_ns': signature[0], 'size': signature[1],
+            'file': os.path.basename(job[1]), 'fs': fs}
+    # Forget files that were removed from the stimulus directory
+    current = {index.path(x) for x in columns['name'].tolist()}
+    files = {k: v for k, v in files.items() if k in current}
+
+    manifest = {'directory': index.directory, 'level': float(level),
+        'samplerate': int(samplerate), 'eq': eq, 'dtype': 'float32',
+        'files': files}
+    tmp = out_dir / (MANIFEST + '.tmp')
+    with open(tmp, 'w') as fh:
+        json.dump(manifest, fh)
+    os.replace(tmp, out_dir / MANIFEST)
+    print(f"Rendered {len(jobs)} file(s) to {out_dir}")
+    return out_dir
+
+
+class RenderedSet:
+    """ A rendered stimulus set, used by models.StimulusCache """
+    def __init__(self, directory, manifest):
+        self.directory = Path(directory)
+        self.level = manifest['level']
+        self.eq = manifest['eq']
+        self.files = manifest['files']
+
+
+    @classmethod
+    def open(cls, directory):
+        """ Load the render in DIRECTORY, or None """
+        try:
+            with open(Path(directory) / MANIFEST, 'r') as fh:
+                return cls(directory, json.load(fh))
+        except (OSError, ValueError):
+            return None
+
+
+    @classmethod
+    def find(cls, directory, level, samplerate, eq='y'):
+        """ Load the render for this calibration, preferring
+            SAMPLERATE over files kept at their own rate
+        """
+        for rate in (samplerate, 0):
+            found = cls.open(RENDER_ROOT /
+                calibration_hash(directory, level, rate, eq=eq))
+            if found is not None:
+                return found
+        return None
+
+
+    def load(self, file_path, level, eq, signature):
+        """ Return (fs, 'float32', signal) for FILE_PATH, or None
+            if it was not rendered for this level or has changed
+        """
+        if level != self.level or eq != self.eq:
+            return None
+        info = self.files.get(os.path.abspath(file_path))
+        if info is None or (info['mtime_ns'], info['size']) != signature:
+            return None
+        try:
+            sig = np.load(self.directory / info['file'])
+        except OSError:
+            return None
+        return info['fs'], np.dtype('float32'), sig
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Pre-render the calibrated stimulus set")
+    parser.add_argument('--samplerate', type=int, default=None,
+        help="output rate (default: the audio device's rate; "
+            "0 keeps each file's rate)")
+    parser.add_argument('--workers', type=int, default=None,
+        help="number of worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+
+    fields = m.SessionParsModel().fields
+    directory = fields['Audio Files Path']['value']
+    if not os.path.isdir(directory):
+        print(f"Not a valid audio files directory: {directory}")
+        return 1
+    samplerate = args.samplerate
+    if samplerate is None:
+        samplerate = device_samplerate(fields['Audio Device ID']['value'])
+    render(directory, adjusted_level(fields), samplerate,
+        workers=args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+""" Monte Carlo simulated-listener benchmark for Adaptive Rating
+
+    Runs thousands of simulated listeners through the arrow
+    button staircase at once, as NumPy arrays, to compare step
+    size configurations (small, big) before running real
+    sessions.
+
+    Each listener has a preferred Parameter value and a
+    psychometric preference curve over the Parameter axis:
+        - the chance of submitting a stimulus falls off with
+          its distance from the preferred value
+        - the press direction follows a logistic function of
+          the signed distance
+        - a big step is used when the (noisy) perceived
+          distance exceeds BIG_THRESHOLD
+    The random start and clamping follow track.AdaptiveTrack.
+
+    Reported per configuration:
+        presses     mean presses until the rating was submitted
+        to_crit     mean presses until a stimulus within
+                    CRITERION of the preferred value was first
+                    presented (trials-to-criterion), among 
+                    listeners who got there
+        reached     share of listeners who got within CRITERION
+        bias        mean (submitted - preferred) value
+        abs_err     mean absolute error of the submitted value
+        done        share of listeners that submitted within
+                    MAX_PRESSES
+
+    Usage:
+        python simulate.py [--listeners 10000] [--steps 1,4 2,8]
+            [--audio-dir DIR | --n-files 200]
+"""
+
+# Import system packages
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Import data science packages
+import numpy as np
+
+
+# Default listener model (in Parameter units unless stated)
+LISTENER = {
+    'width': 5.0,           # width of the preference curve
+    'sharpness': 4.0,       # submit probability = preference ** sharpness
+    'spread': 2.0,          # slope of the direction decision
+    'big_threshold': 10.0,  # perceived distance for using big steps
+    'noise': 3.0,           # s.d. of perceived distance
+    'criterion': 2.0        # distance counted as "converged"
+}
+
+
+def simulate_listeners(values, small, big, n_listeners, seed,
+    max_presses=100, listener=None):
+    """ Run N_LISTENERS simulated listeners through one rating
+        each with step sizes SMALL and BIG (in list indices) on
+        the sorted Parameter VALUES. Returns per-listener arrays.
+    """
+    pars = dict(LISTENER, **(listener or {}))
+    rng = np.random.default_rng(seed)
+    values = np.asarray(values, dtype=np.float64)
+    last = len(values) - 1
+
+    # Preferred values away from the ends of the axis
+    margin = (values[-1] - values[0]) * 0.1
+    preferred = rng.uniform(values[0] + margin, values[-1] - margin,
+        n_listeners)
+    # Random start, never on the last file (as in AdaptiveTrack)
+    index = rng.integers(0, max(last, 1), n_listeners)
+
+    active = np.ones(n_listeners, dtype=bool)
+    presses = np.full(n_listeners, max_presses)
+    to_crit = np.full(n_listeners, np.nan)
+    reached = np.zeros(n_listeners, dtype=bool)
+
+    for press in range(max_presses + 1):
+        dist = values[index] - preferred
+
+        # Trials-to-criterion: first presentation close enough
+        close = active & ~reached & (np.abs(dist) <= pars['criterion'])
+        to_crit[close] = press
+        reached |= close
+
+        # Submit with probability given by the preference curve
+        pref = np.exp(-0.5 * (dist / pars['width'])**2)
+        submit = active & (rng.random(n_listeners) < pref**pars['sharpness'])
+        presses[submit] = press
+        active &= ~submit
+        if press == max_presses or not active.any():
+            break
+
+        # Direction: +1 moves towards higher Parameter values
+        p_up = 1 / (1 + np.exp(dist / pars['spread']))
+        direction = np.where(rng.random(n_listeners) < p_up, 1, -1)
+        perceived = np.abs(dist) + rng.normal(0, pars['noise'], n_listeners)
+        step = np.where(perceived > pars['big_threshold'], big, small)
+        index = np.where(active, np.clip(index + direction * step, 0, last),
+            index)
+
+    return {
+        'presses': presses,
+        'to_crit': to_crit,
+        'error': values[index] - preferred,
+        'done': ~active
+    }
+
+
+def _run_chunk(job):
+    """ Worker process: simulate one chunk of listeners """
+    values, small, big, n, seed, max_presses, listener = job
+    return (small, big), simulate_listeners(values, small, big, n, seed,
+        max_presses, listener)
+
+
+def sweep(values, steps, n_listeners=10000, max_presses=100, listener=None,
+    workers=None, seed=0):
+    """ Simulate every (small, big) step configuration in STEPS.
+        Listeners are split into chunks over a process pool.
+        Returns {(small, big): summary dict}.
+    """
+    workers = workers or os.cpu_count() or 1
+    n_chunks = max(1, min(workers, n_listeners // 1000))
+    sizes = np.full(n_chunks, n_listeners // n_chunks)
+    sizes[:n_listeners % n_chunks] += 1
+    seeds = np.random.SeedSequence(seed).spawn(len(steps) * n_chunks)
+
+    jobs = []
+    for ii, (small, big) in enumerate(steps):
+        for jj, size in enumerate(sizes):
+            jobs.append((values, small, big, int(size),
+                seeds[ii * n_chunks + jj], max_presses, listener))
+
+    parts = dict()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for key, result in pool.map(_run_chunk, jobs):
+            parts.setdefault(key, []).append(result)
+
+    summary = dict()
+    for key, results in parts.items():
+        joined = {x: np.concatenate([r[x] for r in results])
+            for x in results[0]}
+        summary[key] = {
+            'presses': joined['presses'].mean(),
+            'to_crit': np.nanmean(joined['to_crit']),
+            'reached': np.isfinite(joined['to_crit']).mean(),
+            'bias': joined['error'].mean(),
+            'abs_err': np.abs(joined['error']).mean(),
+            'done': joined['done'].mean()
+        }
+    return summary
+
+
+def load_parameters(audio_dir):
+    """ Sorted numeric Parameter values of a stimulus directory,
+        as built by models.AudioList
+    """
+    import models as m
+    index = m.StimulusIndex(audio_dir)
+    index.update(full=False)
+    return np.sort(index.columns['parameter'].astype(np.float64))
+
+
+def _parse_steps(text):
+    small, big = text.split(',')
+    return int(small), int(big)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Simulated-listener comparison of step sizes")
+    parser.add_argument('--listeners', type=int, default=10000)
+    parser.add_argument('--steps', type=_parse_steps, nargs='+',
+        default=[(1, 4), (1, 2), (1, 8), (2, 4), (2, 8)],
+        help="step size pairs as small,big (default: 1,4 1,2 1,8 2,4 2,8)")
+    parser.add_argument('--audio-dir', default=None,
+        help="take the Parameter axis from this stimulus directory")
+    parser.add_argument('--n-files', type=int, default=200,
+        help="otherwise use Parameter values 0..N-1")
+    parser.add_argument('--max-presses', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.audio_dir:
+        values = load_parameters(args.audio_dir)
+    else:
+        values = np.arange(args.n_files, dtype=np.float64)
+
+    summary = sweep(values, args.steps, args.listeners, args.max_presses,
+        workers=args.workers, seed=args.seed)
+
+    print(f"{args.listeners} listeners, {len(values)} stimuli")
+    print(f"{'steps':>8} {'presses':>8} {'to_crit':>8} {'reached':>8} " +
+        f"{'bias':>8} {'abs_err':>8} {'done':>6}")
+    for (small, big), s in summary.items():
+        print(f"{small:>3},{big:<4} {s['presses']:8.2f} {s['to_crit']:8.2f} " +
+            f"{s['reached']:8.1%} {s['bias']:8.2f} {s['abs_err']:8.2f} " +
+            f"{s['done']:6.1%}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+""" Structured tracing for Adaptive Rating
+
+    Replaces print statements on the presentation path with
+    leveled messages and timed spans:
+
+        trace = tracing.get_tracer('app')
+        trace.debug("Playing record #: %s", counter)
+        with trace.span('present', record=counter):
+            ...
+
+    Each module (tracer name) has its own level. Messages below
+    it are dropped before any formatting, and spans below it
+    are a shared no-op object, so disabled tracing costs about
+    one attribute lookup and comparison per call.
+
+    Enabled messages are printed and, like finished spans,
+    recorded in a fixed-size ring buffer (the newest
+    BUFFER_SIZE events are kept). export_chrome() writes them in
+    Chrome trace-event JSON (chrome://tracing, Perfetto).
+
+    Levels are set with configure() or the ADAPTIVE_RATING_TRACE
+    environment variable, e.g.:
+
+        ADAPTIVE_RATING_TRACE=info
+        ADAPTIVE_RATING_TRACE=warning,app=debug,models=info
+
+    The default is 'warning' for every module.
+"""
+
+# Import system packages
+import json
+import os
+import threading
+from collections import deque
+from time import perf_counter_ns
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+    'off': OFF
+}
+
+BUFFER_SIZE = 65536
+
+# (phase, module, name, start ns, duration ns, thread id, args)
+events = deque(maxlen=BUFFER_SIZE)
+_origin_ns = perf_counter_ns()
+_default_level = WARNING
+_module_levels = dict()
+_tracers = dict()
+_lock = threading.Lock()
+
+
+class _NoSpan:
+    """ Span returned when tracing is disabled """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        return False
+
+
+    def set(self, **args):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Span:
+    """ A timed region, recorded when the with-block exits """
+    __slots__ = ('module', 'name', 'args', 'start')
+
+    def __init__(self, module, name, args):
+        self.module = module
+        self.name = name
+        self.args = args
+        self.start = None
+
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+
+    def __exit__(self, *exc):
+        end = perf_counter_ns()
+        events.append(('X', self.module, self.name, self.start,
+            end - self.start, threading.get_ident(), self.args))
+        return False
+
+
+    def set(self, **args):
+        """ Add arguments known only inside the span """
+        self.args.update(args)
+
+
+class Tracer:
+    """ Leveled messages and spans for one module """
+    __slots__ = ('name', 'level')
+
+    def __init__(self, name, level):
+        self.name = name
+        self.level = level
+
+
+    def enabled(self, level):
+        return level >= self.level
+
+
+    def span(self, name, level=INFO, **args):
+        """ Context manager timing NAME (no-op below LEVEL) """
+        if level < self.level:
+            return NO_SPAN
+        return Span(self.name, name, args)
+
+
+    def log(self, level, msg, *args):
+        """ Print and record MSG % ARGS if LEVEL is enabled """
+        if level < self.level:
+            return
+        if args:
+            msg = msg % args
+        events.append(('i', self.name, msg, perf_counter_ns(), 0,
+            threading.get_ident(), None))
+        print(msg)
+
+
+    def debug(self, msg, *args):
+        if DEBUG >= self.level:
+            self.log(DEBUG, msg, *args)
+
+
+    def info(self, msg, *args):
+        if INFO >= self.level:
+            self.log(INFO, msg, *args)
+
+
+    def warning(self, msg, *args):
+        if WARNING >= self.level:
+            self.log(WARNING, msg, *args)
+
+
+    def error(self, msg, *args):
+        if ERROR >= self.level:
+            self.log(ERROR, msg, *args)
+
+
+def _parse_level(level):
+    if isinstance(level, str):
+        return LEVELS[level.strip().lower()]
+    return int(level)
+
+
+def get_tracer(name):
+    """ Return the tracer for module NAME """
+    with _lock:
+        tracer = _tracers.get(name)
+        if tracer is None:
+            tracer = Tracer(name, _module_levels.get(name, _default_level))
+            _tracers[name] = tracer
+        return tracer
+
+
+def configure(spec=None, level=None, **modules):
+    """ Set tracing levels. SPEC is a string as in the
+        ADAPTIVE_RATING_TRACE variable; LEVEL sets the default
+        and keyword arguments set single modules, e.g.
+        configure(level='warning', app='debug').
+    """
+    global _default_level
+    if spec:
+        for part in spec.split(','):
+            if not part.strip():
+                continue
+            if '=' in part:
+                name, value = part.split('=', 1)
+                modules[name.strip()] = value
+            else:
+                level = part
+    with _lock:
+        if level is not None:
+            _default_level = _parse_level(level)
+        for name, value in modules.items():
+            _module_levels[name] = _parse_level(value)
+        for name, tracer in _tracers.items():
+            tracer.level = _module_levels.get(name, _default_level)
+
+
+def clear():
+    """ Empty the event buffer """
+    events.clear()
+
+
+def export_chrome(path, clear_events=False):
+    """ Write the recorded events to PATH as Chrome trace-event
+        JSON. Returns the number of events written.
+    """
+    pid = os.getpid()
+    snapshot = list(events)
+    trace_events = []
+    for phase, module, name, start, duration, tid, args in snapshot:
+        event = {
+            'name': name,
+            'cat': module,
+            'ph': phase,
+            'ts': (start - _origin_ns) / 1000,
+            'pid': pid,
+            'tid': tid
+        }
+        if phase == 'X':
+            event['dur'] = duration / 1000
+            if args:
+                event['args'] = {k: v if isinstance(v, (int, float, str,
+                    bool, type(None))) else str(v) for k, v in args.items()}
+        else:
+            # Instant event scoped to its thread
+            event['s'] = 't'
+        trace_events.append(event)
+
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as fh:
+        json.dump({'traceEvents': trace_events,
+            'displayTimeUnit': 'ms'}, fh)
+    os.replace(tmp, path)
+    if clear_events:
+        clear()
+    return len(trace_events)
+
+
+configure(os.environ.get('ADAPTIVE_RATING_TRACE'))
@@ -0,0 +1,386 @@
+""" Headless adaptive track for Adaptive Rating
+
+    The staircase logic, independent of tkinter: arrow button
+    presses move an index through a sorted stimulus list, with
+    clamping at both ends and a random restart after each
+    submitted rating. The GUI (adaptive_rating.Application) is
+    a thin client of AdaptiveTrack, and the same object can be
+    driven by simulations, benchmarks or other front-ends.
+
+    BayesianTrack is an alternative with the same interface: it
+    places each stimulus where the next press is expected to
+    tell the most about the preferred Parameter value.
+"""
+
+# Import system packages
+import random
+import threading
+from collections import OrderedDict
+
+# Import data science packages
+import numpy as np
+
+
+# Index change for each arrow button
+STEP_SIZES = {
+    'bigup': -4,
+    'smallup': -1,
+    'bigdown': 4,
+    'smalldown': 1
+}
+
+
+class AdaptiveTrack:
+    """ Staircase over a sorted list of stimulus PARAMETERS.
+
+        STEPS: index change for each button ID
+        RNG: random.Random used for restarts
+    """
+    __slots__ = ('parameters', 'steps', 'rng', 'index', 'limit', 'presses')
+
+    def __init__(self, parameters, steps=None, rng=None):
+        self.parameters = parameters
+        self.steps = dict(STEP_SIZES if steps is None else steps)
+        self.rng = rng or random.Random()
+        # True if the last press was clamped at an end of the list
+        self.limit = False
+        # Presses since the last restart
+        self.presses = 0
+        self.index = 0
+        self.restart()
+
+
+    def restart(self):
+        """ Choose a new random starting index. As in earlier
+            versions, the last stimulus is never a start point.
+        """
+        self.index = self.rng.randrange(max(len(self.parameters) - 1, 1))
+        self.presses = 0
+        self.limit = False
+        return self.index
+
+
+    def press(self, button_id):
+        """ Apply an arrow button press and return the index of
+            the stimulus to present
+        """
+        index = self.index + self.steps.get(button_id, 0)
+        last = len(self.parameters) - 1
+        # Make sure index stays within bounds
+        if index >= last:
+            index = last
+            self.limit = True
+        elif index <= 0:
+            index = 0
+            self.limit = True
+        else:
+            self.limit = False
+        self.index = index
+        self.presses += 1
+        return index
+
+
+    def repeat(self):
+        """ Index of the stimulus to present again """
+        return self.index
+
+
+    def candidates(self):
+        """ Indices the next press can lead to (for prefetching) """
+        last = len(self.parameters) - 1
+        indices = {min(max(self.index + step, 0), last)
+            for step in self.steps.values()}
+        indices.discard(self.index)
+        return sorted(indices)
+
+
+    def deferred_candidates(self):
+        """ candidates() of the current state as a function that
+            can be called later from another thread
+        """
+        candidates = self.candidates()
+        return lambda: candidates
+
+
+    def submit(self):
+        """ Finish a rating. Returns the data to record and
+            restarts the track at a random index.
+        """
+        record = {
+            'Index': self.index,
+            'Parameter': self.parameters[self.index],
+            'Presses': self.presses
+        }
+        self.restart()
+        return record
+
+
+    def set_parameters(self, parameters, index):
+        """ Replace the stimulus list (e.g., after the directory
+            changed) and move to INDEX
+        """
+        self.parameters = parameters
+        self.index = min(max(index, 0), max(len(parameters) - 1, 0))
+
+
+def _expit(x):
+    """ Logistic function (overflow-free) """
+    return 0.5 * (1 + np.tanh(0.5 * x))
+
+
+class BayesianTrack:
+    """ Bayesian adaptive placement over a sorted list of
+        stimulus PARAMETERS.
+
+        A posterior over the listener's preferred Parameter value
+        is kept on a grid of GRID_SIZE points. Each arrow press
+        is an observation: the direction says whether the
+        preferred value is below or above the presented one, and
+        a big arrow says it is far away (more than BIG_DISTANCE,
+        with a logistic SLOPE). Instead of stepping through the
+        list, the next stimulus is the one (among N_CANDIDATES 
+        spread over the posterior) that maximizes the expected 
+        information gain of the next press.
+
+        Has the same interface as AdaptiveTrack. Non-numeric
+        parameters are placed by their position in the list.
+    """
+    # Buttons that ask for a lower Parameter value
+    LOWER = ('bigup', 'smallup')
+    BUTTONS = ('bigup', 'smallup', 'bigdown', 'smalldown')
+    # Grid resolution used to choose the next stimulus
+    SELECT_POINTS = 1000
+    # Stimuli whose outcome probabilities are kept for selection
+    CACHE_STIMULI = 512
+    # The start is drawn from this many of the most informative
+    # stimuli, so ratings do not all begin on the same one
+    START_CHOICES = 16
+
+    def __init__(self, parameters, grid_size=2000, slope=None, 
+        big_distance=None, n_candidates=32, rng=None):
+        self.grid_size = grid_size
+        self.n_candidates = n_candidates
+        self._slope = slope
+        self._big_distance = big_distance
+        self.steps = dict(STEP_SIZES)
+        self.rng = rng or random.Random()
+        self.limit = False
+        self.presses = 0
+        # Guards the selection cache (see deferred_candidates)
+        self._rows_lock = threading.Lock()
+        self.set_parameters(parameters, 0)
+        self.restart()
+
+
+    def set_parameters(self, parameters, index):
+        """ Replace the stimulus list and move to INDEX. The
+            posterior is kept on the new grid.
+        """
+        self.parameters = parameters
+        try:
+            values = np.asarray(parameters, dtype=np.float64)
+        except (TypeError, ValueError):
+            values = np.arange(len(parameters), dtype=np.float64)
+        self.values = values if len(values) else np.zeros(1)
+
+        lo, hi = self.values.min(), self.values.max()
+        span = (hi - lo) or 1.0
+        old_grid = getattr(self, 'grid', None)
+        self.grid = np.linspace(lo, hi, self.grid_size)
+        self.slope = self._slope or span / 50
+        self.big_distance = self._big_distance or span / 10
+        if old_grid is not None:
+            self.log_post = np.interp(self.grid, old_grid, self.log_post)
+        # Selection grid (every STEP-th point) and the outcome 
+        # probabilities on it by stimulus index
+        self._starts = np.arange(0, self.grid_size, 
+            -(-self.grid_size // self.SELECT_POINTS))
+        with self._rows_lock:
+            self._rows = OrderedDict()
+        self.index = min(max(index, 0), max(len(parameters) - 1, 0))
+
+
+    def restart(self):
+        """ Reset the posterior and choose a random starting 
+            stimulus among the most informative ones
+        """
+        self.log_post = np.zeros(self.grid_size)
+        self.presses = 0
+        self.limit = False
+        self.index = self._best_index(self.log_post, self.START_CHOICES)
+        self.start = self.index
+        return self.index
+
+
+    def _outcomes(self, x, grid):
+        """ P(button | preferred value) on GRID for stimuli X. 
+            Returns an array of shape (len(X), 4, len(GRID)) in
+            the order of BUTTONS.
+        """
+        dist = np.atleast_1d(x)[:, np.newaxis] - grid
+        lower = _expit(dist / self.slope)
+        big = _expit((np.abs(dist) - self.big_distance) / self.slope)
+        return np.stack([lower * big, lower * (1 - big),
+            (1 - lower) * big, (1 - lower) * (1 - big)], axis=1)
+
+
+    def _likelihood(self, x, button_id):
+        """ P(BUTTON_ID | preferred value) on the grid """
+        dist = x - self.grid
+        lower = _expit(dist / self.slope)
+        if button_id not in self.LOWER:
+            lower = 1 - lower
+        big = _expit((np.abs(dist) - self.big_distance) / self.slope)
+        if not button_id.startswith('big'):
+            big = 1 - big
+        return np.maximum(lower * big, 1e-300)
+
+
+    def update(self, index, button_id):
+        """ Add the observation BUTTON_ID at stimulus INDEX to the
+            posterior (O(grid_size))
+        """
+        self.log_post += np.log(self._likelihood(self.values[index], button_id))
+        self.log_post -= self.log_post.max()
+
+
+    def _best_index(self, log_post, choices=1):
+        """ Stimulus index with the highest expected information
+            gain about the preferred value. With CHOICES > 1, a
+            random one (self.rng) of the CHOICES best.
+        """
+        post = np.exp(log_post - log_post.max())
+        post /= post.sum()
+
+        # Candidate stimuli spread over the posterior
+        cdf = np.cumsum(post)
+        quantiles = (np.arange(self.n_candidates) + 0.5) / self.n_candidates
+        theta = self.grid[np.minimum(np.searchsorted(cdf, quantiles),
+            self.grid_size - 1)]
+        candidates = np.unique(self._nearest(theta))
+
+        # Score on at most SELECT_POINTS grid points
+        post = np.add.reduceat(post, self._starts)
+        probs, conditional = self._selection_rows(candidates)
+        marginal = probs @ post
+        entropy = -(marginal * np.log(marginal)).sum(axis=1)
+        expected = conditional @ post
+        gain = entropy - expected
+        if choices > 1:
+            best = np.argsort(gain)[::-1][:choices]
+            return int(candidates[self.rng.choice(best.tolist())])
+        return int(candidates[np.argmax(gain)])
+
+
+    def _selection_rows(self, candidates):
+        """ Outcome probabilities of CANDIDATES on the selection
+            grid, shape (len(CANDIDATES), 4, points), and their 
+            entropies, shape (len(CANDIDATES), points). Rows are
+            cached by stimulus (candidates repeat from press to 
+            press).
+        """
+        candidates = candidates.tolist()
+        with self._rows_lock:
+            rows = self._rows
+            missing = [x for x in candidates if x not in rows]
+        if missing:
+            probs = np.maximum(self._outcomes(self.values[missing], 
+                self.grid[self._starts]), 1e-300)
+            conditional = -(probs * np.log(probs)).sum(axis=1)
+        selected = []
+        with self._rows_lock:
+            for ii, index in enumerate(missing):
+                rows[index] = (probs[ii], conditional[ii])
+            for index in candidates:
+                rows.move_to_end(index)
+                selected.append(rows[index])
+            while len(rows) > self.CACHE_STIMULI:
+                rows.popitem(last=False)
+        return (np.stack([x[0] for x in selected]), 
+            np.stack([x[1] for x in selected]))
+
+
+    def _nearest(self, theta):
+        """ Indices of the stimuli closest to values THETA """
+        idx = np.clip(np.searchsorted(self.values, theta), 1, 
+            max(len(self.values) - 1, 1))
+        left = self.values[idx - 1]
+        right = self.values[np.minimum(idx, len(self.values) - 1)]
+        idx = idx - (np.abs(theta - left) <= np.abs(theta - right))
+        return np.clip(idx, 0, len(self.parameters) - 1 if 
+            len(self.parameters) else 0)
+
+
+    def press(self, button_id):
+        """ Apply an arrow button press and return the index of
+            the stimulus to present
+        """
+        if button_id not in self.BUTTONS:
+            return self.index
+        self.update(self.index, button_id)
+        self.index = self._best_index(self.log_post)
+        self.presses += 1
+        return self.index
+
+
+    def repeat(self):
+        """ Index of the stimulus to present again """
+        return self.index
+
+
+    def candidates(self):
+        """ Index presented after each possible press """
+        return self._candidates(self.index, self.log_post)
+
+
+    def deferred_candidates(self):
+        """ candidates() of the current state as a function that
+            can be called later from another thread. Selection
+            takes several ms, so the GUI hands it to the 
+            prefetch thread.
+        """
+        index, log_post = self.index, self.log_post.copy()
+        return lambda: self._candidates(index, log_post)
+
+
+    def _candidates(self, index, log_post):
+        x = self.values[index]
+        indices = {self._best_index(log_post + np.log(
+            self._likelihood(x, button))) for button in self.BUTTONS}
+        indices.discard(index)
+        return sorted(indices)
+
+
+    def estimate(self):
+        """ Posterior mean and standard deviation of the 
+            preferred Parameter value
+        """
+        post = np.exp(self.log_post - self.log_post.max())
+        post /= post.sum()
+        mean = float(post @ self.grid)
+        sd = float(np.sqrt(post @ (self.grid - mean)**2))
+        return mean, sd
+
+
+    def submit(self):
+        """ Finish a rating. Returns the data to record (with the
+            posterior estimate) and restarts the track.
+        """
+        mean, sd = self.estimate()
+        record = {
+            'Index': self.index,
+            'Parameter': self.parameters[self.index],
+            'Presses': self.presses,
+            'Start Index': self.start,
+            'Estimate': mean,
+            'Estimate SD': sd
+        }
+        self.restart()
+        return record
+
+
+# Track class for each 'Track Mode' session parameter
+TRACKS = {
+    'staircase': AdaptiveTrack,
+    'bayesian': BayesianTrack
+}
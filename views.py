@@ -6,16 +6,9 @@ from tkinter import ttk
 from tkinter import filedialog
 from tkinter.simpledialog import Dialog
 
-# Import data science packages
-from pandastable import Table
-import numpy as np
-import pandas as pd
-
 # Import system packages
 import os
-
-# Import audio packages
-import sounddevice as sd
+from time import perf_counter_ns
 
 # Import custom modules
 import widgets as w
@@ -39,6 +32,9 @@ class MainFrame(ttk.Frame):
             'Audio Filename': tk.StringVar()
         }
 
+        # Time of the last button press (for latency measurement)
+        self.press_ns = None
+
         # Just using message boxes to indicate limits now
         # These event calls changed the background color, etc.
         #self.bind('<<UpperLimit>>', self._upper_limit) 
@@ -47,24 +43,28 @@ class MainFrame(ttk.Frame):
         # Button functions
         def do_big_up():
             """ Send button ID and play event """
+            self.press_ns = perf_counter_ns()
             self._vars['Button ID'].set("bigup")
             self.event_generate('<<PlayAudio>>')
 
 
         def do_small_up():
             """ Send button ID and play event """
+            self.press_ns = perf_counter_ns()
             self._vars['Button ID'].set("smallup")
             self.event_generate('<<PlayAudio>>')
 
 
         def do_big_down():
             """ Send button ID and play event """
+            self.press_ns = perf_counter_ns()
             self._vars['Button ID'].set("bigdown")
             self.event_generate('<<PlayAudio>>')
 
 
         def do_small_down():
             """ Send button ID and play event """
+            self.press_ns = perf_counter_ns()
             self._vars['Button ID'].set("smalldown")
             self.event_generate('<<PlayAudio>>')
 
@@ -118,6 +118,7 @@ class MainFrame(ttk.Frame):
             file list.
         """
         # Send play audio event to app
+        self.press_ns = perf_counter_ns()
         self.button_text.set("Repeat")
         self.btn_submit.config(state="enabled")
         self.event_generate('<<RepeatAudio>>')
@@ -164,6 +165,8 @@ class Calibration(tk.Toplevel):
         self.focus()
         self.title("Calibration")
         self.grab_set()
+        # Stop the calibration stimulus when the window closes
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
 
 
         # Label frames #
@@ -226,11 +229,17 @@ class Calibration(tk.Toplevel):
         ent_slm = ttk.Entry(lf_present, textvariable=self.sessionpars['Raw Level'],
             width=6)
         ent_slm.grid(column=10, row=5, sticky='w', **options_small)
+        # Apply a new level to the playing stimulus once it is
+        # entered, not on every keystroke
+        ent_slm.bind('<Return>', self._on_raw_level)
+        ent_slm.bind('<FocusOut>', self._on_raw_level)
  
         # Play calibration stimulus
         lbl_play = ttk.Label(lf_present, text="Calibration Stimulus:").grid(
             column=5, row=10, sticky='e', **options_small)
-        btn_play = ttk.Button(lf_present, text="Play", command=self._on_play)
+        self.play_text = tk.StringVar(value="Play")
+        btn_play = ttk.Button(lf_present, textvariable=self.play_text,
+            command=self._on_play)
         btn_play.grid(column=10, row=10, sticky='w', **options_small)
         btn_play.focus()
 
@@ -319,19 +328,41 @@ class Calibration(tk.Toplevel):
 
 
     def _on_play(self):
-        """ Send play event to controller and 
-            enable SLM value entry controls
+        """ Toggle the looping calibration stimulus. Send play 
+            event to controller and enable SLM value entry 
+            controls.
         """
+        if self.play_text.get() == "Stop":
+            self._stop()
+            return
         print(f"Using calibration file: " +
             f"{self.sessionpars['Calibration File'].get()}")
         self.parent.event_generate('<<PlayCalStim>>')
+        self.play_text.set("Stop")
         self.btn_submit.config(state='enabled')
         self.ent_slm.config(state='enabled')
 
 
+    def _on_raw_level(self, *_):
+        """ Send the entered Raw Level to the controller """
+        self.parent.event_generate('<<CalRawLevel>>')
+
+
+    def _stop(self):
+        """ Send stop event to controller """
+        self.parent.event_generate('<<StopCalStim>>')
+        self.play_text.set("Play")
+
+
+    def _on_close(self):
+        self._stop()
+        self.destroy()
+
+
     def _on_submit(self):
         """ Send save SLM value event to controller
         """
+        self._stop()
         print("\nView_Cal_89: Sending save calibration event...")
         self.parent.event_generate('<<CalibrationSubmit>>')
         self.destroy()
@@ -341,10 +372,30 @@ class Calibration(tk.Toplevel):
 # Audio Parameters Dialog #
 ###########################
 class AudioParams(tk.Toplevel):
-    def __init__(self, parent, sessionpars, *args, **kwargs):
+    """ Audio settings dialog. The device list comes from 
+        INVENTORY (see devices.DeviceInventory), which is 
+        refreshed in the background, so the dialog opens 
+        without scanning the devices.
+    """
+    # Device table columns: (inventory key, heading, width)
+    columns = (
+        ('id', "ID", 40),
+        ('name', "Name", 220),
+        ('hostapi', "Host API", 110),
+        ('chans_out', "Out", 40),
+        ('samplerates', "Sample Rates (kHz)", 150),
+        ('low_latency', "Low (ms)", 70),
+        ('high_latency', "High (ms)", 70)
+    )
+
+    def __init__(self, parent, sessionpars, inventory, *args, **kwargs):
         super().__init__(parent, *args, *kwargs)
         self.parent = parent
         self.sessionpars = sessionpars
+        self.inventory = inventory
+        self._shown = None
+        # Pending after() call of _show_devices
+        self._poll_id = None
 
         self.withdraw()
         self.focus()
@@ -374,24 +425,51 @@ class AudioParams(tk.Toplevel):
             textvariable=self.sessionpars['Audio Device ID'], width=6)
         ent_deviceID.grid(column=10, row=10, sticky='w', **options_small)
 
+        # Stream block size
+        lbl_blocksize = ttk.Label(lblfrm_settings, text="Block Size:").grid(
+            column=5, row=15, sticky='e', **options_small)
+        ent_blocksize = ttk.Entry(lblfrm_settings, 
+            textvariable=self.sessionpars['Block Size'], width=6)
+        ent_blocksize.grid(column=10, row=15, sticky='w', **options_small)
+
+        # Stream latency
+        lbl_latency = ttk.Label(lblfrm_settings, text="Output Latency:").grid(
+            column=5, row=20, sticky='e', **options_small)
+        ent_latency = ttk.Entry(lblfrm_settings, 
+            textvariable=self.sessionpars['Output Latency'], width=6)
+        ent_latency.grid(column=10, row=20, sticky='w', **options_small)
+
+        # Record latency measurements with each trial
+        chk_latency = ttk.Checkbutton(lblfrm_settings, 
+            text="Save latency measurements", takefocus=0,
+            variable=self.sessionpars['Record Latency'])
+        chk_latency.grid(column=5, columnspan=10, row=25, sticky='w', 
+            **options_small)
+
         # Submit button
         btnDeviceID = ttk.Button(self, text="Submit", 
             command=self._on_submit)
         btnDeviceID.grid(column=0, columnspan=10, row=10, **options_small)
 
-        # Get and display list of audio devices
-        deviceList = sd.query_devices()
-        names = [deviceList[x]['name'] for x in np.arange(0,len(deviceList))]
-        chans_out =  [deviceList[x]['max_output_channels'] for x in np.arange(0,len(deviceList))]
-        ids = np.arange(0,len(deviceList))
-        df = pd.DataFrame({
-            "device_id": ids, 
-            "name": names, 
-            "chans_out": chans_out})
-        pt = Table(frmTable, dataframe=df, showtoolbar=True, showstatusbar=True)
-        table = pt = Table(frmTable, dataframe=df)
-        table.grid(column=0, row=0)
-        pt.show()
+        # Display the cached list of audio devices
+        self.tree = ttk.Treeview(frmTable, show='headings', height=10,
+            columns=[x[0] for x in self.columns], selectmode='browse')
+        for key, heading, width in self.columns:
+            self.tree.heading(key, text=heading)
+            self.tree.column(key, width=width, anchor='w')
+        self.tree.grid(column=0, row=0, columnspan=3)
+        self.tree.bind('<Double-1>', self._use_selected)
+
+        self.device_status = tk.StringVar()
+        ttk.Label(frmTable, textvariable=self.device_status).grid(
+            column=0, row=1, sticky='w', **options_small)
+        ttk.Button(frmTable, text="Use Lowest Latency", takefocus=0,
+            command=self._use_lowest_latency).grid(
+            column=1, row=1, sticky='e', **options_small)
+        ttk.Button(frmTable, text="Refresh", takefocus=0,
+            command=self._refresh).grid(
+            column=2, row=1, sticky='e', **options_small)
+        self._show_devices()
 
         # Center window based on new size
         self.update_idletasks()
@@ -410,6 +488,82 @@ class AudioParams(tk.Toplevel):
         self.deiconify()
 
 
+    def _show_devices(self):
+        """ Fill the device table from the inventory, and check
+            again while a scan is running
+        """
+        self._poll_id = None
+        if self._shown != self.inventory.updated:
+            self._shown = self.inventory.updated
+            self.tree.delete(*self.tree.get_children())
+            for device in self.inventory.devices:
+                values = dict(device,
+                    samplerates=", ".join(f"{x / 1000:g}" 
+                        for x in device['samplerates']),
+                    low_latency=f"{device['low_latency'] * 1000:.1f}",
+                    high_latency=f"{device['high_latency'] * 1000:.1f}")
+                self.tree.insert('', 'end', iid=str(device['id']),
+                    values=[values[x[0]] for x in self.columns])
+            self._select(self.sessionpars['Audio Device ID'].get())
+
+        if self.inventory.scanning:
+            self.device_status.set("Scanning audio devices...")
+        elif self.inventory.error:
+            self.device_status.set(f"Device scan failed: {self.inventory.error}")
+        else:
+            self.device_status.set(
+                f"{len(self.inventory.devices)} output devices")
+        # Stop checking once a scan has finished or failed
+        if self.inventory.scanning or not (self.inventory.updated or
+            self.inventory.error):
+            self._poll_id = self.after(250, self._show_devices)
+
+
+    def _refresh(self):
+        """ Rescan the devices and show the result """
+        self.inventory.refresh()
+        if self._poll_id is None:
+            self._show_devices()
+
+
+    def destroy(self):
+        """ Stop checking the inventory when the dialog closes """
+        if self._poll_id is not None:
+            self.after_cancel(self._poll_id)
+            self._poll_id = None
+        super().destroy()
+
+
+    def _select(self, device_id):
+        """ Highlight DEVICE_ID in the table """
+        if self.tree.exists(str(device_id)):
+            self.tree.selection_set(str(device_id))
+            self.tree.see(str(device_id))
+
+
+    def _use_selected(self, *_):
+        """ Use the double-clicked device """
+        selection = self.tree.selection()
+        if selection:
+            self.sessionpars['Audio Device ID'].set(int(selection[0]))
+
+
+    def _use_lowest_latency(self):
+        """ Use the device with the lowest output latency that has
+            enough channels for the speaker number
+        """
+        device = self.inventory.lowest_latency(
+            min_channels=self.sessionpars['Speaker Number'].get())
+        if device is None:
+            self.device_status.set("No suitable device found")
+            return
+        self.sessionpars['Audio Device ID'].set(device['id'])
+        self.sessionpars['Output Latency'].set('low')
+        self._select(device['id'])
+        self.device_status.set(f"Using {device['name']} ({device['hostapi']}, " +
+            f"{device['low_latency'] * 1000:.1f} ms)")
+
+
     def _on_submit(self):
         print("View_294: Sending save audio config event...")
         self.parent.event_generate('<<AudioParsSubmit>>')
@@ -470,6 +624,27 @@ class SessionParams(Dialog):
         ttk.Button(my_frame, text="Browse", command=self._get_directory
             ).grid(row=6, column=1, sticky='w', pady=(0, 5))
 
+        # Reload the file list when the directory changes
+        ttk.Checkbutton(my_frame, text="Watch audio file directory for changes",
+            variable=self.sessionpars['Watch Audio Files'], takefocus=0
+            ).grid(row=8, column=1, sticky='w', pady=(0, 5))
+
+        # Stimulus placement
+        ttk.Label(my_frame, text="Track Mode:"
+            ).grid(row=9, column=0, sticky='e', **options)
+        ttk.Combobox(my_frame, width=17, state='readonly',
+            values=('staircase', 'bayesian'),
+            textvariable=self.sessionpars['Track Mode']
+            ).grid(row=9, column=1, sticky='w')
+
+        # Storage
+        ttk.Label(my_frame, text="Data Format:"
+            ).grid(row=10, column=0, sticky='e', **options)
+        ttk.Combobox(my_frame, width=17, state='readonly',
+            values=('csv', 'csv (normalized)', 'sqlite'),
+            textvariable=self.sessionpars['Data Format']
+            ).grid(row=10, column=1, sticky='w')
+
 
     def _get_directory(self):
         # Ask user to specify audio files directory
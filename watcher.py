@@ -0,0 +1,144 @@
+""" File-system watching for Adaptive Rating
+
+    DirectoryWatcher calls a function on a background thread
+    whenever a watched directory may have changed. On Linux it
+    uses inotify (through ctypes, no extra packages); elsewhere,
+    or if inotify is unavailable, it polls at a fixed interval.
+"""
+
+# Import system packages
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+
+# Import custom modules
+import tracing
+
+
+trace = tracing.get_tracer('watcher')
+
+
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_DELETE | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_inotify():
+    """ Return libc if it provides inotify, else None """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DirectoryWatcher:
+    """ Watch DIRECTORY and call ON_CHANGE() from a background
+        thread when it may have changed.
+
+        SUFFIX: only react to files with this ending
+        SETTLE: seconds without events before ON_CHANGE is
+            called, so a folder being rewritten is handled once
+        INTERVAL: seconds between polls (polling mode only)
+    """
+    def __init__(self, directory, on_change, suffix='.wav', settle=0.5,
+        interval=2.0):
+        self.directory = directory
+        self.on_change = on_change
+        self.suffix = suffix
+        self.settle = settle
+        self.interval = interval
+
+        self._libc = _load_inotify()
+        self.mode = 'inotify' if self._libc else 'polling'
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        """ Start watching """
+        target = self._run_inotify if self._libc else self._run_polling
+        self._thread = threading.Thread(target=target, daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """ Stop watching and wait for the thread to finish """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def _notify(self):
+        try:
+            self.on_change()
+        except Exception as e:
+            trace.warning("DirectoryWatcher: Update failed: %s", e)
+
+
+    def _run_polling(self):
+        while not self._stop.wait(self.interval):
+            self._notify()
+
+
+    def _run_inotify(self):
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0 or self._libc.inotify_add_watch(
+            fd, os.fsencode(self.directory), WATCH_MASK) < 0:
+            # Fall back to polling
+            if fd >= 0:
+                os.close(fd)
+            self.mode = 'polling'
+            self._run_polling()
+            return
+
+        pending = False
+        try:
+            while not self._stop.is_set():
+                # Wake up regularly to check for stop requests
+                timeout = self.settle if pending else 0.5
+                ready, _, _ = select.select([fd], [], [], timeout)
+                if ready:
+                    pending |= self._read_events(fd)
+                elif pending:
+                    # Quiet for SETTLE seconds: apply changes
+                    pending = False
+                    self._notify()
+        finally:
+            os.close(fd)
+
+
+    def _read_events(self, fd):
+        """ Read queued events. Returns True if any concerns a
+            watched file or the directory itself.
+        """
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        relevant = False
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            start = offset + EVENT_HEADER.size
+            name = data[start:start + length].rstrip(b'\0').decode(
+                errors='replace')
+            offset = start + length
+            if mask & IN_DELETE_SELF or name.lower().endswith(self.suffix):
+                relevant = True
+        return relevant